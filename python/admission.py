@@ -0,0 +1,464 @@
+"""
+Priority-aware admission control for Bedrock calls
+
+Calls are admitted against token buckets sized to the account quotas, so a
+burst queues locally (or is rejected quickly) instead of turning into
+account-wide throttling that slows every caller down. Each quota (a model
+ID, or 'retrieve') has a requests-per-minute and a tokens-per-minute
+bucket, refilled continuously.
+
+Callers wait in one priority queue per quota: interactive requests are
+admitted before batch items, and batch items before background jobs. Each
+priority class has a maximum queue time. A caller whose wait would exceed
+it is rejected immediately with AdmissionRejected (carrying a retry-after)
+rather than waiting only to fail.
+
+Quotas come from ADMISSION_QUOTAS (JSON); calls for unconfigured quotas
+are admitted without waiting, so admission control is off until quotas are
+set:
+
+    ADMISSION_QUOTAS='{"anthropic.claude-3-haiku-20240307-v1:0": {"rpm": 1000, "tpm": 200000},
+                       "retrieve": {"rpm": 600}}'
+
+Bucket state lives in memory by default. With ADMISSION_TABLE set it is
+kept in DynamoDB (partition key `bucket`) so all Lambda containers draw on
+the same quota.
+"""
+
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+import boto3
+from botocore.exceptions import ClientError
+
+from model_router import DEFAULT_REGION, _percentile
+
+PRIORITIES = {'interactive': 0, 'batch': 1, 'background': 2}
+# Longest a caller of each class may queue before it is rejected
+MAX_QUEUE_SECONDS = {
+    'interactive': float(os.environ.get('ADMISSION_MAX_WAIT_INTERACTIVE', '2')),
+    'batch': float(os.environ.get('ADMISSION_MAX_WAIT_BATCH', '10')),
+    'background': float(os.environ.get('ADMISSION_MAX_WAIT_BACKGROUND', '30')),
+}
+# Queued callers per quota beyond which new callers are rejected outright
+MAX_QUEUE_DEPTH = int(os.environ.get('ADMISSION_MAX_QUEUE_DEPTH', '100'))
+# Bucket capacity as a fraction of the per-minute quota (burst allowance)
+BURST_FRACTION = float(os.environ.get('ADMISSION_BURST_FRACTION', '0.1'))
+MAX_WAIT_SAMPLES = 1000
+# Re-check interval while waiting on a bucket shared with other workers
+SHARED_POLL_SECONDS = 0.05
+
+_priority = contextvars.ContextVar('admission_priority', default='interactive')
+
+
+class AdmissionRejected(Exception):
+    """Raised when a call cannot be admitted within its queue-time limit"""
+
+    def __init__(self, quota, priority, retry_after, reason):
+        super().__init__(f"{quota} admission rejected for {priority} call: {reason} "
+                         f"(retry after {retry_after:.1f}s)")
+        self.quota = quota
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+@contextmanager
+def priority(name):
+    """Run the block's Bedrock calls at a priority class (interactive, batch, background)"""
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown priority class: {name}")
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+def estimate_tokens(text):
+    """Rough token count for quota accounting (about 4 characters per token)"""
+    return max(1, len(text or '') // 4)
+
+
+class _BucketState:
+    """Levels of one request bucket and one token bucket"""
+
+    __slots__ = ('requests', 'tokens', 'updated_at')
+
+    def __init__(self, requests, tokens, updated_at):
+        self.requests = requests
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+def _refill(state, quota, now):
+    elapsed = max(0.0, now - state.updated_at)
+    state.requests = min(quota.request_capacity, state.requests + elapsed * quota.rpm / 60.0)
+    if quota.tpm:
+        state.tokens = min(quota.token_capacity, state.tokens + elapsed * quota.tpm / 60.0)
+    state.updated_at = now
+
+
+def _take(state, quota, tokens):
+    """
+    Take one request and `tokens` from a refilled state
+
+    Returns:
+        float: 0.0 when taken, otherwise seconds until enough has refilled
+    """
+    wait_requests = (1 - state.requests) * 60.0 / quota.rpm if state.requests < 1 else 0.0
+    tokens = min(tokens, quota.token_capacity) if quota.tpm else 0
+    wait_tokens = (tokens - state.tokens) * 60.0 / quota.tpm if quota.tpm and state.tokens < tokens else 0.0
+    wait = max(wait_requests, wait_tokens)
+    if wait <= 0:
+        state.requests -= 1
+        state.tokens -= tokens
+    return wait
+
+
+class Quota:
+    """Requests- and tokens-per-minute limits for one quota"""
+
+    __slots__ = ('name', 'rpm', 'tpm', 'request_capacity', 'token_capacity')
+
+    def __init__(self, name, rpm, tpm=None):
+        self.name = name
+        self.rpm = float(rpm)
+        self.tpm = float(tpm) if tpm else None
+        self.request_capacity = max(1.0, self.rpm * BURST_FRACTION)
+        self.token_capacity = max(1.0, self.tpm * BURST_FRACTION) if self.tpm else 0.0
+
+
+class InMemoryBucketBackend:
+    """Bucket state for a single process"""
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def _state(self, quota, now):
+        state = self._states.get(quota.name)
+        if state is None:
+            state = self._states[quota.name] = _BucketState(quota.request_capacity, quota.token_capacity, now)
+        return state
+
+    def try_acquire(self, quota, tokens):
+        """Take capacity if available; returns 0.0 or the seconds to wait"""
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(quota, now)
+            _refill(state, quota, now)
+            return _take(state, quota, tokens)
+
+    def adjust(self, quota, tokens):
+        """Return (positive) or charge (negative) tokens after the call"""
+        if not quota.tpm or not tokens:
+            return
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(quota, now)
+            _refill(state, quota, now)
+            state.tokens = min(quota.token_capacity, state.tokens + tokens)
+
+
+class DynamoDBBucketBackend:
+    """
+    Bucket state shared through a DynamoDB table
+
+    The table needs a string partition key named `bucket`. Updates use
+    optimistic concurrency on `updated_at`, so concurrent workers never
+    both take the same capacity.
+    """
+
+    shared = True
+
+    def __init__(self, table_name, region_name=DEFAULT_REGION, max_attempts=5):
+        self._table = boto3.resource('dynamodb', region_name=region_name).Table(table_name)
+        self.max_attempts = max_attempts
+
+    def _update(self, quota, change):
+        for _ in range(self.max_attempts):
+            now = time.time()
+            item = self._table.get_item(Key={'bucket': quota.name}, ConsistentRead=True).get('Item')
+            if item:
+                previous = item['updated_at']
+                state = _BucketState(float(item['requests']), float(item['tokens']), float(previous))
+            else:
+                previous = None
+                state = _BucketState(quota.request_capacity, quota.token_capacity, now)
+            _refill(state, quota, now)
+            result = change(state)
+            try:
+                self._table.put_item(
+                    Item={
+                        'bucket': quota.name,
+                        'requests': Decimal(str(round(state.requests, 6))),
+                        'tokens': Decimal(str(round(state.tokens, 6))),
+                        'updated_at': Decimal(str(round(now, 6))),
+                    },
+                    **({'ConditionExpression': 'updated_at = :previous',
+                        'ExpressionAttributeValues': {':previous': previous}}
+                       if previous is not None else
+                       {'ConditionExpression': 'attribute_not_exists(#b)',
+                        'ExpressionAttributeNames': {'#b': 'bucket'}})
+                )
+                return result
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        # Lost the race repeatedly: report a short wait and let the caller retry
+        return SHARED_POLL_SECONDS
+
+    def try_acquire(self, quota, tokens):
+        try:
+            return self._update(quota, lambda state: _take(state, quota, tokens))
+        except ClientError as e:
+            # Fail open: a broken limiter must not take the service down
+            print(f"Warning: Admission state unavailable: {e.response['Error']['Code']}")
+            return 0.0
+
+    def adjust(self, quota, tokens):
+        if not quota.tpm or not tokens:
+            return
+
+        def refund(state):
+            state.tokens = min(quota.token_capacity, state.tokens + tokens)
+        try:
+            self._update(quota, refund)
+        except ClientError as e:
+            print(f"Warning: Admission state unavailable: {e.response['Error']['Code']}")
+
+
+class _Waiter:
+    __slots__ = ('priority', 'seq')
+
+    def __init__(self, priority, seq):
+        self.priority = priority
+        self.seq = seq
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _QuotaQueue:
+    """
+    Waiters for one quota
+
+    Each quota has its own condition, so callers of different models never
+    contend. `polling` is set while the head of the queue is asking the
+    backend for capacity; the lock is not held during that call.
+    """
+
+    __slots__ = ('cond', 'waiters', 'polling')
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiters = []
+        self.polling = False
+
+
+class Ticket:
+    """An admitted call; settle() corrects the token estimate afterwards"""
+
+    __slots__ = ('controller', 'quota', 'estimated_tokens')
+
+    def __init__(self, controller, quota, estimated_tokens):
+        self.controller = controller
+        self.quota = quota
+        self.estimated_tokens = estimated_tokens
+
+    def settle(self, actual_tokens):
+        if self.quota is not None and actual_tokens is not None:
+            self.controller.backend.adjust(self.quota, self.estimated_tokens - actual_tokens)
+
+
+class AdmissionController:
+    """Priority queues in front of token-bucket quotas"""
+
+    def __init__(self, quotas=None, backend=None, max_queue_seconds=None, max_queue_depth=MAX_QUEUE_DEPTH):
+        self.quotas = {}
+        for name, limits in (quotas or {}).items():
+            self.quotas[name] = Quota(name, limits['rpm'], limits.get('tpm'))
+        self.backend = backend or InMemoryBucketBackend()
+        self.max_queue_seconds = dict(MAX_QUEUE_SECONDS, **(max_queue_seconds or {}))
+        self.max_queue_depth = max_queue_depth
+        # Guards the queue map and the stats; never held across backend calls
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._seq = itertools.count()
+        self._stats = {name: {'admitted': 0, 'rejected': 0, 'waited': 0, 'wait_ms': []} for name in PRIORITIES}
+        self._max_depth = 0
+
+    def _queue(self, quota_name):
+        with self._lock:
+            queue = self._queues.get(quota_name)
+            if queue is None:
+                queue = self._queues[quota_name] = _QuotaQueue()
+            return queue
+
+    def acquire(self, quota_name, tokens=0, priority_class=None):
+        """
+        Wait for capacity on a quota
+
+        Only the head of the quota's queue asks the backend for capacity,
+        and it does so without holding the queue's lock, so a slow shared
+        backend (DynamoDB) delays only that quota's head, not other quotas
+        or callers joining the queue.
+
+        Args:
+            quota_name (str): Model ID or 'retrieve'
+            tokens (int): Estimated tokens the call will consume
+            priority_class (str): Defaults to the current priority() block
+
+        Returns:
+            Ticket: Call settle() with the actual token count afterwards
+
+        Raises:
+            AdmissionRejected: If the call cannot start within the class's
+                               queue-time limit
+        """
+        priority_class = priority_class or _priority.get()
+        quota = self.quotas.get(quota_name)
+        if quota is None:
+            return Ticket(self, None, 0)
+
+        started = time.monotonic()
+        deadline = started + self.max_queue_seconds[priority_class]
+        waiter = _Waiter(PRIORITIES[priority_class], next(self._seq))
+        queue = self._queue(quota_name)
+        with queue.cond:
+            depth = len(queue.waiters)
+            if depth >= self.max_queue_depth:
+                self._record(priority_class, started, rejected=True)
+                raise AdmissionRejected(quota_name, priority_class, self.max_queue_seconds[priority_class],
+                                        f"queue full ({depth} waiting)")
+            heapq.heappush(queue.waiters, waiter)
+            depth += 1
+        with self._lock:
+            self._max_depth = max(self._max_depth, depth)
+
+        try:
+            while True:
+                with queue.cond:
+                    now = time.monotonic()
+                    if queue.waiters[0] is not waiter or queue.polling:
+                        wait = deadline - now
+                        if wait <= 0:
+                            self._record(priority_class, started, rejected=True)
+                            raise AdmissionRejected(quota_name, priority_class, 0.0,
+                                                    "queue time limit exceeded")
+                        queue.cond.wait(wait)
+                        continue
+                    # Claim the head's turn, then ask the backend unlocked
+                    queue.polling = True
+
+                try:
+                    wait = self.backend.try_acquire(quota, tokens)
+                finally:
+                    with queue.cond:
+                        queue.polling = False
+                        queue.cond.notify_all()
+
+                if wait <= 0:
+                    self._record(priority_class, started)
+                    return Ticket(self, quota, tokens)
+                if self.backend.shared:
+                    wait = min(max(wait, SHARED_POLL_SECONDS), 1.0)
+                now = time.monotonic()
+                if now + wait > deadline:
+                    # Capacity won't arrive in time: fail fast
+                    self._record(priority_class, started, rejected=True)
+                    raise AdmissionRejected(quota_name, priority_class, wait, "quota exhausted")
+                with queue.cond:
+                    # Woken early if a higher-priority caller becomes head
+                    queue.cond.wait(wait)
+        finally:
+            with queue.cond:
+                queue.waiters.remove(waiter)
+                heapq.heapify(queue.waiters)
+                queue.cond.notify_all()
+
+    def _record(self, priority_class, started, rejected=False):
+        with self._lock:
+            stats = self._stats[priority_class]
+            if rejected:
+                stats['rejected'] += 1
+                return
+            stats['admitted'] += 1
+            wait_ms = (time.monotonic() - started) * 1000
+            if wait_ms >= 1:
+                stats['waited'] += 1
+            stats['wait_ms'].append(wait_ms)
+            if len(stats['wait_ms']) > MAX_WAIT_SAMPLES:
+                del stats['wait_ms'][:len(stats['wait_ms']) - MAX_WAIT_SAMPLES]
+
+    def queue_depth(self):
+        """Current number of waiters per quota"""
+        with self._lock:
+            return {name: len(queue.waiters) for name, queue in self._queues.items() if queue.waiters}
+
+    def stats(self):
+        """Admitted/rejected counts and wait-time percentiles per priority class"""
+        with self._lock:
+            snapshot = {'queue_depth': {n: len(q.waiters) for n, q in self._queues.items() if q.waiters},
+                        'max_queue_depth': self._max_depth}
+            for name, stats in self._stats.items():
+                waits = sorted(stats['wait_ms'])
+                snapshot[name] = {
+                    'admitted': stats['admitted'],
+                    'rejected': stats['rejected'],
+                    'waited': stats['waited'],
+                    'p50_wait_ms': _percentile(waits, 50),
+                    'p95_wait_ms': _percentile(waits, 95),
+                }
+            return snapshot
+
+
+def _quotas_from_env():
+    raw = os.environ.get('ADMISSION_QUOTAS', '').strip()
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError as e:
+        print(f"Warning: Ignoring invalid ADMISSION_QUOTAS: {str(e)}")
+        return {}
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """
+    Return the process-wide admission controller
+
+    Quotas come from ADMISSION_QUOTAS; state is shared through DynamoDB when
+    ADMISSION_TABLE is set.
+    """
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            table_name = os.environ.get('ADMISSION_TABLE')
+            backend = DynamoDBBucketBackend(table_name) if table_name else InMemoryBucketBackend()
+            _controller = AdmissionController(_quotas_from_env(), backend)
+        return _controller
+
+
+def set_admission_controller(controller):
+    """Replace the process-wide admission controller"""
+    global _controller
+    with _controller_lock:
+        _controller = controller
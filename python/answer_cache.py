@@ -0,0 +1,148 @@
+"""
+Answer cache for precomputed query_with_sources results
+
+Holds answers for the head of the query distribution, keyed by normalized
+query, KB ID and model. Entries carry the KB content version they were
+computed against and are ignored once the KB has been re-synced. A snapshot
+of the cache can be written to S3 (or a local file) by the warming job and
+loaded by every new Lambda container on its first request, so a cold
+container starts with the head already hot.
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+
+from model_router import DEFAULT_REGION
+from single_flight import normalize_query
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', '2000'))
+
+
+def _split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class AnswerCache:
+    """Bounded LRU of answers tagged with the KB version they were built from"""
+
+    def __init__(self, version_fn=None, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._version_fn = version_fn
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(query, kb_id, model_arn):
+        return (kb_id, model_arn, normalize_query(query))
+
+    def _current_version(self, kb_id):
+        return self._version_fn(kb_id) if self._version_fn else None
+
+    def get(self, query, kb_id, model_arn):
+        """Return the cached answer dict for the current KB version, or None"""
+        key = self.make_key(query, kb_id, model_arn)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        version = self._current_version(kb_id)
+        with self._lock:
+            if version is not None and entry[0] != version:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, query, kb_id, model_arn, answer, version=None):
+        """Store an answer dict (tagged with the given or current KB version)"""
+        if version is None:
+            version = self._current_version(kb_id)
+        key = self.make_key(query, kb_id, model_arn)
+        with self._lock:
+            self._entries[key] = (version, answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def versions(self, kb_id=None):
+        """KB versions the entries (for one KB, or all) were built from"""
+        with self._lock:
+            return {version for (entry_kb_id, _, _), (version, _) in self._entries.items()
+                    if kb_id is None or entry_kb_id == kb_id}
+
+    # ---- snapshots ----
+
+    def export_snapshot(self):
+        """Return all entries as a JSON-serializable snapshot"""
+        with self._lock:
+            return {
+                'entries': [
+                    {'kb_id': kb_id, 'model_arn': model_arn, 'query': query,
+                     'version': version, 'answer': answer}
+                    for (kb_id, model_arn, query), (version, answer) in self._entries.items()
+                ]
+            }
+
+    def load_snapshot(self, snapshot):
+        """
+        Load entries from a snapshot
+
+        Returns:
+            int: Number of entries loaded
+        """
+        entries = snapshot.get('entries', [])
+        for entry in entries:
+            self.put(entry['query'], entry['kb_id'], entry['model_arn'], entry['answer'], entry.get('version'))
+        return len(entries)
+
+    def save(self, location):
+        """Write a snapshot to an s3:// URI or a local path"""
+        body = json.dumps(self.export_snapshot())
+        if location.startswith('s3://'):
+            bucket, key = _split_s3_uri(location)
+            boto3.client('s3', region_name=DEFAULT_REGION).put_object(
+                Bucket=bucket, Key=key, Body=body.encode('utf-8'), ContentType='application/json'
+            )
+        else:
+            with open(location, 'w') as f:
+                f.write(body)
+
+    def load(self, location):
+        """
+        Load a snapshot from an s3:// URI or a local path
+
+        Returns:
+            int: Number of entries loaded (0 when the snapshot is missing)
+        """
+        try:
+            if location.startswith('s3://'):
+                bucket, key = _split_s3_uri(location)
+                response = boto3.client('s3', region_name=DEFAULT_REGION).get_object(Bucket=bucket, Key=key)
+                snapshot = json.loads(response['Body'].read())
+            else:
+                with open(location) as f:
+                    snapshot = json.load(f)
+        except ClientError as e:
+            print(f"Warning: Could not load answer cache snapshot: {e.response['Error']['Code']}")
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not load answer cache snapshot: {str(e)}")
+            return 0
+        return self.load_snapshot(snapshot)
@@ -1,20 +1,118 @@
 import boto3
 import json
+import os
+import threading
+import time
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from admission import AdmissionRejected, estimate_tokens, get_admission_controller
+from answer_cache import AnswerCache
+from facets import build_filter, detect_query_facets
+from model_router import DEFAULT_REGION, FALLBACK_ERROR_CODES, get_profile, model_id_from_arn, route_stats
+from profiling import stage
+from results import Answer, chunks_from_results
+from retrieval_cache import RetrievalCache
+from single_flight import SingleFlight, make_key
+from token_policy import get_token_policy
 
-bedrock_kb = boto3.client('bedrock-agent-runtime', region_name='us-east-1')
-bedrock = boto3.client('bedrock-runtime', region_name='us-east-1')
+# Connection pool per client; raise it to the number of worker threads when
+# one process serves many requests at once (see server.py)
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get('BEDROCK_MAX_POOL_CONNECTIONS', '10'))
+_client_config = Config(max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS)
 
-def query_knowledge_base(query, kb_id):
+bedrock_kb = boto3.client('bedrock-agent-runtime', region_name=DEFAULT_REGION, config=_client_config)
+bedrock = boto3.client('bedrock-runtime', region_name=DEFAULT_REGION, config=_client_config)
+
+# Read timeout for the agent-runtime clients fan-out targets use (every
+# region, the default one included); fan-out callers stop waiting at their
+# own deadline, this bounds the abandoned call
+REGIONAL_READ_TIMEOUT_SECONDS = float(os.environ.get('REGIONAL_READ_TIMEOUT_SECONDS', '10'))
+_regional_kb_clients = {}
+_regional_kb_lock = threading.Lock()
+
+# Tokens charged against the model quota for a retrieve_and_generate call
+# (retrieved context plus answer), which reports no usage to settle with
+RAG_TOKEN_ESTIMATE = int(os.environ.get('RAG_TOKEN_ESTIMATE', '2000'))
+
+# Shared by all callers in this process so identical concurrent queries coalesce
+inflight = SingleFlight()
+
+# Retrieval results, invalidated when the KB's latest ingestion job changes
+retrieval_cache = RetrievalCache()
+
+# Precomputed answers for top queries, loaded from ANSWER_CACHE_LOCATION
+answer_cache = AnswerCache(version_fn=retrieval_cache.kb_version)
+_answer_snapshot_lock = threading.Lock()
+_answer_snapshot_version = object()
+# Reload backoff while the snapshot is older than the KB (warm_cache not run yet)
+ANSWER_SNAPSHOT_RETRY_SECONDS = float(os.environ.get('ANSWER_SNAPSHOT_RETRY_SECONDS', '30'))
+ANSWER_SNAPSHOT_MAX_RETRY_SECONDS = float(os.environ.get('ANSWER_SNAPSHOT_MAX_RETRY_SECONDS', '600'))
+_answer_snapshot_retry_at = {}
+_answer_snapshot_backoff = ANSWER_SNAPSHOT_RETRY_SECONDS
+
+def _new_agent_runtime(region):
+    return boto3.client(
+        'bedrock-agent-runtime', region_name=region,
+        config=Config(read_timeout=REGIONAL_READ_TIMEOUT_SECONDS, retries={'max_attempts': 2},
+                      max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS)
+    )
+
+def agent_runtime_client(region=None, bounded=False):
+    """
+    Return the bedrock-agent-runtime client for a region (created once per region)
+    
+    bounded=True returns a client with the short REGIONAL_READ_TIMEOUT_SECONDS
+    read timeout even for the default region, for callers (fan-out) that
+    abandon slow calls on a shared pool.
+    """
+    region = region or DEFAULT_REGION
+    if region == DEFAULT_REGION and not bounded:
+        return bedrock_kb
+    with _regional_kb_lock:
+        client = _regional_kb_clients.get(region)
+        if client is None:
+            client = _regional_kb_clients[region] = _new_agent_runtime(region)
+    return client
+
+def _auto_filter(query, metadata_filter, auto_filter):
+    """
+    Facet filter for a query (see query_knowledge_base)
+    
+    Returns:
+        tuple: (filter or None, True if the filter was detected from the query)
+    """
+    if metadata_filter is None and auto_filter:
+        metadata_filter = build_filter(detect_query_facets(query))
+        return metadata_filter, metadata_filter is not None
+    return metadata_filter, False
+
+def query_knowledge_base(query, kb_id, number_of_results=3, search_type='HYBRID', use_cache=True,
+                         metadata_filter=None, auto_filter=True, region=None, bounded=False, raise_errors=False):
     """
     Query the Bedrock Knowledge Base with enhanced error handling
     
     Args:
         query (str): The user's question
         kb_id (str): Knowledge Base ID
+        number_of_results (int): Number of chunks to retrieve
+        search_type (str): HYBRID or SEMANTIC
+        use_cache (bool): Serve from / populate the retrieval cache
+        metadata_filter (dict): Bedrock retrieval filter on document facets
+        auto_filter (bool): When no filter is given, narrow the search to
+                            facets detected in the query (equipment type,
+                            manufacturer, model); retries unfiltered if the
+                            filtered search finds nothing
+        region (str): Region of the knowledge base (default region if None)
+        bounded (bool): Use the short-read-timeout client (see agent_runtime_client)
+        raise_errors (bool): Raise retrieve failures instead of returning []
+                             (fan-out reports them per target)
     
     Returns:
         list: Retrieved results or empty list on error
+    
+    Raises:
+        admission.AdmissionRejected: When the retrieve quota has no room in time
+        ClientError, Exception: Retrieve failures, only with raise_errors
     """
     # Input validation
     if not query or not query.strip():
@@ -25,22 +123,50 @@ def query_knowledge_base(query, kb_id):
         print("Error: Knowledge Base ID is required")
         return []
     
+    metadata_filter, detected = _auto_filter(query, metadata_filter, auto_filter)
+    
+    results = _retrieve(query, kb_id, number_of_results, search_type, use_cache, metadata_filter, region, bounded,
+                        raise_errors)
+    
+    if not results and detected:
+        print("No results with detected facet filter, retrying unfiltered")
+        results = _retrieve(query, kb_id, number_of_results, search_type, use_cache, None, region, bounded,
+                            raise_errors)
+    
+    return results
+
+def _retrieve(query, kb_id, number_of_results, search_type, use_cache, metadata_filter, region=None,
+              bounded=False, raise_errors=False):
+    """Run one retrieve call (through the retrieval cache)"""
+    if use_cache:
+        cached = retrieval_cache.get(query, kb_id, number_of_results, search_type, metadata_filter)
+        if cached is not None:
+            print(f"✓ Retrieval cache hit ({len(cached)} results)")
+            return cached
+    
     try:
         print(f"Querying KB: {kb_id} with query: '{query[:50]}...'")
         
+        vector_search_configuration = {
+            'numberOfResults': number_of_results,
+            'overrideSearchType': search_type
+        }
+        if metadata_filter:
+            vector_search_configuration['filter'] = metadata_filter
+        
+        get_admission_controller().acquire('retrieve')
+        
         # Query the knowledge base
-        response = bedrock_kb.retrieve(
-            knowledgeBaseId=kb_id,
-            retrievalQuery={
-                'text': query.strip()
-            },
-            retrievalConfiguration={
-                'vectorSearchConfiguration': {
-                    'numberOfResults': 3,
-                    'overrideSearchType': 'HYBRID'
+        with stage('retrieve'):
+            response = agent_runtime_client(region, bounded).retrieve(
+                knowledgeBaseId=kb_id,
+                retrievalQuery={
+                    'text': query.strip()
+                },
+                retrievalConfiguration={
+                    'vectorSearchConfiguration': vector_search_configuration
                 }
-            }
-        )
+            )
         
         # Validate response
         if 'retrievalResults' not in response:
@@ -50,18 +176,128 @@ def query_knowledge_base(query, kb_id):
         results = response['retrievalResults']
         print(f"✓ Found {len(results)} results")
         
+        if use_cache:
+            retrieval_cache.put(query, kb_id, number_of_results, search_type, results, metadata_filter)
+        
         return results
         
     except ClientError as e:
         error_code = e.response['Error']['Code']
         error_msg = e.response['Error']['Message']
         print(f"AWS Error querying KB: {error_code} - {error_msg}")
+        if raise_errors:
+            raise
         return []
+    except AdmissionRejected:
+        raise
     except Exception as e:
         print(f"Unexpected error: {type(e).__name__} - {str(e)}")
+        if raise_errors:
+            raise
         return []
 
-def generate_response(prompt, model_id, temperature=0.7, top_p=0.9, max_tokens=500):
+def _clamp_parameters(temperature, top_p, max_tokens):
+    """Clamp generation parameters to the ranges accepted by the model"""
+    temperature = max(0.0, min(1.0, temperature))
+    top_p = max(0.0, min(1.0, top_p))
+    max_tokens = max(1, min(4096, max_tokens))
+    return temperature, top_p, max_tokens
+
+def _invoke_model(prompt, model_id, temperature, top_p, max_tokens, stop_sequences=None, prefill=None):
+    """
+    Invoke a model once and return the parsed response body
+    
+    prefill starts the assistant turn, so the model only writes what
+    follows it (see token_policy.py).
+    
+    Raises:
+        ClientError: On any Bedrock API error (callers decide on fallback)
+        AdmissionRejected: When the model's quota has no room in time
+    """
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": prompt.strip()
+                }
+            ]
+        }
+    ]
+    if prefill:
+        messages.append({"role": "assistant", "content": [{"type": "text", "text": prefill}]})
+    
+    request_body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "top_p": top_p,
+    }
+    if stop_sequences:
+        request_body["stop_sequences"] = stop_sequences
+    
+    ticket = get_admission_controller().acquire(model_id, estimate_tokens(prompt) + max_tokens)
+    
+    with stage('invoke_model'):
+        response = bedrock.invoke_model(
+            modelId=model_id,
+            contentType='application/json',
+            accept='application/json',
+            body=json.dumps(request_body)
+        )
+        response_body = json.loads(response['body'].read())
+    
+    usage = response_body.get('usage', {})
+    if usage:
+        ticket.settle(usage.get('input_tokens', 0) + usage.get('output_tokens', 0))
+    return response_body
+
+def _response_text(response_body, prefill=None):
+    """Extract generated text (after any prefill) from a response body, or an error message"""
+    if 'content' not in response_body or not response_body['content']:
+        print("Error: Invalid response structure")
+        return "Error: Model returned invalid response"
+    
+    generated_text = response_body['content'][0].get('text', '')
+    
+    if not generated_text:
+        print("Warning: Generated text is empty")
+        return "Error: Model generated no text"
+    
+    print(f"✓ Generated {len(generated_text)} characters")
+    return (prefill or '') + generated_text
+
+def _record_budget(task, decision, response_body):
+    """Count a call made under a token policy decision"""
+    policy = get_token_policy()
+    if policy is None or decision is None:
+        return
+    output_tokens = response_body.get('usage', {}).get('output_tokens', 0)
+    # Prefilled calls are meant to stop at the budget
+    truncated = response_body.get('stop_reason') == 'max_tokens' and not decision['prefill']
+    policy.record(task, decision['query_class'], decision['max_tokens'], output_tokens, truncated)
+
+def _choose_budget(task, query):
+    """Token policy decision for a call, or None when the policy is off"""
+    policy = get_token_policy()
+    return policy.choose(task, query) if policy is not None else None
+
+def _client_error_message(e, model_id):
+    """Map a Bedrock ClientError to the error string returned to callers"""
+    error_code = e.response['Error']['Code']
+    error_msg = e.response['Error']['Message']
+    print(f"AWS Error: {error_code} - {error_msg}")
+    
+    if error_code == 'ResourceNotFoundException':
+        return f"Error: Model {model_id} not found"
+    elif error_code == 'AccessDeniedException':
+        return "Error: Access denied. Enable model in Bedrock console"
+    else:
+        return f"Error: {error_msg}"
+
+def generate_response(prompt, model_id, temperature=0.7, top_p=0.9, max_tokens=None):
     """
     Generate response using Bedrock with enhanced validation and error handling
     
@@ -70,7 +306,8 @@ def generate_response(prompt, model_id, temperature=0.7, top_p=0.9, max_tokens=5
         model_id (str): Bedrock model ID
         temperature (float): Controls randomness (0.0-1.0)
         top_p (float): Nucleus sampling (0.0-1.0)
-        max_tokens (int): Maximum response length
+        max_tokens (int): Maximum response length (default: the token
+                          policy's budget for the prompt, else 500)
     
     Returns:
         str: Generated text or error message
@@ -84,75 +321,127 @@ def generate_response(prompt, model_id, temperature=0.7, top_p=0.9, max_tokens=5
         print("Error: Model ID required")
         return "Error: Model ID not specified"
     
+    decision = _choose_budget('generate', prompt) if max_tokens is None else None
+    if max_tokens is None:
+        max_tokens = decision['max_tokens'] if decision and decision['max_tokens'] else 500
+    
     # Parameter validation and clamping
-    temperature = max(0.0, min(1.0, temperature))
-    top_p = max(0.0, min(1.0, top_p))
-    max_tokens = max(1, min(4096, max_tokens))
+    temperature, top_p, max_tokens = _clamp_parameters(temperature, top_p, max_tokens)
     
     try:
         print(f"Generating response with model: {model_id}")
         print(f"Parameters - temp: {temperature}, top_p: {top_p}, max_tokens: {max_tokens}")
         
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt.strip()
-                    }
-                ]
-            }
-        ]
-        
-        request_body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "messages": messages,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "top_p": top_p,
-        }
-        
-        response = bedrock.invoke_model(
-            modelId=model_id,
-            contentType='application/json',
-            accept='application/json',
-            body=json.dumps(request_body)
+        response_body = _invoke_model(
+            prompt, model_id, temperature, top_p, max_tokens,
+            stop_sequences=decision['stop_sequences'] if decision else None,
+            prefill=decision['prefill'] if decision else None
         )
-        
-        response_body = json.loads(response['body'].read())
-        
-        # Validate response
-        if 'content' not in response_body or not response_body['content']:
-            print("Error: Invalid response structure")
-            return "Error: Model returned invalid response"
-        
-        generated_text = response_body['content'][0].get('text', '')
-        
-        if not generated_text:
-            print("Warning: Generated text is empty")
-            return "Error: Model generated no text"
-        
-        print(f"✓ Generated {len(generated_text)} characters")
-        return generated_text
+        _record_budget('generate', decision, response_body)
+        return _response_text(response_body, decision['prefill'] if decision else None)
         
     except ClientError as e:
-        error_code = e.response['Error']['Code']
-        error_msg = e.response['Error']['Message']
-        print(f"AWS Error: {error_code} - {error_msg}")
-        
-        if error_code == 'ResourceNotFoundException':
-            return f"Error: Model {model_id} not found"
-        elif error_code == 'AccessDeniedException':
-            return "Error: Access denied. Enable model in Bedrock console"
-        else:
-            return f"Error: {error_msg}"
+        return _client_error_message(e, model_id)
             
     except Exception as e:
         print(f"Unexpected error: {type(e).__name__} - {str(e)}")
         return f"Error: {str(e)}"
 
-def valid_prompt(prompt, model_id):
+def generate_for_task(task, prompt, model_id=None, temperature=None, top_p=None, max_tokens=None, query=None):
+    """
+    Generate a response using the route profile for a task
+    
+    Uses the task's primary model and retries once on its fallback model
+    when the primary is throttled or unavailable. Latency, token usage and
+    estimated cost are recorded in model_router.route_stats.
+    
+    Args:
+        task (str): Route name (classify, generate, summarize)
+        prompt (str): Input prompt for the model
+        model_id (str): Optional primary model override
+        temperature (float): Optional override of the profile default
+        top_p (float): Optional override of the profile default
+        max_tokens (int): Optional override of the token policy budget
+                          (or the profile default when the policy is off)
+        query (str): The user's question inside the prompt, used to pick
+                     the token budget (defaults to the prompt)
+    
+    Returns:
+        str: Generated text or error message
+    """
+    if not prompt or not prompt.strip():
+        print("Error: Prompt cannot be empty")
+        return "Error: No prompt provided"
+    
+    profile = get_profile(task)
+    decision = _choose_budget(task, query or prompt) if max_tokens is None else None
+    if max_tokens is None:
+        max_tokens = decision['max_tokens'] if decision and decision['max_tokens'] else profile['max_tokens']
+    temperature, top_p, max_tokens = _clamp_parameters(
+        profile['temperature'] if temperature is None else temperature,
+        profile['top_p'] if top_p is None else top_p,
+        max_tokens
+    )
+    stop_sequences = decision['stop_sequences'] if decision else None
+    prefill = decision['prefill'] if decision else None
+    
+    candidates = [model_id or profile['model_id']]
+    if profile.get('fallback_model_id') and profile['fallback_model_id'] != candidates[0]:
+        candidates.append(profile['fallback_model_id'])
+    
+    for attempt, candidate in enumerate(candidates):
+        is_fallback = attempt > 0
+        start = time.perf_counter()
+        try:
+            print(f"Route '{task}' generating with model: {candidate}")
+            response_body = _invoke_model(prompt, candidate, temperature, top_p, max_tokens, stop_sequences, prefill)
+        except ClientError as e:
+            latency_ms = (time.perf_counter() - start) * 1000
+            route_stats.record(task, candidate, latency_ms, error=True, fallback=is_fallback)
+            error_code = e.response['Error']['Code']
+            if error_code in FALLBACK_ERROR_CODES and attempt + 1 < len(candidates):
+                print(f"Route '{task}': {candidate} returned {error_code}, falling back to {candidates[attempt + 1]}")
+                continue
+            return _client_error_message(e, candidate)
+        except AdmissionRejected:
+            # Local quota full: the fallback model has its own quota
+            if attempt + 1 < len(candidates):
+                print(f"Route '{task}': {candidate} quota full, falling back to {candidates[attempt + 1]}")
+                continue
+            raise
+        except Exception as e:
+            latency_ms = (time.perf_counter() - start) * 1000
+            route_stats.record(task, candidate, latency_ms, error=True, fallback=is_fallback)
+            print(f"Unexpected error: {type(e).__name__} - {str(e)}")
+            return f"Error: {str(e)}"
+        
+        latency_ms = (time.perf_counter() - start) * 1000
+        usage = response_body.get('usage', {})
+        route_stats.record(
+            task, candidate, latency_ms,
+            input_tokens=usage.get('input_tokens', 0),
+            output_tokens=usage.get('output_tokens', 0),
+            fallback=is_fallback
+        )
+        _record_budget(task, decision, response_body)
+        return _response_text(response_body, prefill)
+
+def _category_letter(classification):
+    """
+    Category letter from a classifier answer, or None
+
+    Only the letter right after "Category" counts, with or without a space
+    ("Category E", "CategoryE" when the prefill is glued to the model's
+    token) or on its own ("E").
+    """
+    text = classification.strip().upper()
+    if text.startswith("CATEGORY"):
+        text = text[len("CATEGORY"):].lstrip(" :")
+    if text[:1] in ("A", "B", "C", "D", "E") and not text[1:2].isalpha():
+        return text[0]
+    return None
+
+def valid_prompt(prompt, model_id=None):
     """
     Validate user prompt with AI classification and enhanced error handling
     
@@ -165,10 +454,14 @@ def valid_prompt(prompt, model_id):
     
     Args:
         prompt (str): User input
-        model_id (str): Model for classification
+        model_id (str): Model for classification (defaults to the
+                        'classify' route profile)
     
     Returns:
         bool: True if valid (Category E), False otherwise
+    
+    Raises:
+        admission.AdmissionRejected: When the classifier quota has no room in time
     """
     # Input validation
     if not prompt or not prompt.strip():
@@ -183,10 +476,6 @@ def valid_prompt(prompt, model_id):
         print("Error: Prompt too long (max 1000 chars)")
         return False
     
-    if not model_id:
-        print("Error: Model ID required")
-        return False
-    
     try:
         classification_prompt = f"""Human: Classify the provided user request into one of the following categories:
 
@@ -204,15 +493,11 @@ Answer ONLY with the category letter (e.g., "Category E"):
 
 Assistant:"""
         
-        print(f"Classifying prompt with model: {model_id}")
-        
-        # Get classification from model
-        classification = generate_response(
-            classification_prompt, 
-            model_id, 
-            temperature=0.1, 
-            top_p=0.9, 
-            max_tokens=50
+        # Get classification from the classify route (fast, cheap model)
+        classification = generate_for_task(
+            'classify',
+            classification_prompt,
+            model_id=model_id
         )
         
         if classification.startswith("Error:"):
@@ -220,52 +505,254 @@ Assistant:"""
             return False
         
         # Extract category letter
-        classification_clean = classification.strip().upper()
-        print(f"Classification result: {classification_clean}")
+        category = _category_letter(classification)
+        print(f"Classification result: {classification.strip()!r} -> {category}")
         
         # Check if Category E (allowed)
-        if "CATEGORY E" in classification_clean or "E" == classification_clean:
+        if category == "E":
             print("✓ Prompt approved (Category E - Heavy machinery)")
             return True
         else:
             print(f"✗ Prompt blocked (Not Category E)")
             return False
             
+    except AdmissionRejected:
+        # Overload is not a verdict on the prompt; let the caller report it
+        raise
     except Exception as e:
         print(f"Classification error: {type(e).__name__} - {str(e)}")
         return False
 
-def query_with_sources(query, knowledge_base_id, model_arn):
+def _rag_request(query, knowledge_base_id, model_arn, metadata_filter=None):
+    """retrieve_and_generate request, narrowed to a facet filter when one is given"""
+    kb_config = {
+        'knowledgeBaseId': knowledge_base_id,
+        'modelArn': model_arn
+    }
+    if metadata_filter:
+        kb_config['retrievalConfiguration'] = {
+            'vectorSearchConfiguration': {'filter': metadata_filter}
+        }
+    return {
+        'input': {'text': query},
+        'retrieveAndGenerateConfiguration': {
+            'type': 'KNOWLEDGE_BASE',
+            'knowledgeBaseConfiguration': kb_config
+        }
+    }
+
+def _retrieve_and_generate(request, session_id):
+    """One retrieve_and_generate call, starting a new session if session_id is rejected"""
+    if session_id:
+        try:
+            with stage('retrieve_and_generate'):
+                return bedrock_kb.retrieve_and_generate(sessionId=session_id, **request)
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code not in ('ValidationException', 'ResourceNotFoundException'):
+                raise
+            # Expired or unknown session: start a new conversation
+            print(f"Session {session_id} rejected ({error_code}), starting a new session")
+    
+    with stage('retrieve_and_generate'):
+        return bedrock_kb.retrieve_and_generate(**request)
+
+def answer_with_citations(query, knowledge_base_id, model_arn, session_id=None, metadata_filter=None,
+                          auto_filter=True):
     """
-    Query knowledge base and return answer with source citations.
+    Query knowledge base and return a typed answer with ordered citations
+    
+    Args:
+        query (str): The user's question
+        knowledge_base_id (str): Knowledge Base ID
+        model_arn (str): ARN of the generation model
+        session_id (str): Bedrock sessionId from a previous turn, so
+                          follow-up questions reuse the server-side context
+        metadata_filter (dict): Bedrock retrieval filter on document facets
+        auto_filter (bool): When no filter is given, narrow retrieval to
+                            facets detected in the query; asks again
+                            unfiltered if the answer cites nothing
+    
+    Returns:
+        results.Answer: Answer text, citations with span offsets and chunks,
+                        and the sessionId to pass on the next turn
     """
-    bedrock_agent_runtime = boto3.client(
-        'bedrock-agent-runtime',
-        region_name='us-east-1'
-    )
+    metadata_filter, detected = _auto_filter(query, metadata_filter, auto_filter)
+    request = _rag_request(query, knowledge_base_id, model_arn, metadata_filter)
     
-    response = bedrock_agent_runtime.retrieve_and_generate(
-        input={'text': query},
-        retrieveAndGenerateConfiguration={
-            'type': 'KNOWLEDGE_BASE',
-            'knowledgeBaseConfiguration': {
-                'knowledgeBaseId': knowledge_base_id,
-                'modelArn': model_arn
-            }
+    decision = _with_rag_budget(request, query)
+    get_admission_controller().acquire(model_id_from_arn(model_arn), estimate_tokens(query) + RAG_TOKEN_ESTIMATE)
+    answer = Answer.from_retrieve_and_generate(_retrieve_and_generate(request, session_id))
+    
+    if detected and not any(citation.chunks for citation in answer.citations):
+        print("No sources with detected facet filter, retrying unfiltered")
+        del request['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration']['retrievalConfiguration']
+        get_admission_controller().acquire(model_id_from_arn(model_arn), estimate_tokens(query) + RAG_TOKEN_ESTIMATE)
+        answer = Answer.from_retrieve_and_generate(_retrieve_and_generate(request, session_id))
+    
+    return _record_rag_answer(decision, answer)
+
+def _with_rag_budget(request, query):
+    """Add the token policy's inference settings to a retrieve_and_generate request"""
+    decision = _choose_budget('rag', query)
+    if decision is not None:
+        # No learned budget: leave maxTokens to the service default
+        text_config = {'maxTokens': decision['max_tokens']} if decision['max_tokens'] else {}
+        if decision['stop_sequences']:
+            text_config['stopSequences'] = decision['stop_sequences']
+        request['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration']['generationConfiguration'] = {
+            'inferenceConfig': {'textInferenceConfig': text_config}
         }
+    return decision
+
+def _record_rag_answer(decision, answer):
+    """Count a retrieve_and_generate answer (no usage is reported, so output tokens are estimated)"""
+    policy = get_token_policy()
+    if policy is not None and decision is not None:
+        policy.record('rag', decision['query_class'], decision['max_tokens'], estimate_tokens(answer.text))
+    return answer
+
+def query_with_sources(query, knowledge_base_id, model_arn, session_id=None):
+    """
+    Query knowledge base and return answer with source citations.
+    
+    Returns:
+        dict: answer, sources (deduplicated in citation order),
+              citations (answer span plus supporting chunk URIs and scores)
+              and sessionId for follow-up questions
+    """
+    return answer_with_citations(query, knowledge_base_id, model_arn, session_id).to_dict()
+
+def stream_answer(query, knowledge_base_id, model_arn, session_id=None, metadata_filter=None, auto_filter=True):
+    """
+    Stream an answer with retrieve_and_generate_stream
+    
+    Retrieval is narrowed to facets detected in the query as in
+    answer_with_citations, but without the unfiltered retry: the text has
+    already been streamed by the time citations show nothing was found.
+    
+    Yields:
+        dict: {'type': 'text', 'text': delta} as the answer is generated,
+              {'type': 'citation', 'citation': {span, sources, chunks}} as
+              citations arrive,
+              then {'type': 'done', 'answer': results.Answer}
+    
+    Raises:
+        admission.AdmissionRejected: When the model's quota has no room in time
+    """
+    metadata_filter, _ = _auto_filter(query, metadata_filter, auto_filter)
+    request = _rag_request(query, knowledge_base_id, model_arn, metadata_filter)
+    if session_id:
+        request['sessionId'] = session_id
+    
+    decision = _with_rag_budget(request, query)
+    get_admission_controller().acquire(model_id_from_arn(model_arn), estimate_tokens(query) + RAG_TOKEN_ESTIMATE)
+    
+    with stage('retrieve_and_generate_stream'):
+        response = bedrock_kb.retrieve_and_generate_stream(**request)
+        parts = []
+        citations = []
+        for event in response['stream']:
+            if 'output' in event:
+                text = event['output'].get('text', '')
+                parts.append(text)
+                yield {'type': 'text', 'text': text}
+            elif 'citation' in event:
+                citation = event['citation'].get('citation', event['citation'])
+                citations.append(citation)
+                partial = Answer.from_retrieve_and_generate({'output': {'text': ''.join(parts)}, 'citations': [citation]})
+                yield {'type': 'citation', 'citation': partial.citations[0].to_dict()}
+    
+    answer = Answer.from_retrieve_and_generate({
+        'output': {'text': ''.join(parts)},
+        'citations': citations,
+        'sessionId': response.get('sessionId'),
+    })
+    yield {'type': 'done', 'answer': _record_rag_answer(decision, answer)}
+
+def retrieve_chunks(query, kb_id, number_of_results=3, search_type='HYBRID', use_cache=True,
+                    metadata_filter=None, auto_filter=True):
+    """
+    query_knowledge_base returning results.Chunk objects instead of raw dicts
+    """
+    return chunks_from_results(
+        query_knowledge_base(query, kb_id, number_of_results, search_type, use_cache,
+                             metadata_filter, auto_filter)
     )
+
+def shared_valid_prompt(prompt, model_id=None):
+    """
+    valid_prompt with single-flight coalescing
     
-    # Extract answer and sources
-    answer = response['output']['text']
-    citations = response.get('citations', [])
+    Concurrent calls with the same normalized prompt and model share one
+    classification request. See single_flight.SingleFlight.
+    """
+    key = make_key('valid_prompt', prompt, model_id or '')
+    return inflight.do(key, valid_prompt, prompt, model_id)
+
+def shared_query_with_sources(query, knowledge_base_id, model_arn, session_id=None, session_key=None):
+    """
+    query_with_sources with single-flight coalescing
     
-    sources = []
-    for citation in citations:
-        for reference in citation.get('retrievedReferences', []):
-            source_location = reference['location']['s3Location']['uri']
-            sources.append(source_location)
+    Concurrent sessionless calls with the same normalized query, KB and
+    model share one retrieve_and_generate request. The returned dict is
+    shared between callers and must not be mutated.
     
-    return {
-        'answer': answer,
-        'sources': list(set(sources))  # Remove duplicates
-    }
\ No newline at end of file
+    Conversation turns (a session_key or session_id) are never coalesced:
+    the response carries a Bedrock sessionId, and sharing it would join two
+    users' conversations. A first turn has no session_id yet, so the
+    session_key is what marks it as a conversation.
+    """
+    if session_key or session_id:
+        return query_with_sources(query, knowledge_base_id, model_arn, session_id)
+    key = make_key('query_with_sources', query, knowledge_base_id, model_arn)
+    return inflight.do(key, query_with_sources, query, knowledge_base_id, model_arn)
+
+def _ensure_answer_snapshot(kb_id):
+    """
+    Load the warmed answer snapshot once per KB version
+    
+    A warm container reloads the snapshot after a KB sync, picking up the
+    re-warmed answers instead of waiting to be recycled. Until warm_cache
+    has re-warmed, the snapshot still holds the previous version's answers;
+    the version only counts as loaded once the snapshot has entries for it,
+    and until then the load is retried with a growing backoff.
+    """
+    global _answer_snapshot_version, _answer_snapshot_retry_at, _answer_snapshot_backoff
+    location = os.environ.get('ANSWER_CACHE_LOCATION')
+    if not location:
+        return
+    version = retrieval_cache.kb_version(kb_id)
+    if version == _answer_snapshot_version:
+        return
+    if _answer_snapshot_retry_at.get(version, 0.0) > time.monotonic():
+        return
+    with _answer_snapshot_lock:
+        if version == _answer_snapshot_version or _answer_snapshot_retry_at.get(version, 0.0) > time.monotonic():
+            return
+        loaded = answer_cache.load(location)
+        if version is None or version in answer_cache.versions(kb_id):
+            print(f"✓ Loaded {loaded} precomputed answers from {location}")
+            _answer_snapshot_version = version
+            _answer_snapshot_retry_at.clear()
+            _answer_snapshot_backoff = ANSWER_SNAPSHOT_RETRY_SECONDS
+            return
+        print(f"Answer snapshot at {location} is not built from KB version {version} yet, "
+              f"retrying in {_answer_snapshot_backoff:.0f}s")
+        # Only the current version's retry time matters
+        _answer_snapshot_retry_at.clear()
+        _answer_snapshot_retry_at[version] = time.monotonic() + _answer_snapshot_backoff
+        _answer_snapshot_backoff = min(_answer_snapshot_backoff * 2, ANSWER_SNAPSHOT_MAX_RETRY_SECONDS)
+
+def get_cached_answer(query, knowledge_base_id, model_arn):
+    """
+    Return a precomputed answer for a query, or None
+    
+    Answers are produced by warm_cache.py for the most frequent queries and
+    only returned while the KB is still at the version they were built from.
+    
+    Returns:
+        dict: Same shape as query_with_sources, or None on a miss
+    """
+    _ensure_answer_snapshot(knowledge_base_id)
+    return answer_cache.get(query, knowledge_base_id, model_arn)
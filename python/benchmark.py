@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark and load-test harness
+
+Drives bedrock_utils / lambda_function against the local Bedrock stand-in
+(fake_bedrock) at a fixed concurrency (closed loop) or a fixed request rate
+(open loop), and reports throughput and latency percentiles. Results can be
+saved as a JSON baseline and compared against on later runs.
+
+Usage:
+    python benchmark.py --target query_with_sources --concurrency 16 --requests 500
+    python benchmark.py --target lambda_handler --rate 50 --duration 20 --output baseline.json
+    python benchmark.py --target valid_prompt --compare baseline.json
+    python benchmark.py --target lambda_handler --replay /tmp/query-log/queries*.jsonl.gz --speed 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_bedrock
+from latency_stats import summarize_latencies
+
+BENCH_QUERIES = [
+    "What is the bucket capacity of an excavator?",
+    "What is the maximum digging depth of excavators?",
+    "How much engine power does a bulldozer have?",
+    "What is the ground pressure of a bulldozer?",
+    "What blade width do bulldozers use?",
+    "What safety requirements apply to heavy machinery operators?",
+    "What PPE is required on site?",
+    "What is the operating weight of an excavator?",
+    "Tell me about machine learning",
+    "How do cranes communicate with ground personnel?",
+]
+
+FAKE_KB_ID = 'FAKEKB0001'
+FAKE_MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
+
+TARGETS = ('valid_prompt', 'query_knowledge_base', 'generate_response',
+           'query_with_sources', 'lambda_handler', 'asgi', 'asgi_stream')
+
+# Metrics compared against a baseline, and whether higher is better
+COMPARED_METRICS = {
+    'throughput_rps': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+}
+
+
+def build_operation(target, use_cache=False):
+    """
+    Return a callable(query) -> bool (True on success) for a benchmark target
+    """
+    import bedrock_utils
+
+    if target == 'valid_prompt':
+        return lambda q: bedrock_utils.valid_prompt(q, FAKE_MODEL_ID) in (True, False)
+
+    if target == 'query_knowledge_base':
+        return lambda q: bool(bedrock_utils.query_knowledge_base(q, FAKE_KB_ID, use_cache=use_cache))
+
+    if target == 'generate_response':
+        return lambda q: not bedrock_utils.generate_response(q, FAKE_MODEL_ID).startswith('Error:')
+
+    if target == 'query_with_sources':
+        model_arn = f"arn:aws:bedrock:us-east-1::foundation-model/{FAKE_MODEL_ID}"
+        return lambda q: 'answer' in bedrock_utils.query_with_sources(q, FAKE_KB_ID, model_arn)
+
+    if target == 'lambda_handler':
+        os.environ.setdefault('KNOWLEDGE_BASE_ID', FAKE_KB_ID)
+        import lambda_function
+
+        def call(q):
+            response = lambda_function.lambda_handler({'body': json.dumps({'query': q})}, None)
+            return response['statusCode'] in (200, 400)
+        return call
+
+    if target in ('asgi', 'asgi_stream'):
+        # The ASGI app in-process on its own event loop thread (server.py);
+        # no HTTP server needed
+        os.environ.setdefault('KNOWLEDGE_BASE_ID', FAKE_KB_ID)
+        import server
+
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name='asgi-loop', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(server.app.startup(), loop).result()
+        path = '/query' if target == 'asgi' else '/query/stream'
+
+        def call(q):
+            request = server.call_asgi(server.app, 'POST', path, json.dumps({'query': q}))
+            status, _, body = asyncio.run_coroutine_threadsafe(request, loop).result()
+            if target == 'asgi':
+                return status in (200, 400)
+            return status == 200 and (b'event: done' in body or b'"status": 400' in body)
+        return call
+
+    raise ValueError(f"Unknown target: {target}")
+
+
+class _Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies_ms = []
+        self.errors = 0
+
+    def record(self, latency_ms, ok):
+        with self.lock:
+            self.latencies_ms.append(latency_ms)
+            if not ok:
+                self.errors += 1
+
+
+def _timed(operation, query, recorder, scheduled_at=None):
+    # Open-loop latency is measured from the scheduled send time so queueing
+    # delay in the client is not hidden (coordinated omission)
+    start = scheduled_at if scheduled_at is not None else time.perf_counter()
+    try:
+        ok = operation(query)
+    except Exception:
+        ok = False
+    recorder.record((time.perf_counter() - start) * 1000, ok)
+
+
+def run_closed_loop(operation, queries, concurrency, total_requests):
+    """Run total_requests calls with exactly `concurrency` callers in flight"""
+    recorder = _Recorder()
+    counter = iter(range(total_requests))
+    counter_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with counter_lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            _timed(operation, queries[index % len(queries)], recorder)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - started
+
+
+def run_open_loop(operation, queries, rate, duration, max_workers=256):
+    """Issue calls at a fixed rate (requests/s) for `duration` seconds"""
+    recorder = _Recorder()
+    interval = 1.0 / rate
+    total = int(rate * duration)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index in range(total):
+            scheduled_at = started + index * interval
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(_timed, operation, queries[index % len(queries)], recorder, scheduled_at)
+    return recorder, time.perf_counter() - started
+
+
+def load_replay(log_paths):
+    """
+    Query schedule from query logs (query_log.py output)
+
+    Returns:
+        list: (offset_s, query) pairs in send order, offsets relative to the
+              first logged request; batch requests contribute all of their
+              queries at the batch's offset
+    """
+    from query_log import read_log
+
+    entries = []
+    for record in read_log(log_paths):
+        ts = record.get('ts')
+        if not isinstance(ts, (int, float)):
+            continue
+        if isinstance(record.get('query'), str) and record['query']:
+            entries.append((ts, record['query']))
+        for item in record.get('queries') or []:
+            if isinstance(item, dict) and item.get('query'):
+                entries.append((ts, item['query']))
+    entries.sort(key=lambda entry: entry[0])
+    if not entries:
+        return []
+    first = entries[0][0]
+    return [(ts - first, query) for ts, query in entries]
+
+
+def run_replay(operation, schedule, speed=1.0, max_workers=256):
+    """Send logged queries at their recorded times, compressed by `speed` (2.0 = twice as fast)"""
+    recorder = _Recorder()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for offset, query in schedule:
+            scheduled_at = started + offset / speed
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(_timed, operation, query, recorder, scheduled_at)
+    return recorder, time.perf_counter() - started
+
+
+def run_benchmark(args):
+    """Run one benchmark configuration and return the result dict"""
+    latency = fake_bedrock.LatencyModel(args.latency_dist, args.latency_ms, args.latency_spread)
+    fault_args = {
+        'latency': latency,
+        'throttle_rate': args.throttle_rate,
+        'error_rate': args.error_rate,
+        'max_concurrency': args.service_concurrency,
+        'seed': args.seed,
+    }
+    runtime, agent_runtime = fake_bedrock.install(
+        fake_bedrock.FakeBedrockRuntime(**fault_args),
+        fake_bedrock.FakeAgentRuntime(**fault_args),
+    )
+    operation = build_operation(args.target, use_cache=args.cache)
+
+    queries = BENCH_QUERIES
+    schedule = load_replay(args.replay) if args.replay else None
+    if schedule:
+        queries = [query for _, query in schedule]
+    elif args.replay:
+        raise ValueError(f"No replayable records in {', '.join(args.replay)}")
+
+    if schedule and args.speed > 0 and not args.rate:
+        mode = {'mode': 'replay', 'records': len(schedule), 'speed': args.speed}
+        recorder, elapsed = run_replay(operation, schedule, args.speed)
+    elif args.rate:
+        mode = {'mode': 'open', 'rate': args.rate, 'duration': args.duration}
+        recorder, elapsed = run_open_loop(operation, queries, args.rate, args.duration)
+    else:
+        mode = {'mode': 'closed', 'concurrency': args.concurrency, 'requests': args.requests}
+        recorder, elapsed = run_closed_loop(operation, queries, args.concurrency, args.requests)
+
+    completed = len(recorder.latencies_ms)
+    result = {
+        'target': args.target,
+        'load': mode,
+        'fake': {
+            'latency_dist': args.latency_dist,
+            'latency_ms': args.latency_ms,
+            'latency_spread': args.latency_spread,
+            'throttle_rate': args.throttle_rate,
+            'error_rate': args.error_rate,
+            'service_concurrency': args.service_concurrency,
+        },
+        'requests': completed,
+        'errors': recorder.errors,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(completed / elapsed, 2) if elapsed else 0.0,
+        'service_calls': {
+            'bedrock-runtime': runtime.stats(),
+            'bedrock-agent-runtime': agent_runtime.stats(),
+        },
+    }
+    result.update(summarize_latencies(recorder.latencies_ms))
+    return result
+
+
+def compare_to_baseline(result, baseline, tolerance):
+    """
+    Compare a result against a baseline
+
+    Returns:
+        list: Human-readable regression messages (empty when within tolerance)
+    """
+    regressions = []
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        old, new = baseline.get(metric), result.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f"{metric}: {old} -> {new} ({change:+.1%})")
+    return regressions
+
+
+def print_result(result):
+    print(f"\nTarget: {result['target']}  load: {result['load']}")
+    print(f"Requests: {result['requests']}  errors: {result['errors']}  elapsed: {result['elapsed_s']}s")
+    print(f"Throughput: {result['throughput_rps']} req/s")
+    print(f"Latency ms - mean: {result['mean_ms']}  p50: {result['p50_ms']}  "
+          f"p95: {result['p95_ms']}  p99: {result['p99_ms']}  max: {result['max_ms']}")
+    for service, stats in result['service_calls'].items():
+        print(f"  {service}: {stats}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark against a local Bedrock stand-in")
+    parser.add_argument('--target', choices=TARGETS, default='query_with_sources')
+    parser.add_argument('--concurrency', type=int, default=8, help="Closed-loop callers in flight")
+    parser.add_argument('--requests', type=int, default=200, help="Closed-loop total requests")
+    parser.add_argument('--rate', type=float, default=0.0, help="Open-loop requests/s (overrides --concurrency)")
+    parser.add_argument('--duration', type=float, default=10.0, help="Open-loop duration in seconds")
+    parser.add_argument('--latency-dist', choices=fake_bedrock.LatencyModel.KINDS, default='lognormal')
+    parser.add_argument('--latency-ms', type=float, default=200.0, help="Mean/median service latency")
+    parser.add_argument('--latency-spread', type=float, default=0.5,
+                        help="Spread (ms for uniform/normal, sigma for lognormal)")
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--service-concurrency', type=int, default=None,
+                        help="Throttle when more calls than this are in flight")
+    parser.add_argument('--replay', nargs='+', help="Query logs (query_log.py) to replay instead of the built-in queries")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay speed vs the recorded timing (2 = twice as fast; 0 = use --concurrency or --rate)")
+    parser.add_argument('--cache', action='store_true', help="Enable the retrieval cache")
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help="Write the result as a JSON baseline file")
+    parser.add_argument('--compare', help="Baseline JSON file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="Allowed relative regression")
+    parser.add_argument('--verbose', action='store_true', help="Keep per-call log output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # bedrock_utils logs every call with print(); silence it unless asked
+    real_stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        result = run_benchmark(args)
+    finally:
+        if sys.stdout is not real_stdout:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+
+    print_result(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"\n✓ Baseline written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        if regressions:
+            print(f"\n✗ Regressions vs {args.compare} (tolerance {args.tolerance:.0%}):")
+            for line in regressions:
+                print(f"  - {line}")
+            return 1
+        print(f"\n✓ Within {args.tolerance:.0%} of {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
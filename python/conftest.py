@@ -0,0 +1,22 @@
+"""
+pytest setup: every test runs offline against the local Bedrock stand-in
+
+    cd python && python -m pytest -q
+"""
+
+import pytest
+
+# Script that prints verdicts against real Bedrock (python test_valid_prompt.py [--offline])
+collect_ignore = ['test_valid_prompt.py']
+
+
+@pytest.fixture
+def fake_services():
+    """Fast, deterministic fake clients installed into bedrock_utils"""
+    import fake_bedrock
+
+    latency = fake_bedrock.LatencyModel('fixed', 1.0)
+    return fake_bedrock.install(
+        fake_bedrock.FakeBedrockRuntime(latency=latency, seed=1),
+        fake_bedrock.FakeAgentRuntime(latency=latency, seed=1),
+    )
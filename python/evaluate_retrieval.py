@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Retrieval quality and latency evaluation
+
+Runs a golden set of questions with known source documents through
+query_knowledge_base for each retrieval configuration (numberOfResults x
+search type) and reports recall@k, MRR and nDCG@k next to latency
+percentiles, so recall/latency tradeoffs can be compared before changing
+production settings or the index parameters in scripts/aurora_sql.sql.
+
+Relevance is judged per source document: a result counts as relevant when
+its S3 URI ends with one of the query's expected_sources file names.
+
+Usage:
+    python evaluate_retrieval.py --kb-id ABCDEFGHIJ --k 3,5,10 --search-types HYBRID,SEMANTIC
+    python evaluate_retrieval.py --offline --output eval_hnsw_m16.json --label hnsw-m16
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from latency_stats import summarize_latencies
+
+DEFAULT_GOLDEN_SET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden_queries.json')
+
+
+def load_golden_set(path=DEFAULT_GOLDEN_SET):
+    """Load golden queries: a JSON list of {id, query, expected_sources}"""
+    with open(path) as f:
+        return json.load(f)
+
+
+def result_uri(result):
+    """S3 URI of a retrieval result, or '' when missing"""
+    return result.get('location', {}).get('s3Location', {}).get('uri', '')
+
+
+def ranked_documents(results):
+    """Source URIs in rank order, keeping only the first hit per document"""
+    seen = set()
+    ranked = []
+    for result in results:
+        uri = result_uri(result)
+        if uri and uri not in seen:
+            seen.add(uri)
+            ranked.append(uri)
+    return ranked
+
+
+def _is_relevant(uri, expected_sources):
+    return any(uri.endswith('/' + name) or uri == name for name in expected_sources)
+
+
+def score_query(ranked_uris, expected_sources, k):
+    """
+    Compute retrieval metrics for one query
+
+    Returns:
+        dict: recall (fraction of expected documents in the top k),
+              mrr (1 / rank of the first relevant document) and
+              ndcg (binary-relevance nDCG@k)
+    """
+    top = ranked_uris[:k]
+    relevance = [1 if _is_relevant(uri, expected_sources) else 0 for uri in top]
+
+    found = {name for name in expected_sources if any(_is_relevant(uri, [name]) for uri in top)}
+    recall = len(found) / len(expected_sources) if expected_sources else 0.0
+
+    mrr = 0.0
+    for rank, relevant in enumerate(relevance, start=1):
+        if relevant:
+            mrr = 1.0 / rank
+            break
+
+    dcg = sum(rel / math.log2(rank + 1) for rank, rel in enumerate(relevance, start=1))
+    ideal_hits = min(len(expected_sources), k)
+    idcg = sum(1.0 / math.log2(rank + 1) for rank in range(1, ideal_hits + 1))
+    ndcg = dcg / idcg if idcg else 0.0
+
+    return {'recall': recall, 'mrr': mrr, 'ndcg': ndcg}
+
+
+def evaluate_config(golden_set, kb_id, k, search_type, repeats=1):
+    """
+    Evaluate one retrieval configuration over the golden set
+
+    Returns:
+        dict: Mean metrics, latency percentiles and per-query detail
+    """
+    import bedrock_utils
+
+    latencies_ms = []
+    per_query = []
+    for item in golden_set:
+        results = []
+        for _ in range(max(1, repeats)):
+            start = time.perf_counter()
+            results = bedrock_utils.query_knowledge_base(
+                item['query'], kb_id,
+                number_of_results=k,
+                search_type=search_type,
+                use_cache=False
+            )
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+        ranked = ranked_documents(results)
+        scores = score_query(ranked, item['expected_sources'], k)
+        per_query.append({'id': item['id'], 'ranked_sources': ranked, **scores})
+
+    count = len(per_query) or 1
+    summary = {
+        'k': k,
+        'search_type': search_type,
+        'queries': len(per_query),
+        'recall_at_k': round(sum(q['recall'] for q in per_query) / count, 4),
+        'mrr': round(sum(q['mrr'] for q in per_query) / count, 4),
+        'ndcg_at_k': round(sum(q['ndcg'] for q in per_query) / count, 4),
+        'per_query': per_query,
+    }
+    summary.update(summarize_latencies(latencies_ms))
+    return summary
+
+
+def format_table(rows, baseline_rows=None):
+    """Render config results as an aligned text table"""
+    baseline = {(r['k'], r['search_type']): r for r in (baseline_rows or [])}
+    headers = ['k', 'search_type', 'recall@k', 'MRR', 'nDCG@k', 'p50_ms', 'p95_ms', 'p99_ms']
+    if baseline:
+        headers += ['Δrecall', 'Δp95_ms']
+
+    table = []
+    for row in rows:
+        line = [row['k'], row['search_type'], row['recall_at_k'], row['mrr'], row['ndcg_at_k'],
+                row['p50_ms'], row['p95_ms'], row['p99_ms']]
+        if baseline:
+            old = baseline.get((row['k'], row['search_type']))
+            if old:
+                line += [f"{row['recall_at_k'] - old['recall_at_k']:+.4f}",
+                         f"{row['p95_ms'] - old['p95_ms']:+.2f}"]
+            else:
+                line += ['-', '-']
+        table.append([str(v) for v in line])
+
+    widths = [max(len(h), *(len(r[i]) for r in table)) if table else len(h) for i, h in enumerate(headers)]
+    lines = ['  '.join(h.ljust(w) for h, w in zip(headers, widths))]
+    lines.append('  '.join('-' * w for w in widths))
+    for r in table:
+        lines.append('  '.join(v.ljust(w) for v, w in zip(r, widths)))
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate retrieval quality and latency per configuration")
+    parser.add_argument('--kb-id', default=os.environ.get('KNOWLEDGE_BASE_ID'))
+    parser.add_argument('--golden', default=DEFAULT_GOLDEN_SET, help="Golden query set (JSON)")
+    parser.add_argument('--k', default='3,5,10', help="Comma-separated numberOfResults values")
+    parser.add_argument('--search-types', default='HYBRID,SEMANTIC')
+    parser.add_argument('--repeats', type=int, default=1, help="Calls per query (for latency stability)")
+    parser.add_argument('--parallel', type=int, default=4, help="Configurations evaluated at once")
+    parser.add_argument('--offline', action='store_true', help="Use the local Bedrock stand-in")
+    parser.add_argument('--label', default='', help="Free-form label, e.g. the index settings under test")
+    parser.add_argument('--output', help="Write results as JSON")
+    parser.add_argument('--compare', help="Previous results JSON to diff against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.offline:
+        import fake_bedrock
+        fake_bedrock.install()
+        args.kb_id = args.kb_id or 'FAKEKB0001'
+
+    if not args.kb_id:
+        print("Error: --kb-id or KNOWLEDGE_BASE_ID is required")
+        return 1
+
+    golden_set = load_golden_set(args.golden)
+    configs = [(int(k), search_type.strip().upper())
+               for k in args.k.split(',')
+               for search_type in args.search_types.split(',')]
+
+    print(f"Evaluating {len(configs)} configurations over {len(golden_set)} golden queries...")
+
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.parallel)) as executor:
+            futures = [executor.submit(evaluate_config, golden_set, args.kb_id, k, search_type, args.repeats)
+                       for k, search_type in configs]
+            rows = [future.result() for future in futures]
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+    baseline_rows = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline_rows = json.load(f).get('results', [])
+
+    print()
+    if args.label:
+        print(f"Label: {args.label}")
+    print(format_table(rows, baseline_rows))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'label': args.label, 'kb_id': args.kb_id, 'results': rows}, f, indent=2)
+        print(f"\n✓ Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
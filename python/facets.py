@@ -0,0 +1,185 @@
+"""
+Document facet extraction and query-time facet detection
+
+Facets (equipment type, manufacturer, model, document date) are extracted
+from each document at upload time and written as Bedrock KB metadata
+sidecars (`<file>.metadata.json`). Bedrock stores them in the `metadata`
+jsonb column of bedrock_integration.bedrock_knowledge_base, where retrieval
+filters are evaluated. At query time the same vocabulary is used to detect
+facets in the question and narrow the search.
+"""
+
+import datetime
+import os
+import re
+
+# Canonical equipment type -> phrases that refer to it
+EQUIPMENT_TYPES = {
+    'excavator': ('excavator', 'excavators', 'digger', 'diggers'),
+    'bulldozer': ('bulldozer', 'bulldozers', 'dozer', 'dozers'),
+    'crane': ('crane', 'cranes'),
+    'loader': ('loader', 'loaders', 'wheel loader', 'wheel loaders'),
+    'backhoe': ('backhoe', 'backhoes', 'backhoe loader'),
+    'dump_truck': ('dump truck', 'dump trucks', 'haul truck', 'haul trucks'),
+    'grader': ('grader', 'graders', 'motor grader'),
+    'compactor': ('compactor', 'compactors', 'roller', 'rollers'),
+}
+
+# Canonical manufacturer -> case-insensitive patterns
+MANUFACTURERS = {
+    'caterpillar': (r'\bcaterpillar\b',),
+    'komatsu': (r'\bkomatsu\b',),
+    'john_deere': (r'\bjohn\s+deere\b', r'\bdeere\b'),
+    'volvo': (r'\bvolvo\b',),
+    'hitachi': (r'\bhitachi\b',),
+    'liebherr': (r'\bliebherr\b',),
+    'jcb': (r'\bjcb\b',),
+    'doosan': (r'\bdoosan\b', r'\bdevelon\b'),
+    'hyundai': (r'\bhyundai\b',),
+    'kobelco': (r'\bkobelco\b',),
+    'bobcat': (r'\bbobcat\b',),
+}
+
+# Upper-case brand abbreviations are only matched case-sensitively
+_MANUFACTURER_ABBREVIATIONS = {
+    'caterpillar': r'\bCAT\b',
+    'case': r'\bCASE\b',
+}
+
+# Model designations such as "CAT 320", "PC200-8", "D6T", "EC220E"
+_MODEL_RE = re.compile(r'\b([A-Z]{1,4}[- ]?\d{2,4}[A-Z]{0,3}(?:-\d{1,2})?)\b')
+_NOT_MODELS = {'ISO', 'PSI', 'HP', 'KW', 'SAE', 'ANSI', 'OSHA', 'EN', 'TIER'}
+
+_DATE_RE = re.compile(r'\b(\d{4})-(\d{2})-(\d{2})\b')
+_MONTH_YEAR_RE = re.compile(
+    r'\b(January|February|March|April|May|June|July|August|September|October|November|December)\s+(\d{4})\b'
+)
+
+_EQUIPMENT_PATTERNS = {
+    canonical: re.compile(r'\b(?:' + '|'.join(re.escape(p) for p in phrases) + r')\b', re.IGNORECASE)
+    for canonical, phrases in EQUIPMENT_TYPES.items()
+}
+_MANUFACTURER_PATTERNS = {
+    canonical: re.compile('|'.join(patterns), re.IGNORECASE)
+    for canonical, patterns in MANUFACTURERS.items()
+}
+_ABBREVIATION_PATTERNS = {canonical: re.compile(p) for canonical, p in _MANUFACTURER_ABBREVIATIONS.items()}
+
+
+def _equipment_types(text):
+    return [canonical for canonical, pattern in _EQUIPMENT_PATTERNS.items() if pattern.search(text)]
+
+
+def _manufacturers(text):
+    found = [canonical for canonical, pattern in _MANUFACTURER_PATTERNS.items() if pattern.search(text)]
+    for canonical, pattern in _ABBREVIATION_PATTERNS.items():
+        if canonical not in found and pattern.search(text):
+            found.append(canonical)
+    return found
+
+
+def _models(text):
+    models = []
+    for match in _MODEL_RE.finditer(text):
+        model = match.group(1).replace(' ', '').upper()
+        prefix = re.match(r'[A-Z]+', model).group(0)
+        if prefix in _NOT_MODELS or model in models:
+            continue
+        models.append(model)
+    return models
+
+
+def _doc_date(text, path=None):
+    match = _DATE_RE.search(text)
+    if match:
+        return match.group(0)
+    match = _MONTH_YEAR_RE.search(text)
+    if match:
+        month = datetime.datetime.strptime(match.group(1), '%B').month
+        return f"{match.group(2)}-{month:02d}-01"
+    if path and os.path.exists(path):
+        return datetime.date.fromtimestamp(os.path.getmtime(path)).isoformat()
+    return None
+
+
+def extract_facets(text, path=None):
+    """
+    Extract document facets
+
+    Args:
+        text (str): Document text
+        path (str): Local file path, used for the date when the text has none
+
+    Returns:
+        dict: Non-empty facets among equipment_type (list), manufacturer
+              (list), model (list) and doc_date (YYYY-MM-DD string)
+    """
+    facets = {
+        'equipment_type': _equipment_types(text),
+        'manufacturer': _manufacturers(text),
+        'model': _models(text)[:20],
+        'doc_date': _doc_date(text, path),
+    }
+    return {key: value for key, value in facets.items() if value}
+
+
+def metadata_sidecar(facets):
+    """Bedrock KB metadata sidecar document for a set of facets"""
+    return {'metadataAttributes': facets}
+
+
+def detect_query_facets(query):
+    """
+    Detect facets mentioned in a user question
+
+    Returns:
+        dict: equipment_type / manufacturer / model lists (only non-empty)
+    """
+    facets = {
+        'equipment_type': _equipment_types(query),
+        'manufacturer': _manufacturers(query),
+        'model': _models(query),
+    }
+    return {key: value for key, value in facets.items() if value}
+
+
+def build_filter(facets):
+    """
+    Build a Bedrock retrieval filter from detected facets
+
+    Values of one facet are OR-ed, different facets are AND-ed.
+
+    Returns:
+        dict: Bedrock RetrievalFilter, or None when there is nothing to filter on
+    """
+    clauses = []
+    for key in ('equipment_type', 'manufacturer', 'model'):
+        values = facets.get(key) or []
+        conditions = [{'listContains': {'key': key, 'value': value}} for value in values]
+        if len(conditions) == 1:
+            clauses.append(conditions[0])
+        elif conditions:
+            clauses.append({'orAll': conditions})
+
+    if not clauses:
+        return None
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'andAll': clauses}
+
+
+def matches_filter(attributes, retrieval_filter):
+    """Evaluate a retrieval filter against metadata attributes (used offline)"""
+    if not retrieval_filter:
+        return True
+    if 'andAll' in retrieval_filter:
+        return all(matches_filter(attributes, f) for f in retrieval_filter['andAll'])
+    if 'orAll' in retrieval_filter:
+        return any(matches_filter(attributes, f) for f in retrieval_filter['orAll'])
+    if 'listContains' in retrieval_filter:
+        condition = retrieval_filter['listContains']
+        return condition['value'] in (attributes.get(condition['key']) or [])
+    if 'equals' in retrieval_filter:
+        condition = retrieval_filter['equals']
+        return attributes.get(condition['key']) == condition['value']
+    return True
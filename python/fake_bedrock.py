@@ -0,0 +1,349 @@
+"""
+Local stand-in for bedrock-runtime and bedrock-agent-runtime
+
+Used by the benchmark and evaluation tools to exercise bedrock_utils and
+lambda_function offline. Latency follows a configurable distribution (plus
+an optional per-output-token cost) and throttling/errors can be injected at
+a fixed rate or when too many calls are in flight at once. Generation
+honours max_tokens, stop sequences and assistant prefill.
+"""
+
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from facets import extract_facets, matches_filter
+
+DEFAULT_CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'spec-sheets')
+
+MACHINERY_TERMS = (
+    'excavator', 'bulldozer', 'crane', 'loader', 'machinery', 'bucket', 'blade',
+    'digging', 'engine', 'hydraulic', 'ground pressure', 'operator', 'equipment',
+)
+
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+
+class LatencyModel:
+    """
+    Latency distribution in milliseconds
+
+    kind is one of:
+        fixed      - always mean_ms
+        uniform    - uniform in [mean_ms - spread_ms, mean_ms + spread_ms]
+        normal     - normal(mean_ms, spread_ms), truncated at 0
+        lognormal  - lognormal with median mean_ms and sigma spread (heavy tail)
+    """
+
+    KINDS = ('fixed', 'uniform', 'normal', 'lognormal')
+
+    def __init__(self, kind='lognormal', mean_ms=200.0, spread_ms=0.5):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution: {kind}")
+        self.kind = kind
+        self.mean_ms = mean_ms
+        self.spread_ms = spread_ms
+
+    def sample(self, rng):
+        if self.kind == 'fixed':
+            value = self.mean_ms
+        elif self.kind == 'uniform':
+            value = rng.uniform(self.mean_ms - self.spread_ms, self.mean_ms + self.spread_ms)
+        elif self.kind == 'normal':
+            value = rng.gauss(self.mean_ms, self.spread_ms)
+        else:
+            value = self.mean_ms * math.exp(rng.gauss(0.0, self.spread_ms))
+        return max(0.0, value)
+
+
+class _FakeService:
+    """Shared latency, fault injection and call accounting"""
+
+    def __init__(self, latency=None, throttle_rate=0.0, error_rate=0.0,
+                 max_concurrency=None, seed=None, time_scale=1.0, ms_per_output_token=0.0):
+        self.latency = latency or LatencyModel()
+        self.ms_per_output_token = ms_per_output_token
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.time_scale = time_scale
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+        self.errors = 0
+        self.output_tokens = 0
+        self.truncated = 0
+
+    def _enter(self, operation):
+        with self._lock:
+            self.calls += 1
+            roll = self._rng.random()
+            delay_ms = self.latency.sample(self._rng)
+            over_limit = self.max_concurrency is not None and self.in_flight >= self.max_concurrency
+            if over_limit or roll < self.throttle_rate:
+                self.throttled += 1
+                fault = 'ThrottlingException'
+            elif roll < self.throttle_rate + self.error_rate:
+                self.errors += 1
+                fault = 'ServiceUnavailableException'
+            else:
+                fault = None
+            if fault is None:
+                self.in_flight += 1
+
+        if fault is not None:
+            # Rejections come back quickly, like the real service
+            time.sleep(min(delay_ms, 20.0) / 1000.0 * self.time_scale)
+            raise ClientError({'Error': {'Code': fault, 'Message': f"Injected {fault}"}}, operation)
+
+        time.sleep(delay_ms / 1000.0 * self.time_scale)
+
+    def _exit(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _generate(self, text, stop_reason=None):
+        """Account for and spend the generation time of an output"""
+        tokens = _estimate_tokens(text)
+        with self._lock:
+            self.output_tokens += tokens
+            self.truncated += 1 if stop_reason == 'max_tokens' else 0
+        if self.ms_per_output_token:
+            time.sleep(tokens * self.ms_per_output_token / 1000.0 * self.time_scale)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'output_tokens': self.output_tokens,
+                'truncated': self.truncated,
+            }
+
+
+def _is_machinery(text):
+    lowered = text.lower()
+    return any(term in lowered for term in MACHINERY_TERMS)
+
+
+def _estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def _limit_output(text, max_tokens, stop_sequences=()):
+    """
+    Cut an output at the first stop sequence or at max_tokens
+
+    Returns:
+        tuple: (text, stop_reason)
+    """
+    for stop in stop_sequences or ():
+        if stop and stop in text:
+            return text[:text.index(stop)], 'stop_sequence'
+    if max_tokens and _estimate_tokens(text) > max_tokens:
+        return text[:max_tokens * 4], 'max_tokens'
+    return text, 'end_turn'
+
+
+class FakeBedrockRuntime(_FakeService):
+    """Stand-in for boto3.client('bedrock-runtime')"""
+
+    def invoke_model(self, modelId, body, contentType='application/json', accept='application/json'):
+        self._enter('InvokeModel')
+        try:
+            request = json.loads(body)
+            messages = request.get('messages', [])
+            prefill = ''
+            if messages and messages[-1].get('role') == 'assistant':
+                prefill = ''.join(part.get('text', '') for part in messages[-1].get('content', []))
+                messages = messages[:-1]
+            prompt = ''.join(
+                part.get('text', '')
+                for message in messages
+                for part in message.get('content', [])
+            )
+            match = re.search(r'<user_request>(.*?)</user_request>', prompt, re.S)
+            if match:
+                category = 'E' if _is_machinery(match.group(1)) else 'C'
+                text = f"Category {category}"
+            else:
+                text = f"[{modelId}] Based on the provided documents: " + prompt.strip()[:200]
+            if prefill and text.startswith(prefill):
+                text = text[len(prefill):]
+            text, stop_reason = _limit_output(text, max(1, request.get('max_tokens', 500)),
+                                              request.get('stop_sequences'))
+            self._generate(text, stop_reason)
+            payload = {
+                'content': [{'type': 'text', 'text': text}],
+                'usage': {
+                    'input_tokens': _estimate_tokens(prompt),
+                    'output_tokens': _estimate_tokens(text),
+                },
+                'stop_reason': stop_reason,
+            }
+            return {'body': io.BytesIO(json.dumps(payload).encode('utf-8'))}
+        finally:
+            self._exit()
+
+
+def load_corpus(corpus_dir=DEFAULT_CORPUS_DIR):
+    """
+    Split the local documents into paragraph chunks
+
+    Returns:
+        list: Dicts with text, uri (s3://fake-bucket/<relative path>) and
+              the document's facet attributes
+    """
+    chunks = []
+    for root, _dirs, files in os.walk(corpus_dir):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, corpus_dir).replace('\\', '/')
+            with open(path, encoding='utf-8', errors='replace') as f:
+                content = f.read()
+            attributes = extract_facets(content, path)
+            for paragraph in re.split(r'\n\s*\n', content):
+                if paragraph.strip():
+                    chunks.append({
+                        'text': paragraph.strip(),
+                        'uri': f"s3://fake-bucket/{relative}",
+                        'attributes': attributes,
+                    })
+    return chunks
+
+
+class FakeAgentRuntime(_FakeService):
+    """Stand-in for boto3.client('bedrock-agent-runtime') over a local corpus"""
+
+    def __init__(self, corpus=None, answer_tokens=350, **kwargs):
+        super().__init__(**kwargs)
+        self.answer_tokens = answer_tokens
+        self.corpus = corpus if corpus is not None else load_corpus()
+        self._chunk_words = [set(_WORD_RE.findall(c['text'].lower())) for c in self.corpus]
+
+    def _search(self, text, k, retrieval_filter=None):
+        words = set(_WORD_RE.findall(text.lower()))
+        scored = []
+        for index, chunk_words in enumerate(self._chunk_words):
+            if retrieval_filter and not matches_filter(self.corpus[index].get('attributes', {}), retrieval_filter):
+                continue
+            overlap = len(words & chunk_words)
+            if overlap:
+                scored.append((overlap / math.sqrt(len(chunk_words) + 1), index))
+        scored.sort(key=lambda s: (-s[0], s[1]))
+        results = []
+        for score, index in scored[:k]:
+            chunk = self.corpus[index]
+            results.append({
+                'content': {'text': chunk['text']},
+                'location': {'type': 'S3', 's3Location': {'uri': chunk['uri']}},
+                'score': round(min(1.0, score), 4),
+                'metadata': dict(chunk.get('attributes', {}), **{'x-amz-bedrock-kb-source-uri': chunk['uri']}),
+            })
+        return results
+
+    def _answer(self, query, hits):
+        """
+        Answer text that restates the hits until it reaches the query's length
+
+        Answer lengths are lognormal around answer_tokens (seeded by the query,
+        so a query gets the same length on every run), giving the spread of
+        short and long answers the token budgets are meant to cap.
+        """
+        if not hits:
+            return 'No information found.'
+        target_chars = 4 * int(self.answer_tokens * random.Random(query).lognormvariate(0.0, 0.5))
+        sources = [' '.join(hit['content']['text'].split()) for hit in hits]
+        parts = []
+        while sum(len(part) + 1 for part in parts) < target_chars:
+            parts.append(sources[len(parts) % len(sources)])
+        return ' '.join(parts)[:max(target_chars, len(sources[0]))]
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration=None, **kwargs):
+        self._enter('Retrieve')
+        try:
+            config = (retrievalConfiguration or {}).get('vectorSearchConfiguration', {})
+            k = config.get('numberOfResults', 5)
+            return {'retrievalResults': self._search(retrievalQuery['text'], k, config.get('filter'))}
+        finally:
+            self._exit()
+
+    def retrieve_and_generate(self, input, retrieveAndGenerateConfiguration, sessionId=None, **kwargs):
+        self._enter('RetrieveAndGenerate')
+        try:
+            kb_config = retrieveAndGenerateConfiguration.get('knowledgeBaseConfiguration', {})
+            search_config = kb_config.get('retrievalConfiguration', {}).get('vectorSearchConfiguration', {})
+            hits = self._search(input['text'], search_config.get('numberOfResults', 3), search_config.get('filter'))
+            answer = self._answer(input['text'], hits)
+            text_config = (kb_config.get('generationConfiguration', {}).get('inferenceConfig', {})
+                           .get('textInferenceConfig', {}))
+            answer, stop_reason = _limit_output(answer, text_config.get('maxTokens', 2048),
+                                                text_config.get('stopSequences'))
+            self._generate(answer, stop_reason)
+            citations = [{
+                'generatedResponsePart': {
+                    'textResponsePart': {'text': answer, 'span': {'start': 0, 'end': len(answer) - 1}}
+                },
+                'retrievedReferences': [
+                    {'content': hit['content'], 'location': hit['location'], 'metadata': hit['metadata']}
+                    for hit in hits
+                ],
+            }] if hits else []
+            return {
+                'sessionId': sessionId or f"fake-session-{self._rng.getrandbits(32):08x}",
+                'output': {'text': answer},
+                'citations': citations,
+            }
+        finally:
+            self._exit()
+
+
+    def retrieve_and_generate_stream(self, input, retrieveAndGenerateConfiguration, sessionId=None, **kwargs):
+        """Same answer as retrieve_and_generate, delivered as output/citation events"""
+        response = self.retrieve_and_generate(input, retrieveAndGenerateConfiguration, sessionId)
+        words = response['output']['text'].split(' ')
+
+        def events():
+            for start in range(0, len(words), 4):
+                # ~20 ms per 4-word delta, scaled like the other calls
+                time.sleep(0.02 * self.time_scale)
+                text = ' '.join(words[start:start + 4]) + (' ' if start + 4 < len(words) else '')
+                yield {'output': {'text': text}}
+            for citation in response['citations']:
+                yield {'citation': {'citation': citation}}
+        return {'sessionId': response['sessionId'], 'stream': events()}
+
+
+def install(runtime=None, agent_runtime=None):
+    """
+    Point bedrock_utils at fake clients
+
+    Args:
+        runtime (FakeBedrockRuntime): Replaces the bedrock-runtime client
+        agent_runtime (FakeAgentRuntime): Replaces the bedrock-agent-runtime client
+
+    Returns:
+        tuple: (runtime, agent_runtime) actually installed
+    """
+    import bedrock_utils
+
+    runtime = runtime or FakeBedrockRuntime()
+    agent_runtime = agent_runtime or FakeAgentRuntime()
+    bedrock_utils.bedrock = runtime
+    bedrock_utils.bedrock_kb = agent_runtime
+    # Every region answers from the same fake
+    bedrock_utils._new_agent_runtime = lambda region: agent_runtime
+    bedrock_utils._regional_kb_clients.clear()
+    # Content never changes under the fake, so pin a constant KB version
+    bedrock_utils.retrieval_cache.set_version_fn(lambda kb_id: 'fake-ingestion-job')
+    return runtime, agent_runtime
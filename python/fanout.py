@@ -0,0 +1,271 @@
+"""
+Fan-out retrieval across several knowledge bases and regions
+
+The corpus is split across per-business-unit knowledge bases, and a KB can
+be replicated to a second region for failover. A fan-out retrieve queries
+every target at once on a shared thread pool, waits for each one only up to
+its own timeout (and never past the overall deadline), then merges whatever
+finished: scores are normalized per target (divided by that target's best
+score, times the target weight) so KBs with different score scales compete
+fairly, and duplicate chunks (the same chunk of a document from a replica or
+from two KBs) are collapsed to their best-scoring hit. A slow or failing target only
+costs its own results.
+
+Targets are configured with KB_TARGETS, either as a comma-separated list
+of KB IDs with an optional region
+
+    KB_TARGETS=KBSALES0001,KBPARTS0001,KBPARTS0001@us-west-2
+
+or as a JSON list for per-target timeouts and weights
+
+    KB_TARGETS='[{"kb_id": "KBSALES0001", "timeout": 2.0}, {"kb_id": "KBPARTS0001", "region": "us-west-2", "weight": 0.8}]'
+"""
+
+import contextvars
+import json
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+import bedrock_utils
+from admission import AdmissionRejected
+from model_router import DEFAULT_REGION, model_id_from_arn
+from profiling import stage
+from results import Answer, Chunk, Citation
+from retrieval_cache import register_kb_region
+from single_flight import make_key
+
+FANOUT_MAX_WORKERS = int(os.environ.get('FANOUT_MAX_WORKERS', '8'))
+FANOUT_TARGET_TIMEOUT_SECONDS = float(os.environ.get('FANOUT_TARGET_TIMEOUT_SECONDS', '3'))
+FANOUT_DEADLINE_SECONDS = float(os.environ.get('FANOUT_DEADLINE_SECONDS', '5'))
+
+# Shared by all fan-outs in this process; calls abandoned at a deadline keep
+# their worker until the client read timeout (REGIONAL_READ_TIMEOUT_SECONDS,
+# applied to every target including the default region)
+_executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix='fanout')
+
+_TARGET_RE = re.compile(r'^\s*([A-Za-z0-9]+)\s*(?:@\s*([a-z0-9-]+))?\s*$')
+
+
+class RetrievalTarget:
+    """One knowledge base in one region"""
+
+    __slots__ = ('kb_id', 'region', 'timeout', 'weight')
+
+    def __init__(self, kb_id, region=None, timeout=None, weight=1.0):
+        self.kb_id = kb_id
+        self.region = region or DEFAULT_REGION
+        self.timeout = float(timeout) if timeout else FANOUT_TARGET_TIMEOUT_SECONDS
+        self.weight = float(weight)
+        if self.region != DEFAULT_REGION:
+            register_kb_region(kb_id, self.region)
+
+    @property
+    def name(self):
+        return f"{self.kb_id}@{self.region}"
+
+    def __repr__(self):
+        return f"RetrievalTarget({self.name!r}, timeout={self.timeout}, weight={self.weight})"
+
+
+def parse_targets(spec):
+    """
+    Parse a KB_TARGETS value
+
+    Returns:
+        list: RetrievalTarget objects (empty for an empty spec)
+
+    Raises:
+        ValueError: If the spec is malformed
+    """
+    spec = (spec or '').strip()
+    if not spec:
+        return []
+    if spec.startswith('['):
+        return [RetrievalTarget(**entry) for entry in json.loads(spec)]
+
+    targets = []
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        match = _TARGET_RE.match(part)
+        if not match:
+            raise ValueError(f"Invalid KB target: {part!r}")
+        targets.append(RetrievalTarget(match.group(1), match.group(2)))
+    return targets
+
+
+_configured = None
+
+
+def configured_targets():
+    """Targets from KB_TARGETS, parsed once per process"""
+    global _configured
+    if _configured is None:
+        try:
+            _configured = parse_targets(os.environ.get('KB_TARGETS'))
+        except ValueError as e:
+            print(f"Warning: Ignoring KB_TARGETS: {str(e)}")
+            _configured = []
+    return _configured
+
+
+def _source_key(result):
+    # A document's distinct chunks are all kept; only the same chunk seen
+    # from a replica or a second KB collapses
+    chunk = Chunk.from_result(result)
+    return (chunk.uri, chunk.text)
+
+
+def merge_results(results_by_target, number_of_results):
+    """
+    Merge per-target results by normalized score, deduplicated by (source, chunk text)
+
+    Args:
+        results_by_target (list): (RetrievalTarget, retrievalResults) pairs
+        number_of_results (int): Results to keep after merging
+
+    Returns:
+        list: Result dicts (copies) with knowledgeBaseId, region and
+              normalizedScore added, best first
+    """
+    best = {}
+    for target, results in results_by_target:
+        top_score = max((r.get('score') or 0.0 for r in results), default=0.0)
+        for rank, result in enumerate(results):
+            score = result.get('score')
+            if top_score > 0 and score is not None:
+                normalized = score / top_score * target.weight
+            else:
+                # No usable scores: fall back to rank order within the target
+                normalized = target.weight / (rank + 1)
+            key = _source_key(result)
+            current = best.get(key)
+            if current is None or normalized > current['normalizedScore']:
+                best[key] = dict(result, knowledgeBaseId=target.kb_id, region=target.region,
+                                 normalizedScore=round(normalized, 6))
+
+    merged = sorted(best.values(), key=lambda r: -r['normalizedScore'])
+    return merged[:number_of_results]
+
+
+def fan_out_retrieve(query, targets=None, number_of_results=3, search_type='HYBRID', use_cache=True,
+                     metadata_filter=None, auto_filter=True, deadline=FANOUT_DEADLINE_SECONDS):
+    """
+    Retrieve from several KBs/regions concurrently and merge the results
+
+    Args:
+        query (str): The user's question
+        targets (list): RetrievalTarget objects (defaults to KB_TARGETS)
+        number_of_results (int): Results per target and after merging
+        search_type (str): HYBRID or SEMANTIC
+        use_cache (bool): Serve from / populate the retrieval cache
+        metadata_filter (dict): Bedrock retrieval filter applied to every target
+        auto_filter (bool): When no filter is given, narrow each target to
+                            facets detected in the query (a target that
+                            finds nothing retries unfiltered)
+        deadline (float): Seconds to wait overall; targets still running
+                          are reported as 'timeout'
+
+    Returns:
+        dict: results (merged list), targets (per-target status of ok,
+              timeout, rejected or error, result count and elapsed_ms) and partial (True if any target did not
+              contribute)
+    """
+    targets = configured_targets() if targets is None else targets
+    if not query or not query.strip() or not targets:
+        return {'results': [], 'targets': [], 'partial': bool(targets)}
+
+    started = time.monotonic()
+    overall = started + deadline
+    pending = {}
+    for target in targets:
+        # Run in a copy of this context so workers record into the request profile
+        future = _executor.submit(
+            contextvars.copy_context().run, partial(
+                bedrock_utils.query_knowledge_base, query, target.kb_id, number_of_results, search_type,
+                use_cache, metadata_filter, auto_filter, region=target.region, bounded=True,
+                raise_errors=True
+            )
+        )
+        pending[future] = (target, min(started + target.timeout, overall))
+
+    status = {}
+    finished = []
+    with stage('fanout'):
+        while pending:
+            now = time.monotonic()
+            for future, (target, target_deadline) in list(pending.items()):
+                if target_deadline <= now:
+                    # Stop waiting; the call finishes (or times out) in the background
+                    status[target.name] = ('timeout', 0, target_deadline - started)
+                    del pending[future]
+            if not pending:
+                break
+            timeout = min(target_deadline for _, target_deadline in pending.values()) - now
+            done, _ = wait(list(pending), timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+            for future in done:
+                target, _ = pending.pop(future)
+                elapsed = time.monotonic() - started
+                if isinstance(future.exception(), AdmissionRejected):
+                    status[target.name] = ('rejected', 0, elapsed)
+                elif future.exception() is not None:
+                    print(f"✗ Fan-out target {target.name} failed: {future.exception()}")
+                    status[target.name] = ('error', 0, elapsed)
+                else:
+                    results = future.result()
+                    status[target.name] = ('ok', len(results), elapsed)
+                    finished.append((target, results))
+
+    merged = merge_results(finished, number_of_results)
+    report = []
+    for target in targets:
+        outcome, count, elapsed = status[target.name]
+        report.append({'kb_id': target.kb_id, 'region': target.region, 'status': outcome,
+                       'results': count, 'elapsed_ms': round(elapsed * 1000, 1)})
+    print(f"✓ Fan-out: {len(merged)} merged results from {len(finished)}/{len(targets)} targets")
+    return {
+        'results': merged,
+        'targets': report,
+        'partial': any(entry['status'] != 'ok' for entry in report),
+    }
+
+
+def answer_from_targets(query, model_arn, targets=None, number_of_results=5):
+    """
+    Answer a question from fan-out retrieval plus one generate call
+
+    retrieve_and_generate only reads a single KB, so the merged chunks are
+    put into the prompt directly. The whole answer cites the chunks it was
+    generated from.
+
+    Returns:
+        results.Answer: Answer citing the merged chunks (no sessionId)
+    """
+    fanout = fan_out_retrieve(query, targets, number_of_results=number_of_results)
+    chunks = [Chunk.from_result(dict(r, score=r['normalizedScore'])) for r in fanout['results']]
+    if not chunks:
+        return Answer("I couldn't find information about that in the knowledge bases.")
+
+    context = '\n\n'.join(f"<source id=\"{i + 1}\">\n{chunk.text}\n</source>" for i, chunk in enumerate(chunks))
+    prompt = f"""Answer the question using only the sources below. If they do not contain the answer, say so.
+
+{context}
+
+Question: {query.strip()}"""
+
+    text = bedrock_utils.generate_for_task('generate', prompt, model_id=model_id_from_arn(model_arn), query=query)
+    if text.startswith('Error:'):
+        raise RuntimeError(text)
+    return Answer(text, [Citation(text, 0, len(text) - 1, chunks)])
+
+
+def shared_answer_from_targets(query, model_arn, targets=None):
+    """answer_from_targets as a dict, with single-flight coalescing"""
+    targets = configured_targets() if targets is None else targets
+    key = make_key('fanout', query, model_arn, *(target.name for target in targets))
+    return bedrock_utils.inflight.do(
+        key, lambda: answer_from_targets(query, model_arn, targets).to_dict()
+    )
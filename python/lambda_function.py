@@ -1,30 +1,120 @@
+import contextvars
 import json
 import os
-from bedrock_utils import query_knowledge_base, generate_response, valid_prompt, query_with_sources
+import time
+_INIT_STARTED = time.perf_counter()
+from concurrent.futures import ThreadPoolExecutor, wait
+from admission import AdmissionRejected, priority
+from bedrock_utils import get_cached_answer, shared_valid_prompt, shared_query_with_sources
+from fanout import configured_targets, shared_answer_from_targets
+from model_router import get_profile, model_arn as build_model_arn
+from profiling import finish_request, stage, start_request
+from query_log import log_request, wake_query_logger
+from results import dumps
+from session_store import get_session_store
+from spec_index import answer_from_spec_index
+from single_flight import normalize_query
+
+# Module import time, including Bedrock client construction (reported as the
+# 'init' stage when the first request of a container is profiled)
+_INIT_SECONDS = time.perf_counter() - _INIT_STARTED
+_cold_start = True
+
+# Batch mode limits (override with env vars)
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '25'))
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', '4'))
+BATCH_DEADLINE_SECONDS = float(os.environ.get('BATCH_DEADLINE_SECONDS', '25'))
+# Time kept in reserve to serialize the response before Lambda times out
+DEADLINE_SAFETY_MARGIN_SECONDS = 1.0
+
+REJECTED_MESSAGE = 'Query rejected: only heavy machinery questions are supported'
+
+RESPONSE_HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Origin': '*'
+}
 
 def lambda_handler(event, context):
     """
     AWS Lambda function to handle document querying requests.
+    
+    Accepts either a single query ({"query": "...", "sessionKey": "..."})
+    or a batch ({"queries": ["...", {"id": "...", "query": "..."}]}).
+    Requests with the same sessionKey continue one Bedrock conversation.
+    
+    With PROFILE_MODE or an X-Profile header set, the response carries a
+    Server-Timing header with the per-stage breakdown (see profiling.py).
+    With QUERY_LOG_PATH set, every request is logged (see query_log.py).
     """
+    global _cold_start
+    cold_start, _cold_start = _cold_start, False
+    started = time.perf_counter()
+    request_id = getattr(context, 'aws_request_id', None)
+    
+    # The container was frozen since the last response; let the query log
+    # ship any due batch in the background while this request runs
+    wake_query_logger()
+    
+    profile = start_request(event, request_id)
+    if profile is None:
+        response = _handle_request(event, context)
+    else:
+        if cold_start:
+            profile.record('init', _INIT_SECONDS)
+        try:
+            response = _handle_request(event, context)
+        except BaseException:
+            profile.stop()
+            raise
+        response = finish_request(profile, response)
+    
+    # Buffered only; the flush thread writes it later (see query_log.py)
+    log_request(request_id, event.get('body'), response, (time.perf_counter() - started) * 1000.0)
+    return response
+
+def _handle_request(event, context):
+    """Answer a single or batch request (see lambda_handler)"""
     try:
         # Extract query from event
-        body = json.loads(event.get('body', '{}'))
-        query = body.get('query', '')
+        with stage('parse'):
+            body = json.loads(event.get('body', '{}'))
+        
+        if 'queries' in body:
+            return handle_batch(body, context)
+        
+        query = body.get('query', '').strip()
+        
+        # Direct spec lookups are answered from the spec index without any model call
+        with stage('spec_lookup'):
+            spec_answer = answer_from_spec_index(query) if len(query) <= 1000 else None
+        if spec_answer is not None:
+            result = spec_answer.to_dict()
+            result['query'] = query
+            result['fastPath'] = True
+            return _ok(result)
+        
+        # Get environment variables
+        knowledge_base_id, model_arn = _kb_config()
+        session_key = body.get('sessionKey')
+        
+        # Precomputed answers for frequent questions (warmed only after passing validation)
+        if knowledge_base_id and not session_key:
+            with stage('answer_cache'):
+                cached = get_cached_answer(query, knowledge_base_id, model_arn)
+            if cached is not None:
+                return _ok(dict(cached, query=query, cached=True))
         
-        # Validate the prompt
-        is_valid, validation_result = valid_prompt(query)
-        if not is_valid:
+        # Validate the prompt on the cheap classify route
+        with stage('classify'):
+            allowed = shared_valid_prompt(query, os.environ.get('CLASSIFIER_MODEL_ID'))
+        if not allowed:
             return {
                 'statusCode': 400,
                 'body': json.dumps({
-                    'error': validation_result
+                    'error': REJECTED_MESSAGE
                 })
             }
         
-        # Get environment variables
-        knowledge_base_id = os.environ.get('KNOWLEDGE_BASE_ID')
-        model_arn = os.environ.get('MODEL_ARN', 'arn:aws:bedrock:us-east-1::foundation-model/anthropic.claude-3-sonnet-20240229-v1:0')
-        
         if not knowledge_base_id:
             return {
                 'statusCode': 500,
@@ -33,26 +123,233 @@ def lambda_handler(event, context):
                 })
             }
         
-        # Query the knowledge base
-        response = query_with_sources(validation_result, knowledge_base_id, model_arn)
+        # Reuse the Bedrock conversation for follow-up questions
+        with stage('session'):
+            session_id = get_session_store().get(session_key) if session_key else None
         
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'answer': response['answer'],
-                'sources': response['sources'],
-                'query': validation_result
-            })
+        # Query the knowledge base (all KB_TARGETS at once when configured;
+        # conversations stay on the single-KB path that keeps the sessionId)
+        with stage('rag'):
+            if configured_targets() and not session_key:
+                response = shared_answer_from_targets(query, model_arn)
+            else:
+                response = shared_query_with_sources(query, knowledge_base_id, model_arn, session_id, session_key)
+        
+        result = {
+            'answer': response['answer'],
+            'sources': response['sources'],
+            'citations': response['citations'],
+            'query': query
         }
+        if session_key and response.get('sessionId'):
+            with stage('session'):
+                get_session_store().put(session_key, response['sessionId'])
+            result['sessionKey'] = session_key
         
+        return _ok(result)
+    
+    except AdmissionRejected as e:
+        return _throttled(e)
     except Exception as e:
         return {
             'statusCode': 500,
             'body': json.dumps({
                 'error': f'Internal server error: {str(e)}'
             })
-        }
\ No newline at end of file
+        }
+
+def _ok(result):
+    """Serialize a 200 response"""
+    with stage('serialize'):
+        body = dumps(result)
+    return {
+        'statusCode': 200,
+        'headers': RESPONSE_HEADERS,
+        'body': body
+    }
+
+def _throttled(e):
+    """429 response for a call rejected by admission control"""
+    return {
+        'statusCode': 429,
+        'headers': dict(RESPONSE_HEADERS, **{'Retry-After': str(max(1, round(e.retry_after)))}),
+        'body': json.dumps({
+            'error': 'Too many requests, please retry shortly',
+            'retryAfter': round(e.retry_after, 1)
+        })
+    }
+
+def _kb_config():
+    """Return (knowledge_base_id, model_arn) from the environment (KNOWLEDGE_BASE_ID, else the first KB_TARGETS entry)"""
+    targets = configured_targets()
+    knowledge_base_id = os.environ.get('KNOWLEDGE_BASE_ID') or (targets[0].kb_id if targets else None)
+    model_arn = os.environ.get('MODEL_ARN') or build_model_arn(get_profile('generate')['model_id'])
+    return knowledge_base_id, model_arn
+
+def _parse_batch(queries):
+    """
+    Normalize a batch payload into a list of items
+    
+    Returns:
+        tuple: (items, error) - items is a list of dicts with index, id and
+               query; error is a message when the batch itself is invalid
+    """
+    if not isinstance(queries, list) or not queries:
+        return None, "'queries' must be a non-empty list"
+    
+    if len(queries) > BATCH_MAX_SIZE:
+        return None, f"Batch too large: {len(queries)} queries (max {BATCH_MAX_SIZE})"
+    
+    items = []
+    for index, entry in enumerate(queries):
+        if isinstance(entry, dict):
+            item_id = entry.get('id', index)
+            query = entry.get('query', '')
+        else:
+            item_id = index
+            query = entry
+        items.append({
+            'index': index,
+            'id': item_id,
+            'query': query.strip() if isinstance(query, str) else ''
+        })
+    return items, None
+
+def _precheck(query):
+    """Cheap local checks run before any Bedrock call, or None if OK"""
+    if not query:
+        return 'Query cannot be empty'
+    if len(query) < 3:
+        return 'Query too short (min 3 chars)'
+    if len(query) > 1000:
+        return 'Query too long (max 1000 chars)'
+    return None
+
+def _answer(query, knowledge_base_id, model_arn, classifier_model_id):
+    """Validate and answer one batch item"""
+    with stage('spec_lookup'):
+        spec_answer = answer_from_spec_index(query)
+    if spec_answer is not None:
+        result = spec_answer.to_dict()
+        result['status'] = 'ok'
+        result['fastPath'] = True
+        return result
+    
+    with stage('answer_cache'):
+        cached = get_cached_answer(query, knowledge_base_id, model_arn)
+    if cached is not None:
+        return dict(cached, status='ok', cached=True)
+    
+    with stage('classify'):
+        allowed = shared_valid_prompt(query, classifier_model_id)
+    if not allowed:
+        return {'status': 'rejected', 'error': REJECTED_MESSAGE}
+    
+    with stage('rag'):
+        if configured_targets():
+            response = shared_answer_from_targets(query, model_arn)
+        else:
+            response = shared_query_with_sources(query, knowledge_base_id, model_arn)
+    return {
+        'status': 'ok',
+        'answer': response['answer'],
+        'sources': response['sources'],
+        'citations': response['citations']
+    }
+
+def _batch_deadline(context):
+    """Seconds available for the batch, bounded by the Lambda's remaining time"""
+    deadline = BATCH_DEADLINE_SECONDS
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        remaining = context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_SAFETY_MARGIN_SECONDS
+        deadline = min(deadline, remaining)
+    return max(0.0, deadline)
+
+def handle_batch(body, context):
+    """
+    Answer many queries in one invocation
+    
+    Items are pre-checked locally, duplicates within the batch are answered
+    once, and the rest run on a bounded thread pool. Items still running
+    when the batch deadline passes are reported as 'timeout' so the
+    invocation returns partial results instead of timing out.
+    
+    Args:
+        body (dict): Parsed request body with a 'queries' list
+        context: Lambda context (used for remaining execution time)
+    
+    Returns:
+        dict: API Gateway response with per-item results in request order
+    """
+    started = time.monotonic()
+    items, error = _parse_batch(body.get('queries'))
+    if error:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'error': error
+            })
+        }
+    
+    knowledge_base_id, model_arn = _kb_config()
+    if not knowledge_base_id:
+        return {
+            'statusCode': 500,
+            'body': json.dumps({
+                'error': 'Knowledge base ID not configured'
+            })
+        }
+    classifier_model_id = os.environ.get('CLASSIFIER_MODEL_ID')
+    
+    results = [None] * len(items)
+    futures = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, BATCH_MAX_WORKERS))
+    try:
+        for item in items:
+            problem = _precheck(item['query'])
+            if problem:
+                results[item['index']] = {'status': 'rejected', 'error': problem}
+                continue
+            key = normalize_query(item['query'])
+            if key not in futures:
+                # Run in a copy of this context so workers keep the batch
+                # priority and record into the request profile
+                with priority('batch'):
+                    context_copy = contextvars.copy_context()
+                futures[key] = executor.submit(
+                    context_copy.run,
+                    _answer, item['query'], knowledge_base_id, model_arn, classifier_model_id
+                )
+        
+        done, _ = wait(list(futures.values()), timeout=_batch_deadline(context))
+    finally:
+        # Don't wait on stragglers; anything not started is dropped
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    for item in items:
+        if results[item['index']] is not None:
+            continue
+        future = futures[normalize_query(item['query'])]
+        if future not in done:
+            results[item['index']] = {'status': 'timeout', 'error': 'Batch deadline exceeded'}
+        elif isinstance(future.exception(), AdmissionRejected):
+            results[item['index']] = {'status': 'throttled', 'error': str(future.exception())}
+        elif future.exception() is not None:
+            results[item['index']] = {'status': 'error', 'error': str(future.exception())}
+        else:
+            results[item['index']] = future.result()
+    
+    response_items = []
+    for item, result in zip(items, results):
+        entry = {'id': item['id'], 'query': item['query']}
+        entry.update(result)
+        response_items.append(entry)
+    
+    completed = sum(1 for r in results if r['status'] != 'timeout')
+    return _ok({
+        'results': response_items,
+        'completed': completed,
+        'total': len(items),
+        'partial': completed < len(items),
+        'elapsed_ms': round((time.monotonic() - started) * 1000, 1)
+    })
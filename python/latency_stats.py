@@ -0,0 +1,31 @@
+"""
+Latency percentiles for the benchmark and evaluation tools
+
+Kept free of other project imports so standalone tools (vector_index.py,
+evaluate_retrieval.py) can report latencies without loading the Bedrock
+stand-in.
+"""
+
+import math
+
+
+def percentile(sorted_samples, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_samples:
+        return 0.0
+    rank = math.ceil(pct / 100.0 * len(sorted_samples))
+    return sorted_samples[min(len(sorted_samples), max(1, rank)) - 1]
+
+
+def summarize_latencies(latencies_ms):
+    """Return mean/p50/p95/p99/max for a list of latencies in ms"""
+    samples = sorted(latencies_ms)
+    if not samples:
+        return {'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+    return {
+        'mean_ms': round(sum(samples) / len(samples), 2),
+        'p50_ms': round(percentile(samples, 50), 2),
+        'p95_ms': round(percentile(samples, 95), 2),
+        'p99_ms': round(percentile(samples, 99), 2),
+        'max_ms': round(samples[-1], 2),
+    }
@@ -0,0 +1,190 @@
+"""
+Model routing profiles for the document querying system
+
+Each task (classify, generate, summarize) gets its own primary model, an
+optional fallback model used when the primary is throttled, and default
+generation parameters. Per-route latency, token usage and estimated cost are
+recorded so the profiles can be tuned from real traffic.
+"""
+
+import os
+import threading
+
+# Region of the default Bedrock clients (Lambda sets AWS_REGION)
+DEFAULT_REGION = os.environ.get('BEDROCK_REGION') or os.environ.get('AWS_REGION', 'us-east-1')
+
+# Approximate on-demand pricing in USD per 1K tokens (input, output)
+MODEL_PRICING = {
+    'anthropic.claude-3-haiku-20240307-v1:0': (0.00025, 0.00125),
+    'anthropic.claude-3-5-haiku-20241022-v1:0': (0.0008, 0.004),
+    'anthropic.claude-3-sonnet-20240229-v1:0': (0.003, 0.015),
+    'anthropic.claude-3-5-sonnet-20240620-v1:0': (0.003, 0.015),
+}
+
+# Default route profiles - override per task with ROUTE_<TASK>_* env vars
+ROUTE_PROFILES = {
+    'classify': {
+        'model_id': 'anthropic.claude-3-haiku-20240307-v1:0',
+        'fallback_model_id': 'anthropic.claude-3-5-haiku-20241022-v1:0',
+        'max_tokens': 10,
+        'temperature': 0.0,
+        'top_p': 0.9,
+    },
+    'generate': {
+        'model_id': 'anthropic.claude-3-sonnet-20240229-v1:0',
+        'fallback_model_id': 'anthropic.claude-3-haiku-20240307-v1:0',
+        'max_tokens': 500,
+        'temperature': 0.5,
+        'top_p': 0.9,
+    },
+    'summarize': {
+        'model_id': 'anthropic.claude-3-haiku-20240307-v1:0',
+        'fallback_model_id': 'anthropic.claude-3-sonnet-20240229-v1:0',
+        'max_tokens': 300,
+        'temperature': 0.3,
+        'top_p': 0.9,
+    },
+}
+
+# Error codes that should trigger a retry on the fallback model
+FALLBACK_ERROR_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'ModelNotReadyException',
+}
+
+_ENV_OVERRIDES = {
+    'model_id': ('MODEL_ID', str),
+    'fallback_model_id': ('FALLBACK_MODEL_ID', str),
+    'max_tokens': ('MAX_TOKENS', int),
+    'temperature': ('TEMPERATURE', float),
+    'top_p': ('TOP_P', float),
+}
+
+# Number of latency samples kept per route for percentile reporting
+MAX_LATENCY_SAMPLES = 1000
+
+
+def get_profile(task):
+    """
+    Resolve the route profile for a task, applying environment overrides
+
+    Args:
+        task (str): Route name (classify, generate, summarize)
+
+    Returns:
+        dict: Profile with model_id, fallback_model_id, max_tokens,
+              temperature and top_p
+    """
+    if task not in ROUTE_PROFILES:
+        raise ValueError(f"Unknown route: {task}")
+
+    profile = dict(ROUTE_PROFILES[task])
+    for key, (suffix, cast) in _ENV_OVERRIDES.items():
+        value = os.environ.get(f"ROUTE_{task.upper()}_{suffix}")
+        if value is None:
+            continue
+        try:
+            profile[key] = cast(value) if value else None
+        except ValueError:
+            print(f"Warning: Ignoring invalid ROUTE_{task.upper()}_{suffix}={value!r}")
+    return profile
+
+
+def model_arn(model_id, region=DEFAULT_REGION):
+    """Build a foundation model ARN from a model ID"""
+    if model_id.startswith('arn:'):
+        return model_id
+    return f"arn:aws:bedrock:{region}::foundation-model/{model_id}"
+
+
+def model_id_from_arn(arn):
+    """Foundation model ID from an ARN (other ARNs and plain IDs are passed through)"""
+    if arn and 'foundation-model/' in arn:
+        return arn.split('foundation-model/', 1)[1]
+    return arn
+
+
+def estimate_cost(model_id, input_tokens, output_tokens):
+    """
+    Estimate the USD cost of a call from token counts
+
+    Returns:
+        float: Estimated cost, or 0.0 when the model has no pricing entry
+    """
+    input_price, output_price = MODEL_PRICING.get(model_id, (0.0, 0.0))
+    return (input_tokens / 1000.0) * input_price + (output_tokens / 1000.0) * output_price
+
+
+class RouteStats:
+    """Thread-safe per-route counters for latency, tokens and cost"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def _route(self, task):
+        if task not in self._routes:
+            self._routes[task] = {
+                'calls': 0,
+                'errors': 0,
+                'fallbacks': 0,
+                'input_tokens': 0,
+                'output_tokens': 0,
+                'cost_usd': 0.0,
+                'latencies_ms': [],
+                'models': {},
+            }
+        return self._routes[task]
+
+    def record(self, task, model_id, latency_ms, input_tokens=0, output_tokens=0,
+               error=False, fallback=False):
+        """Record the outcome of a single routed call"""
+        cost = estimate_cost(model_id, input_tokens, output_tokens)
+        with self._lock:
+            route = self._route(task)
+            route['calls'] += 1
+            route['errors'] += 1 if error else 0
+            route['fallbacks'] += 1 if fallback else 0
+            route['input_tokens'] += input_tokens
+            route['output_tokens'] += output_tokens
+            route['cost_usd'] += cost
+            route['models'][model_id] = route['models'].get(model_id, 0) + 1
+            samples = route['latencies_ms']
+            samples.append(latency_ms)
+            if len(samples) > MAX_LATENCY_SAMPLES:
+                del samples[:len(samples) - MAX_LATENCY_SAMPLES]
+
+    def snapshot(self):
+        """
+        Return a summary of all routes
+
+        Returns:
+            dict: Route name -> counters plus p50/p95 latency in ms
+        """
+        with self._lock:
+            summary = {}
+            for task, route in self._routes.items():
+                samples = sorted(route['latencies_ms'])
+                entry = {k: v for k, v in route.items() if k != 'latencies_ms'}
+                entry['models'] = dict(route['models'])
+                entry['cost_usd'] = round(route['cost_usd'], 6)
+                entry['p50_ms'] = _percentile(samples, 50)
+                entry['p95_ms'] = _percentile(samples, 95)
+                summary[task] = entry
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+def _percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, int(round(pct / 100.0 * (len(sorted_samples) - 1))))
+    return round(sorted_samples[index], 2)
+
+
+route_stats = RouteStats()
@@ -0,0 +1,305 @@
+"""
+Opt-in request profiling for the Lambda path
+
+Off by default. When a request is profiled, each stage wrapped in
+`stage(name)` is timed, and the breakdown is returned in a `Server-Timing`
+response header (visible in browser dev tools and in API Gateway logs).
+A sampled fraction of profiled requests can also run under a profiler:
+
+    timers   stage timers only (cheap enough to leave on)
+    cprofile deterministic cProfile; writes <request>.prof and a
+             <request>.collapsed file for flamegraph.pl / speedscope
+    sample   statistical sampler walking the request thread's stack every
+             PROFILE_SAMPLE_INTERVAL_MS; writes <request>.collapsed
+
+Switched on for all requests with PROFILE_MODE, or per request with an
+`X-Profile: timers|cprofile|sample` header. The header is ignored unless
+PROFILE_ALLOW_HEADER=1, and when PROFILE_SECRET is set it also needs a
+matching `X-Profile-Key` header, so public clients cannot switch profilers
+on. PROFILE_SAMPLE_RATE (default 0.01) is the fraction of profiled requests
+that get the cprofile/sample treatment; the rest get timers. cProfile is
+process-wide, so a request that asks for it while another request is
+being profiled falls back to timers.
+
+Profiler output is only logged, never returned to the client, and
+PROFILE_OUTPUT_DIR keeps the newest PROFILE_MAX_FILES files.
+
+When profiling is off, `stage()` is a context-variable lookup returning a
+shared no-op context manager.
+"""
+
+import contextvars
+import glob
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'off').lower()
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.01'))
+PROFILE_ALLOW_HEADER = os.environ.get('PROFILE_ALLOW_HEADER', '0') == '1'
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET', '')
+PROFILE_OUTPUT_DIR = os.environ.get('PROFILE_OUTPUT_DIR', '/tmp/profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '50'))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+
+MODES = ('timers', 'cprofile', 'sample')
+PROFILE_HEADER = 'x-profile'
+PROFILE_KEY_HEADER = 'x-profile-key'
+
+# Held while a cProfile profiler is enabled (only one can run per process)
+_cprofile_lock = threading.Lock()
+
+_current = contextvars.ContextVar('request_profile', default=None)
+
+
+class _NullStage:
+    """Shared no-op stage used when the request is not being profiled"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('profile', 'name', 'started')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.record(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def stage(name):
+    """Time a block as a named stage of the current request (no-op when off)"""
+    profile = _current.get()
+    if profile is None:
+        return _NULL_STAGE
+    return _Stage(profile, name)
+
+
+class RequestProfile:
+    """Stage timings (and optional profiler output) for one request"""
+
+    def __init__(self, mode, request_id=None):
+        self.mode = mode
+        self.request_id = request_id or f"{int(time.time() * 1000)}-{random.randrange(1 << 16):04x}"
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        # name -> [total seconds, count]; batch workers record concurrently
+        self._stages = {}
+        self._profiler = None
+        self._sampler = None
+        self._token = None
+
+    def record(self, name, seconds):
+        with self._lock:
+            entry = self._stages.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def breakdown(self):
+        """Return {stage: {'ms': total, 'count': n}} plus the request total"""
+        with self._lock:
+            stages = {name: {'ms': round(total * 1000, 2), 'count': count}
+                      for name, (total, count) in self._stages.items()}
+        stages['total'] = {'ms': round((time.perf_counter() - self.started) * 1000, 2), 'count': 1}
+        return stages
+
+    def server_timing(self):
+        """Format the breakdown as a Server-Timing header value"""
+        return ', '.join(
+            f"{name};dur={entry['ms']}" + (f';desc="x{entry["count"]}"' if entry['count'] > 1 else '')
+            for name, entry in self.breakdown().items()
+        )
+
+    def start(self):
+        self._token = _current.set(self)
+        if self.mode == 'cprofile':
+            if not _cprofile_lock.acquire(blocking=False):
+                self.mode = 'timers'
+                return
+            import cProfile
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError:
+                # Another profiler (outside this module) is active
+                _cprofile_lock.release()
+                self._profiler = None
+                self.mode = 'timers'
+        elif self.mode == 'sample':
+            self._sampler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL_MS / 1000.0)
+            self._sampler.start()
+
+    def stop(self):
+        """Stop profilers, write their output and return the written paths"""
+        paths = []
+        if self._profiler is not None:
+            self._profiler.disable()
+            _cprofile_lock.release()
+            paths = self._write_cprofile()
+            self._profiler = None
+        elif self._sampler is not None:
+            self._sampler.stop()
+            paths = [self._write_collapsed(self._sampler.stacks)]
+            self._sampler = None
+        if self._token is not None:
+            _current.reset(self._token)
+            self._token = None
+        if paths:
+            _prune_output_dir()
+        return paths
+
+    def _output_path(self, suffix):
+        os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+        return os.path.join(PROFILE_OUTPUT_DIR, f"{self.request_id}{suffix}")
+
+    def _write_collapsed(self, stacks):
+        path = self._output_path('.collapsed')
+        with open(path, 'w') as f:
+            for frames, count in stacks.most_common():
+                f.write(f"{frames} {count}\n")
+        return path
+
+    def _write_cprofile(self):
+        import pstats
+        prof_path = self._output_path('.prof')
+        self._profiler.dump_stats(prof_path)
+        return [prof_path, self._write_collapsed(collapse_pstats(pstats.Stats(self._profiler)))]
+
+
+def _prune_output_dir(max_files=None):
+    """Delete the oldest profiler output beyond PROFILE_MAX_FILES"""
+    max_files = PROFILE_MAX_FILES if max_files is None else max_files
+    paths = glob.glob(os.path.join(glob.escape(PROFILE_OUTPUT_DIR), '*.prof'))
+    paths += glob.glob(os.path.join(glob.escape(PROFILE_OUTPUT_DIR), '*.collapsed'))
+    if len(paths) <= max_files:
+        return
+    for path in sorted(paths, key=os.path.getmtime)[:len(paths) - max_files]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval into collapsed stacks"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = max(0.001, interval)
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                frames.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if frames:
+                self.stacks[';'.join(reversed(frames))] += 1
+
+
+def collapse_pstats(stats, scale=1_000_000):
+    """
+    Approximate collapsed stacks from cProfile's caller graph
+
+    cProfile records caller -> callee edges rather than full stacks, so each
+    function's own time is attributed to its heaviest caller chain. Weights
+    are microseconds of self time.
+    """
+    entries = stats.stats
+    collapsed = Counter()
+    for func, (_cc, _nc, self_time, _cum, callers) in entries.items():
+        weight = int(self_time * scale)
+        if weight <= 0:
+            continue
+        chain = [func]
+        seen = {func}
+        current = func
+        while True:
+            callers_of = entries.get(current, (None, None, None, None, {}))[4]
+            if not callers_of:
+                break
+            parent = max(callers_of, key=lambda c: callers_of[c][3])
+            if parent in seen:
+                break
+            chain.append(parent)
+            seen.add(parent)
+            current = parent
+        collapsed[';'.join(f"{os.path.basename(f[0])}:{f[2]}" for f in reversed(chain))] += weight
+    return collapsed
+
+
+def _requested_mode(event):
+    if not PROFILE_ALLOW_HEADER:
+        return PROFILE_MODE
+    headers = {name.lower(): value for name, value in ((event or {}).get('headers') or {}).items()}
+    value = headers.get(PROFILE_HEADER)
+    if not value:
+        return PROFILE_MODE
+    if PROFILE_SECRET and not hmac.compare_digest(headers.get(PROFILE_KEY_HEADER) or '', PROFILE_SECRET):
+        return PROFILE_MODE
+    value = value.strip().lower()
+    return 'timers' if value in ('1', 'true', 'on') else value
+
+
+def start_request(event, request_id=None):
+    """
+    Begin profiling a request if it is switched on
+
+    Returns:
+        RequestProfile: The active profile, or None when profiling is off
+    """
+    mode = _requested_mode(event)
+    if mode not in MODES:
+        return None
+    if mode != 'timers' and random.random() >= PROFILE_SAMPLE_RATE:
+        mode = 'timers'
+    profile = RequestProfile(mode, request_id)
+    profile.start()
+    return profile
+
+
+def finish_request(profile, response):
+    """Stop the profile and add the timing headers to a Lambda response"""
+    paths = profile.stop()
+    headers = dict(response.get('headers') or {})
+    headers['Server-Timing'] = profile.server_timing()
+    headers['X-Profile-Mode'] = profile.mode
+    if paths:
+        # Logged only: file paths are not for the client
+        print(f"Profile written: {', '.join(paths)}")
+    return dict(response, headers=headers)
@@ -0,0 +1,454 @@
+"""
+Buffered query log for analytics, cache warming and replay
+
+Every request is appended to a JSONL log (one object per line, the format
+warm_cache.py ranks and benchmark.py --replay feeds back):
+
+    {"ts": 1760870400.123, "request_id": "...", "query": "...", "verdict": "answered",
+     "status": 200, "latency_ms": 812.4, "sources": ["s3://..."]}
+
+Batch requests log one record with a "queries" list of {query, verdict,
+sources}. Verdicts: answered, fast_path, cached, rejected, throttled, error.
+Answered queries also get an output_tokens estimate, which token_policy.py
+learns answer budgets from.
+
+Logging never adds I/O to a request. log_request only appends the raw
+request and response bodies to an in-memory ring buffer; a background
+thread parses them into records and writes them in batches when
+QUERY_LOG_FLUSH_RECORDS are buffered or every QUERY_LOG_FLUSH_SECONDS. When
+the buffer is full the record is dropped and counted, never waited for.
+
+Configuration:
+    QUERY_LOG_PATH            Log file, e.g. /tmp/query-log/queries.jsonl
+    QUERY_LOG_S3_URI          s3://bucket/prefix/ to ship every flushed batch to S3 as a
+                              gzipped object (logging is off when neither is set)
+    QUERY_LOG_BUFFER          Ring buffer capacity in records (default 10000)
+    QUERY_LOG_FLUSH_RECORDS   Buffered records that trigger a flush (default 500)
+    QUERY_LOG_FLUSH_SECONDS   Maximum time between flushes (default 2)
+    QUERY_LOG_COMPRESS        1 to gzip the log (each flush is one gzip member)
+    QUERY_LOG_MAX_BYTES       Rotate the active file past this size (default 64 MB)
+    QUERY_LOG_MAX_FILES       Rotated files kept (default 10)
+    QUERY_LOG_SYNC_FLUSH      1 to write due batches on the request path (default 0)
+
+In Lambda, /tmp disappears with the container, the flush thread is frozen
+between invocations and atexit does not run at shutdown, so a local file
+alone loses records. Set QUERY_LOG_S3_URI there: batches land under
+<prefix>YYYY/MM/DD/HH/ where warm_cache.py (QUERY_LOG_PATHS) and read_log
+can read them. lambda_handler calls wake_query_logger() as each invocation
+starts: the flush thread thaws with the container and ships whatever was
+due while the request waits on Bedrock, so no request waits for S3. Records
+buffered since the last flush are lost when an idle container is
+reclaimed. QUERY_LOG_SYNC_FLUSH=1 trades that loss for latency: the request
+that finds a flush due writes the batch itself before returning (at most
+one S3 write per QUERY_LOG_FLUSH_SECONDS per container).
+"""
+
+import atexit
+import glob
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from admission import estimate_tokens
+from model_router import DEFAULT_REGION
+from results import dumps
+
+QUERY_LOG_PATH = os.environ.get('QUERY_LOG_PATH', '')
+QUERY_LOG_BUFFER = int(os.environ.get('QUERY_LOG_BUFFER', '10000'))
+QUERY_LOG_FLUSH_RECORDS = int(os.environ.get('QUERY_LOG_FLUSH_RECORDS', '500'))
+QUERY_LOG_FLUSH_SECONDS = float(os.environ.get('QUERY_LOG_FLUSH_SECONDS', '2'))
+QUERY_LOG_COMPRESS = os.environ.get('QUERY_LOG_COMPRESS', '0').lower() in ('1', 'true', 'yes')
+QUERY_LOG_MAX_BYTES = int(os.environ.get('QUERY_LOG_MAX_BYTES', str(64 * 1024 * 1024)))
+QUERY_LOG_MAX_FILES = int(os.environ.get('QUERY_LOG_MAX_FILES', '10'))
+QUERY_LOG_S3_URI = os.environ.get('QUERY_LOG_S3_URI', '')
+QUERY_LOG_SYNC_FLUSH = os.environ.get('QUERY_LOG_SYNC_FLUSH', '0').lower() in ('1', 'true', 'yes')
+
+_STATUS_VERDICTS = {400: 'rejected', 429: 'throttled'}
+
+
+def _verdict(status, result):
+    if status == 200:
+        if result.get('fastPath'):
+            return 'fast_path'
+        if result.get('cached'):
+            return 'cached'
+        return 'answered'
+    return _STATUS_VERDICTS.get(status, 'error')
+
+
+def _with_output_tokens(entry, result):
+    if entry['verdict'] == 'answered' and isinstance(result.get('answer'), str):
+        entry['output_tokens'] = estimate_tokens(result['answer'])
+    return entry
+
+
+def _item_verdict(item):
+    if item['status'] == 'ok':
+        return _verdict(200, item)
+    return item['status']
+
+
+def build_record(ts, request_id, request_body, status, response_body, latency_ms):
+    """
+    Turn a raw request/response pair into a log record
+
+    Runs on the flush thread, so the JSON parsing stays off the request path.
+    """
+    record = {'ts': round(ts, 3), 'request_id': request_id, 'status': status,
+              'latency_ms': round(latency_ms, 1)}
+    try:
+        request = json.loads(request_body or '{}')
+    except ValueError:
+        request = {}
+    try:
+        result = json.loads(response_body or '{}')
+    except ValueError:
+        result = {}
+    if not isinstance(request, dict):
+        request = {}
+
+    record['verdict'] = _verdict(status, result)
+    if 'queries' in request:
+        items = result.get('results')
+        if items is None:
+            # The whole batch failed; log the requested queries with its verdict
+            items = [{'query': q if isinstance(q, str) else q.get('query', '')}
+                     for q in request.get('queries') or [] if isinstance(q, (str, dict))]
+        record['queries'] = [_with_output_tokens({
+            'query': item.get('query', ''),
+            'verdict': _item_verdict(item) if 'status' in item else record['verdict'],
+            'sources': item.get('sources') or [],
+        }, item) for item in items]
+        return record
+
+    record['query'] = request.get('query', '') if isinstance(request.get('query'), str) else ''
+    record['sources'] = result.get('sources') or []
+    if request.get('sessionKey'):
+        record['session'] = True
+    return _with_output_tokens(record, result)
+
+
+def _split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class S3BatchSink:
+    """Writes each flushed batch as one gzipped JSONL object under a prefix"""
+
+    def __init__(self, uri, s3_client=None):
+        self.bucket, self.prefix = _split_s3_uri(uri)
+        if self.prefix and not self.prefix.endswith('/'):
+            self.prefix += '/'
+        self._client = s3_client
+        # Distinguishes the objects of concurrent containers/processes
+        self._writer = uuid.uuid4().hex[:12]
+        self._seq = 0
+
+    def _s3(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3', region_name=DEFAULT_REGION)
+        return self._client
+
+    def write(self, data):
+        """Upload one batch; returns the object URI"""
+        now = time.gmtime()
+        self._seq += 1
+        key = (f"{self.prefix}{time.strftime('%Y/%m/%d/%H', now)}/"
+               f"queries-{time.strftime('%Y%m%dT%H%M%S', now)}-{self._writer}-{self._seq:06d}.jsonl.gz")
+        self._s3().put_object(Bucket=self.bucket, Key=key, Body=gzip.compress(data, compresslevel=6),
+                              ContentType='application/x-ndjson', ContentEncoding='gzip')
+        return f"s3://{self.bucket}/{key}"
+
+
+class QueryLogger:
+    """
+    Ring-buffered, batch-flushed JSONL writer
+
+    log() is safe from any thread and never blocks on I/O; writes happen on
+    one daemon thread (or, with sync_flush, on the request that finds a
+    flush due). Batches go to a local file, an S3 prefix, or both.
+    """
+
+    def __init__(self, path=None, capacity=QUERY_LOG_BUFFER, flush_records=QUERY_LOG_FLUSH_RECORDS,
+                 flush_seconds=QUERY_LOG_FLUSH_SECONDS, compress=QUERY_LOG_COMPRESS,
+                 max_bytes=QUERY_LOG_MAX_BYTES, max_files=QUERY_LOG_MAX_FILES, s3_uri=None,
+                 sync_flush=False, s3_client=None):
+        if path and compress and not path.endswith('.gz'):
+            path += '.gz'
+        self.path = path
+        self.s3 = S3BatchSink(s3_uri, s3_client) if s3_uri else None
+        self.sync_flush = sync_flush
+        self._first_buffered_at = None
+        self.capacity = capacity
+        self.flush_records = max(1, flush_records)
+        self.flush_seconds = flush_seconds
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._buffer = deque()
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self.logged = 0
+        self.dropped = 0
+        self.written = 0
+        self.flushes = 0
+        self.rotations = 0
+        self.uploads = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name='query-log', daemon=True)
+        self._thread.start()
+
+    def log(self, *entry):
+        """
+        Buffer one entry (raw build_record arguments or a finished record dict)
+
+        Returns:
+            bool: False if the buffer was full and the entry was dropped
+        """
+        # len/append on a deque are atomic; an occasional overshoot of one
+        # or two records under contention is harmless
+        if len(self._buffer) >= self.capacity or self._closed:
+            self.dropped += 1
+            return False
+        if not self._buffer:
+            self._first_buffered_at = time.monotonic()
+        self._buffer.append(entry)
+        self.logged += 1
+        if len(self._buffer) >= self.flush_records:
+            self._wake.set()
+        return True
+
+    def _flush_due(self):
+        """True when QUERY_LOG_FLUSH_RECORDS are buffered or the oldest record is QUERY_LOG_FLUSH_SECONDS old"""
+        first = self._first_buffered_at
+        if not self._buffer or first is None:
+            return False
+        return len(self._buffer) >= self.flush_records or time.monotonic() - first >= self.flush_seconds
+
+    def wake_if_due(self):
+        """Have the flush thread write now if a flush is due (no I/O on the caller)"""
+        if self._flush_due():
+            self._wake.set()
+
+    def flush_if_due(self):
+        """Flush on the calling thread when a flush is due (sync_flush mode)"""
+        return self.flush() if self._flush_due() else 0
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def _drain(self):
+        entries = []
+        try:
+            while True:
+                entries.append(self._buffer.popleft())
+        except IndexError:
+            pass
+        return entries
+
+    def flush(self):
+        """Write everything buffered so far (called by the flush thread and on close)"""
+        with self._write_lock:
+            entries = self._drain()
+            self._first_buffered_at = time.monotonic() if self._buffer else None
+            if not entries:
+                return 0
+            lines = []
+            for entry in entries:
+                try:
+                    record = entry[0] if len(entry) == 1 else build_record(*entry)
+                    lines.append(dumps(record))
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Warning: Skipping query log record: {str(e)}")
+            data = ('\n'.join(lines) + '\n').encode('utf-8') if lines else b''
+            written = False
+            if self.path:
+                try:
+                    self._write(data)
+                    written = True
+                except OSError as e:
+                    self.errors += 1
+                    print(f"Warning: Query log write failed: {str(e)}")
+            if self.s3 is not None and data:
+                try:
+                    self.s3.write(data)
+                    self.uploads += 1
+                    written = True
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Warning: Query log upload failed: {type(e).__name__} - {str(e)}")
+            if not written:
+                self.dropped += len(lines)
+                return 0
+            self.written += len(lines)
+            self.flushes += 1
+            return len(lines)
+
+    def _write(self, data):
+        if not data:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.compress:
+            data = gzip.compress(data, compresslevel=6)
+        # One write per flush; gzip members concatenate into a valid stream
+        with open(self.path, 'ab') as f:
+            f.write(data)
+            size = f.tell()
+        if size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        base, ext = self._split_ext()
+        rotated = f"{base}-{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{self.rotations}{ext}"
+        os.replace(self.path, rotated)
+        self.rotations += 1
+        old = sorted(glob.glob(f"{glob.escape(base)}-*{ext}"), key=os.path.getmtime)
+        for path in old[:-self.max_files] if self.max_files > 0 else old:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _split_ext(self):
+        for ext in ('.jsonl.gz', '.jsonl', '.gz'):
+            if self.path.endswith(ext):
+                return self.path[:-len(ext)], ext
+        return os.path.splitext(self.path)
+
+    def close(self, timeout=5.0):
+        """Stop the flush thread and write what is left"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            's3': f"s3://{self.s3.bucket}/{self.s3.prefix}" if self.s3 is not None else None,
+            'buffered': len(self._buffer),
+            'logged': self.logged,
+            'written': self.written,
+            'dropped': self.dropped,
+            'flushes': self.flushes,
+            'rotations': self.rotations,
+            'uploads': self.uploads,
+            'errors': self.errors,
+        }
+
+
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_query_logger():
+    """The process-wide logger, or None when neither QUERY_LOG_PATH nor QUERY_LOG_S3_URI is set"""
+    global _logger
+    if _logger is None and (QUERY_LOG_PATH or QUERY_LOG_S3_URI):
+        with _logger_lock:
+            if _logger is None:
+                _logger = QueryLogger(QUERY_LOG_PATH or None, s3_uri=QUERY_LOG_S3_URI or None,
+                                      sync_flush=QUERY_LOG_SYNC_FLUSH)
+                atexit.register(_logger.close)
+    return _logger
+
+
+def wake_query_logger():
+    """
+    Start shipping a due batch in the background (no-op when logging is off)
+
+    Called as a Lambda invocation starts, when the flush thread has just
+    been thawed, so the write overlaps the request instead of delaying it.
+    """
+    logger = _logger
+    if logger is not None:
+        logger.wake_if_due()
+
+
+def log_request(request_id, request_body, response, latency_ms):
+    """
+    Log one handled request (no-op when logging is off)
+
+    Args:
+        request_id (str): Lambda/ASGI request ID, or None
+        request_body (str): Raw request body
+        response (dict): API Gateway style response (statusCode, body)
+        latency_ms (float): Handling time
+    """
+    logger = get_query_logger()
+    if logger is not None:
+        logger.log(time.time(), request_id, request_body, response.get('statusCode'),
+                   response.get('body'), latency_ms)
+        if logger.sync_flush:
+            logger.flush_if_due()
+
+
+def _s3_objects(uri, s3_client):
+    """Keys for an s3:// URI: every object under it when it ends with '/', else the one object"""
+    bucket, key = _split_s3_uri(uri)
+    if key and not key.endswith('/'):
+        return bucket, [key]
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=key):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    return bucket, sorted(keys)
+
+
+def _log_sources(path, s3_client=None):
+    """Yield (name, open function) for a local path or each object of an s3:// URI"""
+    if not path.startswith('s3://'):
+        opener = gzip.open if path.endswith('.gz') else open
+        yield path, lambda: opener(path, 'rt', encoding='utf-8')
+        return
+    if s3_client is None:
+        import boto3
+        s3_client = boto3.client('s3', region_name=DEFAULT_REGION)
+    bucket, keys = _s3_objects(path, s3_client)
+    for key in keys:
+        def open_object(key=key):
+            body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+            raw = gzip.GzipFile(fileobj=body) if key.endswith('.gz') else body
+            return io.TextIOWrapper(raw, encoding='utf-8')
+        yield f"s3://{bucket}/{key}", open_object
+
+
+def read_log(paths, s3_client=None):
+    """
+    Yield records from query logs (plain or gzipped, rotated files included)
+
+    Paths may be local files or s3:// URIs; a URI ending in '/' reads every
+    object under that prefix (the batches QUERY_LOG_S3_URI writes). A partly
+    written trailing line or gzip member from a crash ends that file's
+    records instead of raising.
+    """
+    for path in paths:
+        for name, open_log in _log_sources(path, s3_client):
+            try:
+                with open_log() as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            continue
+            except (EOFError, gzip.BadGzipFile) as e:
+                print(f"Warning: {name} ends early: {str(e)}")
@@ -0,0 +1,165 @@
+"""
+Compact result objects for retrieval and answer generation
+
+Chunk, Citation and Answer use __slots__ to keep per-object overhead low
+when responses carry many references. A chunk cited several times in one
+answer is held once (see Answer.from_retrieve_and_generate), and
+a Citation keeps span offsets into the answer text instead of a copy of the
+cited part. Source URIs are deduplicated in first-seen order.
+"""
+
+import json
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """
+    Serialize a response body to a JSON string
+
+    Uses orjson when it is installed, otherwise the stdlib encoder with
+    compact separators.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, check_circular=False)
+
+
+def _s3_uri(location):
+    return (location or {}).get('s3Location', {}).get('uri', '')
+
+
+class Chunk:
+    """A retrieved chunk of a source document"""
+
+    __slots__ = ('text', 'uri', 'score', 'metadata')
+
+    def __init__(self, text, uri, score=None, metadata=None):
+        self.text = text or ''
+        # Only URIs are interned: there are few of them and they repeat
+        # across every query, while chunk text is unbounded in a long-running
+        # server and interned strings are never freed
+        self.uri = sys.intern(uri) if uri else ''
+        self.score = score
+        self.metadata = metadata
+
+    @classmethod
+    def from_result(cls, result):
+        """Build a Chunk from a retrieve() result or a retrievedReference"""
+        return cls(
+            result.get('content', {}).get('text', ''),
+            _s3_uri(result.get('location')),
+            result.get('score'),
+            result.get('metadata')
+        )
+
+    def to_dict(self, include_text=True):
+        data = {'uri': self.uri, 'score': self.score}
+        if include_text:
+            data['text'] = self.text
+        if self.metadata:
+            data['metadata'] = self.metadata
+        return data
+
+    def __repr__(self):
+        return f"Chunk(uri={self.uri!r}, score={self.score!r}, text={self.text[:40]!r})"
+
+
+class Citation:
+    """A span of the answer and the chunks that support it"""
+
+    __slots__ = ('_answer_text', 'start', 'end', 'chunks')
+
+    def __init__(self, answer_text, start, end, chunks):
+        self._answer_text = answer_text
+        self.start = start
+        self.end = end
+        self.chunks = chunks
+
+    @property
+    def text(self):
+        """The cited part of the answer (sliced on demand)"""
+        return self._answer_text[self.start:self.end + 1]
+
+    @property
+    def sources(self):
+        return list(dict.fromkeys(chunk.uri for chunk in self.chunks if chunk.uri))
+
+    def to_dict(self, include_text=False):
+        return {
+            'span': [self.start, self.end],
+            'sources': self.sources,
+            'chunks': [chunk.to_dict(include_text) for chunk in self.chunks],
+        }
+
+
+class Answer:
+    """A generated answer with ordered citations"""
+
+    __slots__ = ('text', 'citations', 'session_id')
+
+    def __init__(self, text, citations=(), session_id=None):
+        self.text = text
+        self.citations = list(citations)
+        self.session_id = session_id
+
+    @classmethod
+    def from_retrieve_and_generate(cls, response):
+        """
+        Build an Answer from a retrieve_and_generate response
+
+        Identical references (same URI and chunk text) share one Chunk.
+        """
+        text = response.get('output', {}).get('text', '')
+        chunks_by_key = {}
+        citations = []
+        for citation in response.get('citations', []):
+            part = citation.get('generatedResponsePart', {}).get('textResponsePart', {})
+            span = part.get('span', {})
+            start = span.get('start', 0)
+            end = span.get('end', len(text) - 1)
+            chunks = []
+            for reference in citation.get('retrievedReferences', []):
+                key = (_s3_uri(reference.get('location')), reference.get('content', {}).get('text', ''))
+                chunk = chunks_by_key.get(key)
+                if chunk is None:
+                    chunk = Chunk.from_result(reference)
+                    chunks_by_key[key] = chunk
+                chunks.append(chunk)
+            citations.append(Citation(text, start, end, chunks))
+        return cls(text, citations, response.get('sessionId'))
+
+    @property
+    def sources(self):
+        """Source URIs in citation order, without duplicates"""
+        return list(dict.fromkeys(
+            chunk.uri
+            for citation in self.citations
+            for chunk in citation.chunks
+            if chunk.uri
+        ))
+
+    def to_dict(self, include_chunk_text=False):
+        """
+        Plain-dict form used by query_with_sources and lambda_handler
+
+        Chunk text is left out by default; the sources and spans are what
+        clients render, and the text dominates the payload size.
+        """
+        data = {
+            'answer': self.text,
+            'sources': self.sources,
+            'citations': [c.to_dict(include_chunk_text) for c in self.citations],
+        }
+        if self.session_id:
+            data['sessionId'] = self.session_id
+        return data
+
+
+def chunks_from_results(results):
+    """Convert a retrieve() results list into Chunk objects"""
+    return [Chunk.from_result(result) for result in results]
@@ -0,0 +1,262 @@
+"""
+Retrieval result cache for query_knowledge_base
+
+Caches `retrievalResults` keyed by normalized query, KB ID and search
+configuration (number of results, search type, metadata filter). Entries
+are tagged with the KB content version (the latest completed ingestion job)
+and become stale as soon as the KB is re-synced, instead of expiring on a
+blind TTL.
+
+Chunk text is stored once in a shared, reference-counted chunk store; each
+entry only keeps chunk IDs plus the small per-hit fields (score, location,
+metadata). The whole cache is bounded by an approximate byte budget.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+
+from model_router import DEFAULT_REGION
+from single_flight import normalize_query
+
+DEFAULT_MAX_BYTES = int(os.environ.get('RETRIEVAL_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# How often the KB version token is re-read from the ingestion job history
+VERSION_CHECK_SECONDS = float(os.environ.get('KB_VERSION_CHECK_SECONDS', '60'))
+
+# Fixed per-entry overhead estimate (key, list, dict bookkeeping)
+_ENTRY_OVERHEAD_BYTES = 200
+
+_bedrock_agent = {}
+_bedrock_agent_lock = threading.Lock()
+# KB ID -> region for knowledge bases outside DEFAULT_REGION (see fanout.py)
+_kb_regions = {}
+
+
+def register_kb_region(kb_id, region):
+    """Record the region of a KB so its ingestion jobs are read from there"""
+    _kb_regions[kb_id] = region
+
+
+def _agent_client(region=None):
+    region = region or DEFAULT_REGION
+    with _bedrock_agent_lock:
+        client = _bedrock_agent.get(region)
+        if client is None:
+            client = _bedrock_agent[region] = boto3.client('bedrock-agent', region_name=region)
+    return client
+
+
+def latest_ingestion_job_id(kb_id):
+    """
+    Look up the KB content version: the newest completed ingestion job ID
+
+    Args:
+        kb_id (str): Knowledge Base ID
+
+    Returns:
+        str: Ingestion job ID (or data source IDs joined with job IDs when the
+             KB has several data sources), or None if it cannot be determined
+    """
+    try:
+        client = _agent_client(_kb_regions.get(kb_id))
+        data_sources = client.list_data_sources(knowledgeBaseId=kb_id).get('dataSourceSummaries', [])
+        tokens = []
+        for data_source in sorted(data_sources, key=lambda d: d['dataSourceId']):
+            jobs = client.list_ingestion_jobs(
+                knowledgeBaseId=kb_id,
+                dataSourceId=data_source['dataSourceId'],
+                filters=[{'attribute': 'STATUS', 'operator': 'EQ', 'values': ['COMPLETE']}],
+                sortBy={'attribute': 'STARTED_AT', 'order': 'DESCENDING'},
+                maxResults=1
+            ).get('ingestionJobSummaries', [])
+            if jobs:
+                tokens.append(f"{data_source['dataSourceId']}:{jobs[0]['ingestionJobId']}")
+        return '|'.join(tokens) or None
+    except ClientError as e:
+        print(f"Warning: Could not read KB version: {e.response['Error']['Code']}")
+        return None
+    except Exception as e:
+        print(f"Warning: Could not read KB version: {type(e).__name__} - {str(e)}")
+        return None
+
+
+def chunk_id(text):
+    """Content-derived chunk ID used as the shared chunk store key"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:20]
+
+
+class RetrievalCache:
+    """Byte-bounded LRU cache of retrieval results with KB-version invalidation"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, version_fn=latest_ingestion_job_id,
+                 version_check_seconds=VERSION_CHECK_SECONDS):
+        self.max_bytes = max_bytes
+        self.version_check_seconds = version_check_seconds
+        self._version_fn = version_fn
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._chunks = {}
+        self._versions = {}
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---- KB version tracking ----
+
+    def kb_version(self, kb_id):
+        """Current content version for a KB, refreshed at most every version_check_seconds"""
+        override = os.environ.get('KB_VERSION')
+        if override:
+            return override
+
+        now = time.monotonic()
+        with self._lock:
+            cached = self._versions.get(kb_id)
+            if cached and now - cached[1] < self.version_check_seconds:
+                return cached[0]
+
+        version = self._version_fn(kb_id) if self._version_fn else None
+        if version is None and cached:
+            # Keep the last known version rather than dropping the cache on a lookup error
+            version = cached[0]
+        self.set_version(kb_id, version)
+        return version
+
+    def set_version(self, kb_id, version):
+        """
+        Record a KB's content version, dropping entries from older versions
+
+        Call this from the ingestion-completed hook to invalidate immediately.
+        """
+        with self._lock:
+            previous = self._versions.get(kb_id)
+            self._versions[kb_id] = (version, time.monotonic())
+            if previous and previous[0] != version:
+                for key in [k for k, e in self._entries.items() if k[0] == kb_id]:
+                    self._remove(key)
+
+    def set_version_fn(self, version_fn):
+        """Replace the KB version lookup and forget cached version tokens"""
+        with self._lock:
+            self._version_fn = version_fn
+            self._versions.clear()
+
+    def invalidate(self, kb_id=None):
+        """Drop all entries (or those for one KB) and forget the version token"""
+        with self._lock:
+            for key in [k for k in self._entries if kb_id is None or k[0] == kb_id]:
+                self._remove(key)
+            if kb_id is None:
+                self._versions.clear()
+            else:
+                self._versions.pop(kb_id, None)
+
+    # ---- get / put ----
+
+    @staticmethod
+    def make_key(query, kb_id, number_of_results, search_type, metadata_filter=None):
+        filter_key = json.dumps(metadata_filter, sort_keys=True) if metadata_filter else ''
+        return (kb_id, normalize_query(query), number_of_results, search_type or '', filter_key)
+
+    def get(self, query, kb_id, number_of_results, search_type, metadata_filter=None):
+        """
+        Return cached retrieval results as fresh dicts, or None on a miss
+        """
+        version = self.kb_version(kb_id)
+        if version is None:
+            return None
+
+        key = self.make_key(query, kb_id, number_of_results, search_type, metadata_filter)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['version'] != version:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return [self._expand(hit) for hit in entry['hits']]
+
+    def put(self, query, kb_id, number_of_results, search_type, results, metadata_filter=None):
+        """Store retrieval results for the current KB version"""
+        version = self.kb_version(kb_id)
+        if version is None:
+            return
+
+        hits = []
+        texts = {}
+        entry_bytes = _ENTRY_OVERHEAD_BYTES
+        for result in results:
+            text = result.get('content', {}).get('text', '')
+            cid = chunk_id(text)
+            texts[cid] = text
+            extra = {k: v for k, v in result.items() if k != 'content'}
+            extra_json = json.dumps(extra, default=str)
+            hits.append((cid, extra_json))
+            entry_bytes += len(cid) + len(extra_json)
+
+        key = self.make_key(query, kb_id, number_of_results, search_type, metadata_filter)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            for cid, text in texts.items():
+                chunk = self._chunks.get(cid)
+                if chunk is None:
+                    size = len(text.encode('utf-8'))
+                    self._chunks[cid] = [text, 0, size]
+                    self.bytes_used += size
+                    chunk = self._chunks[cid]
+                chunk[1] += 1
+            self._entries[key] = {
+                'version': version,
+                'hits': hits,
+                'chunk_ids': list(texts),
+                'bytes': entry_bytes,
+            }
+            self.bytes_used += entry_bytes
+            while self.bytes_used > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+            if self.bytes_used > self.max_bytes:
+                # A single entry larger than the budget is not worth keeping
+                self._remove(key)
+
+    # ---- internals (call with lock held) ----
+
+    def _expand(self, hit):
+        cid, extra_json = hit
+        result = json.loads(extra_json)
+        result['content'] = {'text': self._chunks[cid][0]}
+        return result
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes_used -= entry['bytes']
+        for cid in entry['chunk_ids']:
+            chunk = self._chunks[cid]
+            chunk[1] -= 1
+            if chunk[1] == 0:
+                self.bytes_used -= chunk[2]
+                del self._chunks[cid]
+
+    def stats(self):
+        """Return hit/miss counters and memory usage"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'chunks': len(self._chunks),
+                'bytes_used': self.bytes_used,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+ASGI server mode
+
+Runs the same pipeline as lambda_handler as a long-lived service, so the
+Bedrock clients (and their keep-alive connection pools), the retrieval and
+answer caches, the spec index, sessions and single-flight coalescing stay
+warm across requests instead of being rebuilt per container.
+
+Endpoints:
+    POST /query          same request and response bodies as the Lambda
+                         (single query or {"queries": [...]} batch)
+    POST /query/stream   Server-Sent Events: text deltas, citations, done
+    GET  /query/stream   same, with ?query=...&sessionKey=... (EventSource)
+    GET  /health         liveness: 200 while the process is up
+    GET  /ready          readiness: 200 once warmed, 503 while draining
+    POST /drain          stop accepting work (e.g. from a preStop hook)
+    GET  /stats          route, cache, coalescing and admission counters
+
+Blocking Bedrock calls run on a bounded thread pool (SERVER_WORKERS); the
+event loop only parses, routes and streams. On shutdown, or after /drain,
+readiness turns 503, new requests are refused with 503, and in-flight
+requests get up to SERVER_DRAIN_SECONDS to finish.
+
+Usage:
+    pip install uvicorn
+    uvicorn server:app --host 0.0.0.0 --port 8080
+    python server.py --offline --port 8080      # against the Bedrock stand-in
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '64'))
+SERVER_DRAIN_SECONDS = float(os.environ.get('SERVER_DRAIN_SECONDS', '25'))
+MAX_BODY_BYTES = int(os.environ.get('SERVER_MAX_BODY_BYTES', str(1024 * 1024)))
+
+# One pooled connection per worker thread, set before the clients are built
+os.environ.setdefault('BEDROCK_MAX_POOL_CONNECTIONS', str(SERVER_WORKERS))
+
+import bedrock_utils  # noqa: E402
+import lambda_function  # noqa: E402
+from admission import AdmissionRejected, get_admission_controller  # noqa: E402
+from fanout import configured_targets, shared_answer_from_targets  # noqa: E402
+from query_log import get_query_logger, log_request  # noqa: E402
+from results import dumps  # noqa: E402
+from session_store import get_session_store  # noqa: E402
+from spec_index import answer_from_spec_index, get_spec_index  # noqa: E402
+from token_policy import get_token_policy  # noqa: E402
+
+JSON_HEADERS = [(b'content-type', b'application/json')]
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+]
+
+
+def sse_event(event, data):
+    """Encode one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+class App:
+    """ASGI application wrapping the lambda_function pipeline"""
+
+    def __init__(self, workers=SERVER_WORKERS, drain_seconds=SERVER_DRAIN_SECONDS):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='server')
+        self.drain_seconds = drain_seconds
+        self.ready = False
+        self.draining = False
+        self.in_flight = 0
+        self.started_at = time.time()
+        self._idle = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    # ---- lifecycle ----
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        """Load the spec index and answer cache snapshot before reporting ready"""
+        loop = asyncio.get_running_loop()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        knowledge_base_id, _ = lambda_function._kb_config()
+        await loop.run_in_executor(self.executor, get_spec_index)
+        if knowledge_base_id:
+            await loop.run_in_executor(self.executor, bedrock_utils._ensure_answer_snapshot, knowledge_base_id)
+        self.ready = True
+        print(f"✓ Server ready ({self.workers} workers)")
+
+    def drain(self):
+        """Stop taking new requests; readiness reports 503 from now on"""
+        if not self.draining:
+            print(f"Draining: {self.in_flight} requests in flight")
+        self.draining = True
+
+    async def shutdown(self):
+        """Drain, wait for in-flight requests (bounded), then stop the workers"""
+        self.drain()
+        if self._idle is not None and self.in_flight:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=self.drain_seconds)
+            except asyncio.TimeoutError:
+                print(f"Warning: Shutting down with {self.in_flight} requests still in flight")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if get_query_logger() is not None:
+            get_query_logger().close()
+
+    def _enter(self):
+        self.in_flight += 1
+        self._idle.clear()
+
+    def _exit(self):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self._idle.set()
+
+    # ---- HTTP ----
+
+    async def _http(self, scope, receive, send):
+        method, path = scope['method'], scope['path'].rstrip('/') or '/'
+
+        if path == '/health':
+            return await self._json(send, 200, {'status': 'ok', 'uptime_s': round(time.time() - self.started_at)})
+        if path == '/ready':
+            ok = self.ready and not self.draining
+            return await self._json(send, 200 if ok else 503,
+                                    {'ready': ok, 'draining': self.draining, 'in_flight': self.in_flight})
+        if path == '/stats' and method == 'GET':
+            return await self._json(send, 200, self.stats())
+        if path == '/drain' and method == 'POST':
+            self.drain()
+            return await self._json(send, 202, {'draining': True, 'in_flight': self.in_flight})
+
+        if path not in ('/query', '/query/stream'):
+            return await self._json(send, 404, {'error': 'Not found'})
+        if self.draining or not self.ready:
+            return await self._json(send, 503, {'error': 'Server is not accepting requests'},
+                                    extra_headers=[(b'connection', b'close'), (b'retry-after', b'1')])
+
+        self._enter()
+        try:
+            if path == '/query' and method == 'POST':
+                await self._query(scope, receive, send)
+            elif path == '/query/stream' and method in ('GET', 'POST'):
+                await self._stream(scope, receive, send)
+            else:
+                await self._json(send, 405, {'error': 'Method not allowed'})
+        finally:
+            self._exit()
+
+    async def _read_body(self, receive):
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                raise ValueError('Request body too large')
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def _json(self, send, status, payload, extra_headers=()):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': JSON_HEADERS + list(extra_headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _query(self, scope, receive, send):
+        try:
+            body = await self._read_body(receive)
+        except ValueError as e:
+            return await self._json(send, 413, {'error': str(e)})
+        if body is None:
+            return
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return await self._json(send, 400, {'error': 'Body must be UTF-8 JSON'})
+        event = {
+            'body': text or '{}',
+            'headers': {k.decode('latin-1'): v.decode('latin-1') for k, v in scope.get('headers', [])},
+        }
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(self.executor, lambda_function.lambda_handler, event, None)
+        headers = [(k.lower().encode('latin-1'), str(v).encode('latin-1'))
+                   for k, v in (response.get('headers') or {}).items()
+                   if k.lower() != 'content-type']
+        body = response.get('body', '')
+        await self._json(send, response['statusCode'],
+                         body.encode('utf-8') if isinstance(body, str) else body, headers)
+
+    async def _stream(self, scope, receive, send):
+        if scope['method'] == 'GET':
+            try:
+                params = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+            except UnicodeDecodeError:
+                return await self._json(send, 400, {'error': 'Query string must be UTF-8'})
+            request = {k: v[0] for k, v in params.items()}
+        else:
+            try:
+                body = await self._read_body(receive)
+                request = json.loads(body or b'{}') if body is not None else None
+            except ValueError as e:
+                return await self._json(send, 400, {'error': str(e)})
+            if request is None:
+                return
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+
+        started = time.perf_counter()
+        outcome = {'statusCode': 500, 'body': ''}
+
+        def push(event):
+            if event is not None and event[0] in ('done', 'error'):
+                outcome['statusCode'] = 200 if event[0] == 'done' else event[1].get('status', 500)
+                outcome['body'] = event[1]
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+        def produce():
+            try:
+                stream_events(request.get('query', ''), request.get('sessionKey'), push, cancelled)
+            except Exception as e:
+                push(('error', {'error': f'Internal server error: {str(e)}'}))
+            finally:
+                push(None)
+            if get_query_logger() is not None:
+                # After the last event, so serializing here costs the client nothing
+                log_request(None, dumps(request), dict(outcome, body=dumps(outcome['body'])),
+                            (time.perf_counter() - started) * 1000.0)
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+        producer = loop.run_in_executor(self.executor, produce)
+        watcher = asyncio.ensure_future(self._watch_disconnect(receive, cancelled))
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if cancelled.is_set():
+                    continue
+                await send({'type': 'http.response.body', 'body': sse_event(*item), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            cancelled.set()
+        finally:
+            watcher.cancel()
+            await producer
+
+    async def _watch_disconnect(self, receive, cancelled):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                cancelled.set()
+                return
+
+    def stats(self):
+        from model_router import route_stats
+        return {
+            'in_flight': self.in_flight,
+            'draining': self.draining,
+            'routes': route_stats.snapshot(),
+            'single_flight': bedrock_utils.inflight.stats(),
+            'retrieval_cache': bedrock_utils.retrieval_cache.stats(),
+            'answer_cache': {'entries': len(bedrock_utils.answer_cache),
+                             'hits': bedrock_utils.answer_cache.hits,
+                             'misses': bedrock_utils.answer_cache.misses},
+            'admission': get_admission_controller().stats(),
+            'query_log': get_query_logger().stats() if get_query_logger() is not None else None,
+            'token_policy': get_token_policy().stats() if get_token_policy() is not None else None,
+        }
+
+
+def stream_events(query, session_key, push, cancelled):
+    """
+    Run the query pipeline, pushing (event, data) pairs as they are ready
+
+    Same order of checks as lambda_handler: spec fast path, answer cache,
+    classification, then a streamed retrieve_and_generate. Spec and cached
+    answers arrive as a single text event, and so do fan-out answers
+    (KB_TARGETS without a sessionKey), which come from one generate call
+    over the merged chunks like the non-streamed path.
+    """
+    query = (query or '').strip()
+    problem = lambda_function._precheck(query)
+    if problem:
+        push(('error', {'error': problem, 'status': 400}))
+        return
+
+    def whole(result, **flags):
+        push(('text', {'text': result['answer']}))
+        push(('done', dict(result, query=query, **flags)))
+
+    spec_answer = answer_from_spec_index(query)
+    if spec_answer is not None:
+        return whole(spec_answer.to_dict(), fastPath=True)
+
+    knowledge_base_id, model_arn = lambda_function._kb_config()
+    if not knowledge_base_id:
+        push(('error', {'error': 'Knowledge base ID not configured', 'status': 500}))
+        return
+    if not session_key:
+        cached = bedrock_utils.get_cached_answer(query, knowledge_base_id, model_arn)
+        if cached is not None:
+            return whole(cached, cached=True)
+
+    try:
+        if not bedrock_utils.shared_valid_prompt(query, os.environ.get('CLASSIFIER_MODEL_ID')):
+            push(('error', {'error': lambda_function.REJECTED_MESSAGE, 'status': 400}))
+            return
+
+        if configured_targets() and not session_key:
+            return whole(shared_answer_from_targets(query, model_arn))
+
+        session_id = get_session_store().get(session_key) if session_key else None
+        events = bedrock_utils.stream_answer(query, knowledge_base_id, model_arn, session_id)
+        try:
+            for event in events:
+                if cancelled.is_set():
+                    return  # client went away; stop reading the Bedrock stream
+                if event['type'] == 'text':
+                    push(('text', {'text': event['text']}))
+                elif event['type'] == 'citation':
+                    push(('citation', event['citation']))
+                else:
+                    answer = event['answer']
+                    result = answer.to_dict()
+                    if session_key and answer.session_id:
+                        get_session_store().put(session_key, answer.session_id)
+                        result['sessionKey'] = session_key
+                    result.pop('sessionId', None)
+                    push(('done', dict(result, query=query)))
+        finally:
+            events.close()
+    except AdmissionRejected as e:
+        push(('error', {'error': 'Too many requests, please retry shortly',
+                        'retryAfter': round(e.retry_after, 1), 'status': 429}))
+
+
+async def call_asgi(app, method, path, body=b'', headers=()):
+    """
+    Issue one in-process request against an ASGI app (used by benchmark.py)
+
+    Returns:
+        tuple: (status, headers, body bytes)
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    path, _, query_string = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string.encode('utf-8'),
+             'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]}
+    sent_body = False
+    done = asyncio.Event()
+    response = {'status': None, 'headers': [], 'body': []}
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = message.get('headers', [])
+        elif message['type'] == 'http.response.body':
+            response['body'].append(message.get('body', b''))
+            if not message.get('more_body'):
+                done.set()
+
+    await app(scope, receive, send)
+    done.set()
+    return response['status'], response['headers'], b''.join(response['body'])
+
+
+app = App()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the query pipeline as an ASGI service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--offline', action='store_true', help="Use the local Bedrock stand-in")
+    args = parser.parse_args(argv)
+
+    try:
+        import uvicorn
+    except ImportError:
+        print("Error: server mode needs an ASGI server: pip install uvicorn")
+        return 1
+
+    if args.offline:
+        import fake_bedrock
+        fake_bedrock.install()
+        os.environ.setdefault('KNOWLEDGE_BASE_ID', 'FAKEKB0001')
+
+    uvicorn.run(app, host=args.host, port=args.port, timeout_graceful_shutdown=int(SERVER_DRAIN_SECONDS))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
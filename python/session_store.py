@@ -0,0 +1,155 @@
+"""
+Conversation session stores
+
+Maps a client-supplied session key to the Bedrock `sessionId` returned by
+retrieve_and_generate, so follow-up questions reuse the server-side
+conversation context. InMemorySessionStore is bounded and evicts sessions
+that have been idle longer than the TTL; DynamoDBSessionStore shares
+sessions across Lambda containers. Any object with get/put/delete can be
+plugged in with set_session_store().
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import boto3
+from botocore.exceptions import ClientError
+
+from model_router import DEFAULT_REGION
+
+SESSION_IDLE_TTL_SECONDS = float(os.environ.get('SESSION_IDLE_TTL_SECONDS', '1800'))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', '10000'))
+
+
+class SessionStore:
+    """Interface for session stores"""
+
+    def get(self, key):
+        """Return the Bedrock sessionId for a key, or None"""
+        raise NotImplementedError
+
+    def put(self, key, session_id):
+        """Remember the Bedrock sessionId for a key"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Forget a key (e.g. when Bedrock reports the session expired)"""
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    """Bounded LRU session store with idle-TTL eviction"""
+
+    def __init__(self, max_entries=SESSION_MAX_ENTRIES, idle_ttl_seconds=SESSION_IDLE_TTL_SECONDS,
+                 clock=time.monotonic):
+        self.max_entries = max_entries
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key):
+        now = self._clock()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._sessions.get(key)
+            if entry is None:
+                return None
+            self._sessions[key] = (entry[0], now)
+            self._sessions.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, session_id):
+        now = self._clock()
+        with self._lock:
+            self._sessions[key] = (session_id, now)
+            self._sessions.move_to_end(key)
+            self._evict_idle(now)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def _evict_idle(self, now):
+        # Entries are kept in last-used order, so idle ones are at the front
+        while self._sessions:
+            key, (_session_id, last_used) = next(iter(self._sessions.items()))
+            if now - last_used <= self.idle_ttl_seconds:
+                break
+            del self._sessions[key]
+            self.evictions += 1
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+class DynamoDBSessionStore(SessionStore):
+    """
+    Session store backed by a DynamoDB table
+
+    The table needs a string partition key named `session_key`; enable
+    DynamoDB TTL on the `expires_at` attribute to expire idle sessions.
+    """
+
+    def __init__(self, table_name, idle_ttl_seconds=SESSION_IDLE_TTL_SECONDS, region_name=DEFAULT_REGION):
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._table = boto3.resource('dynamodb', region_name=region_name).Table(table_name)
+
+    def get(self, key):
+        try:
+            item = self._table.get_item(Key={'session_key': key}).get('Item')
+        except ClientError as e:
+            print(f"Warning: Session lookup failed: {e.response['Error']['Code']}")
+            return None
+        # DynamoDB TTL deletion is lazy, so check expiry ourselves
+        if not item or int(item.get('expires_at', 0)) < time.time():
+            return None
+        return item['session_id']
+
+    def put(self, key, session_id):
+        try:
+            self._table.put_item(Item={
+                'session_key': key,
+                'session_id': session_id,
+                'expires_at': int(time.time() + self.idle_ttl_seconds),
+            })
+        except ClientError as e:
+            print(f"Warning: Session save failed: {e.response['Error']['Code']}")
+
+    def delete(self, key):
+        try:
+            self._table.delete_item(Key={'session_key': key})
+        except ClientError as e:
+            print(f"Warning: Session delete failed: {e.response['Error']['Code']}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    Return the process-wide session store
+
+    Uses DynamoDB when SESSION_TABLE is set, otherwise an in-memory store.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            table_name = os.environ.get('SESSION_TABLE')
+            _store = DynamoDBSessionStore(table_name) if table_name else InMemorySessionStore()
+        return _store
+
+
+def set_session_store(store):
+    """Replace the process-wide session store"""
+    global _store
+    with _store_lock:
+        _store = store
@@ -0,0 +1,140 @@
+"""
+Single-flight request coalescing
+
+Concurrent callers asking for the same key share one in-flight call instead
+of each hitting Bedrock. Works for both threads (do) and asyncio (do_async).
+The result object is shared between all waiters, so callers must treat it as
+read-only.
+"""
+
+import asyncio
+import threading
+
+
+def normalize_query(query):
+    """Normalize a query for keying: trim, lowercase and collapse whitespace"""
+    return ' '.join((query or '').lower().split())
+
+
+def make_key(operation, query, *ids):
+    """
+    Build a coalescing key
+
+    Args:
+        operation (str): Name of the call being coalesced
+        query (str): User query (normalized before keying)
+        *ids: KB IDs, model IDs or other parameters that change the result
+
+    Returns:
+        tuple: Hashable key
+    """
+    return (operation, normalize_query(query)) + tuple(str(i) for i in ids)
+
+
+class _Call:
+    """A thread-based in-flight call"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls into one execution"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) once per key among concurrent threads
+
+        The first caller executes the function; callers arriving while it
+        runs block and receive the same result. Exceptions raised by the
+        function are re-raised in every waiting caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, coro_fn, *args, **kwargs):
+        """
+        Await coro_fn(*args, **kwargs) once per key among concurrent tasks
+
+        The shared call runs as its own task. A waiter that is cancelled only
+        stops waiting; the shared task is cancelled once every waiter has
+        gone away, so one disconnecting client cannot fail the others.
+        """
+        loop = asyncio.get_running_loop()
+        async_key = (id(loop), key)
+        with self._lock:
+            entry = self._async_calls.get(async_key)
+            if entry is not None:
+                entry['waiters'] += 1
+                self.coalesced += 1
+            else:
+                task = loop.create_task(coro_fn(*args, **kwargs))
+                entry = {'task': task, 'waiters': 1}
+                self._async_calls[async_key] = entry
+                self.executed += 1
+                task.add_done_callback(lambda _t: self._forget_async(async_key, entry))
+
+        try:
+            return await asyncio.shield(entry['task'])
+        except asyncio.CancelledError:
+            with self._lock:
+                entry['waiters'] -= 1
+                abandoned = entry['waiters'] == 0
+            if abandoned:
+                entry['task'].cancel()
+            raise
+
+    def _forget_async(self, async_key, entry):
+        with self._lock:
+            if self._async_calls.get(async_key) is entry:
+                del self._async_calls[async_key]
+
+    def in_flight(self):
+        """Number of distinct calls currently executing"""
+        with self._lock:
+            return len(self._calls) + len(self._async_calls)
+
+    def stats(self):
+        """Return execution and coalescing counters"""
+        with self._lock:
+            return {
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls) + len(self._async_calls),
+            }
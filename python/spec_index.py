@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Structured spec-line index for instant numeric lookups
+
+At ingestion time, spec lines such as
+
+    Excavators:
+    - Bucket capacity: 0.5-3.0 cubic meters
+
+are parsed into typed (equipment, attribute, value range, unit) entries with
+units normalized (kg, hp, m, m3, psi). At query time, a question that is
+only a lookup of one indexed attribute of one equipment type ("bucket
+capacity of excavators") is answered straight from the index with a
+citation, skipping classification, retrieval and generation.
+
+Usage:
+    python spec_index.py build ../spec-sheets --uri-prefix s3://my-bucket/ --output spec_index.json
+    python spec_index.py query "What is the bucket capacity of an excavator?"
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+from facets import EQUIPMENT_TYPES, detect_query_facets
+from results import Answer, Chunk, Citation
+
+DEFAULT_INDEX_PATH = os.environ.get(
+    'SPEC_INDEX_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spec_index.json')
+)
+
+# Unit phrase -> (canonical unit, multiplier to canonical)
+UNIT_ALIASES = {
+    'kg': ('kg', 1.0), 'kilograms': ('kg', 1.0),
+    't': ('kg', 1000.0), 'tonnes': ('kg', 1000.0), 'tons': ('kg', 907.185), 'metric tons': ('kg', 1000.0),
+    'lb': ('kg', 0.453592), 'lbs': ('kg', 0.453592), 'pounds': ('kg', 0.453592),
+    'hp': ('hp', 1.0), 'horsepower': ('hp', 1.0), 'kw': ('hp', 1.34102),
+    'm': ('m', 1.0), 'meters': ('m', 1.0), 'metres': ('m', 1.0),
+    'ft': ('m', 0.3048), 'feet': ('m', 0.3048),
+    'mm': ('m', 0.001), 'cm': ('m', 0.01), 'in': ('m', 0.0254), 'inches': ('m', 0.0254),
+    'm3': ('m3', 1.0), 'm³': ('m3', 1.0), 'cubic meters': ('m3', 1.0), 'cubic metres': ('m3', 1.0),
+    'yd3': ('m3', 0.764555), 'cubic yards': ('m3', 0.764555),
+    'psi': ('psi', 1.0), 'kpa': ('psi', 0.145038), 'bar': ('psi', 14.5038),
+}
+
+_SECTION_RE = re.compile(r'^\s*([A-Za-z][A-Za-z /&-]*):\s*$')
+_SPEC_LINE_RE = re.compile(r'^\s*[-*•]\s*([^:]+):\s*(.+?)\s*$')
+_VALUE_RE = re.compile(
+    r'(?P<low>\d[\d,]*(?:\.\d+)?)\s*(?:(?:-|–|to)\s*(?P<high>\d[\d,]*(?:\.\d+)?))?\s*(?P<unit>[A-Za-z³]+(?:\s+[A-Za-z³]+)?)?'
+)
+_WORD_RE = re.compile(r'[a-z]+')
+
+# Words ignored when matching attribute names against questions
+_STOP_WORDS = {'of', 'the', 'a', 'an', 'and', 'for', 'in', 'on', 'is', 'are', 's', 'what', 'whats', 'how', 'much',
+               'many'}
+# Words a lookup may contain besides the equipment and attribute
+# ("what's the typical operating weight of an excavator"); doe/ha are the
+# stems of does/has
+_FILLER_WORDS = {'typical', 'typically', 'usual', 'standard', 'rated', 'spec', 'specs', 'doe', 'do', 'have',
+                 'ha', 'it'}
+# Openers of questions that are not a bare lookup
+_QUESTION_OPENERS = {'is', 'are', 'can', 'could', 'should', 'would', 'will', 'do', 'does', 'did', 'why', 'when',
+                     'where', 'which', 'who', 'explain', 'compare', 'describe', 'list', 'recommend', 'i', 'my'}
+# "how ..." forms that ask for a quantity
+_HOW_QUANTITY_WORDS = {'much', 'many', 'heavy', 'big', 'large', 'deep', 'wide', 'tall', 'high', 'long',
+                       'powerful', 'fast'}
+
+
+def _stem(word):
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('s') and not word.endswith('ss') and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def _content_words(text):
+    return {_stem(w) for w in _WORD_RE.findall(text.lower()) if w not in _STOP_WORDS}
+
+
+def _is_lookup_form(words):
+    """True for "what ..." / "how much ..." questions and bare noun phrases"""
+    first = words[0]
+    if first in ('what', 'whats'):
+        return True
+    if first == 'how':
+        return len(words) > 1 and words[1] in _HOW_QUANTITY_WORDS
+    # Any other question or imperative opener ("is it safe", "can I", "why")
+    return first not in _QUESTION_OPENERS
+
+
+def _equipment_words(equipment):
+    return {_stem(word) for phrase in EQUIPMENT_TYPES[equipment] for word in phrase.split()}
+
+
+def _equipment_for_heading(heading):
+    words = heading.lower().strip()
+    for canonical, phrases in EQUIPMENT_TYPES.items():
+        if words in phrases or _stem(words) in phrases:
+            return canonical
+    return None
+
+
+def _number(text):
+    return float(text.replace(',', ''))
+
+
+def parse_value(raw_value):
+    """
+    Parse a spec value such as "15,000-90,000 kg" or "200-800 HP turbocharged diesel"
+
+    Returns:
+        dict: low, high, unit (canonical or None when unknown) and
+              low_raw/high_raw in the original unit, or None if no number
+    """
+    match = _VALUE_RE.search(raw_value)
+    if not match:
+        return None
+    low = _number(match.group('low'))
+    high = _number(match.group('high')) if match.group('high') else low
+
+    unit_text = (match.group('unit') or '').lower()
+    unit, factor = None, 1.0
+    # Prefer two-word units ("cubic meters") over their first word
+    for candidate in (unit_text, unit_text.split(' ')[0] if unit_text else ''):
+        if candidate in UNIT_ALIASES:
+            unit, factor = UNIT_ALIASES[candidate]
+            break
+
+    return {
+        'low': round(low * factor, 4),
+        'high': round(high * factor, 4),
+        'unit': unit,
+        'low_raw': low,
+        'high_raw': high,
+    }
+
+
+class SpecEntry:
+    """One parsed spec line"""
+
+    __slots__ = ('equipment', 'attribute', 'low', 'high', 'unit', 'raw_value', 'line', 'source')
+
+    def __init__(self, equipment, attribute, low, high, unit, raw_value, line, source):
+        self.equipment = equipment
+        self.attribute = attribute
+        self.low = low
+        self.high = high
+        self.unit = unit
+        self.raw_value = raw_value
+        self.line = line
+        self.source = source
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{slot: data.get(slot) for slot in cls.__slots__})
+
+
+def extract_specs(text, source):
+    """
+    Parse spec lines from a document
+
+    Lines are attributed to the equipment named by the most recent section
+    heading ("Excavators:"); lines under non-equipment headings are skipped.
+
+    Args:
+        text (str): Document text
+        source (str): Source URI recorded for citations
+
+    Returns:
+        list: SpecEntry objects
+    """
+    entries = []
+    equipment = None
+    for line in text.splitlines():
+        section = _SECTION_RE.match(line)
+        if section:
+            equipment = _equipment_for_heading(section.group(1))
+            continue
+        spec = _SPEC_LINE_RE.match(line)
+        if not spec or equipment is None:
+            continue
+        attribute, raw_value = spec.group(1).strip(), spec.group(2).strip()
+        value = parse_value(raw_value)
+        if value is None:
+            continue
+        entries.append(SpecEntry(
+            equipment, attribute.lower(), value['low'], value['high'], value['unit'],
+            raw_value, line.strip(), source
+        ))
+    return entries
+
+
+class SpecIndex:
+    """In-memory (equipment, attribute) -> spec entries index"""
+
+    def __init__(self, entries=()):
+        self._by_equipment = {}
+        self._attribute_words = {}
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        self._by_equipment.setdefault(entry.equipment, []).append(entry)
+        self._attribute_words.setdefault(entry.attribute, _content_words(entry.attribute))
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._by_equipment.values())
+
+    def entries(self):
+        return [entry for entries in self._by_equipment.values() for entry in entries]
+
+    def lookup(self, query):
+        """
+        Find spec entries that directly answer a query
+
+        The fast path runs before classification and generation, so it only
+        answers questions that are nothing but a lookup:
+
+        - a quantity question ("what is ...", "how much/heavy/deep ...") or
+          a bare noun phrase ("excavator bucket capacity"),
+        - exactly one equipment type and one attribute (the most specific
+          one whose words are all present),
+        - no other content words ("... in cold weather", "... and digging
+          depth", a manufacturer or model).
+
+        Anything else falls through to classification and RAG.
+
+        Returns:
+            list: Matching SpecEntry objects (empty when not a spec lookup)
+        """
+        words = _WORD_RE.findall(query.lower())
+        if not words or not _is_lookup_form(words):
+            return []
+
+        equipment = detect_query_facets(query).get('equipment_type', [])
+        if len(equipment) != 1:
+            return []
+
+        query_words = _content_words(query)
+        best_score, matches = 0, []
+        for entry in self._by_equipment.get(equipment[0], []):
+            attribute_words = self._attribute_words[entry.attribute]
+            if not attribute_words or not attribute_words <= query_words:
+                continue
+            # Prefer the most specific attribute ("blade capacity" over "blade")
+            score = len(attribute_words)
+            if score > best_score:
+                best_score, matches = score, [entry]
+            elif score == best_score:
+                matches.append(entry)
+
+        if len({entry.attribute for entry in matches}) != 1:
+            return []
+        leftover = query_words - self._attribute_words[matches[0].attribute] - _equipment_words(equipment[0])
+        if leftover - _FILLER_WORDS:
+            return []
+        return matches
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump([entry.to_dict() for entry in self.entries()], f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(SpecEntry.from_dict(data) for data in json.load(f))
+
+    @classmethod
+    def build(cls, folder, uri_prefix=''):
+        """Index every text document under a folder"""
+        index = cls()
+        for root, _dirs, files in os.walk(folder):
+            for name in sorted(files):
+                if not name.lower().endswith(('.txt', '.md')):
+                    continue
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, folder).replace('\\', '/')
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    for entry in extract_specs(f.read(), uri_prefix + relative):
+                        index.add(entry)
+        return index
+
+
+def format_answer(entries):
+    """Render matched entries as an Answer with one citation per line"""
+    parts = []
+    citations = []
+    offset = 0
+    for entry in entries:
+        part = f"{entry.equipment.replace('_', ' ').capitalize()} {entry.attribute}: {entry.raw_value}."
+        if parts:
+            offset += 1  # joining space
+        parts.append(part)
+        citations.append((offset, offset + len(part) - 1, entry))
+        offset += len(part)
+
+    text = ' '.join(parts)
+    return Answer(text, [
+        Citation(text, start, end, [Chunk(entry.line, entry.source)])
+        for start, end, entry in citations
+    ])
+
+
+_loaded_index = None
+
+
+def get_spec_index(path=DEFAULT_INDEX_PATH):
+    """
+    Load the spec index once per process
+
+    Returns:
+        SpecIndex: The index, or None when the file does not exist or the
+                   fast path is disabled with SPEC_FAST_PATH=0
+    """
+    global _loaded_index
+    if os.environ.get('SPEC_FAST_PATH', '1') == '0':
+        return None
+    if _loaded_index is None:
+        if not os.path.exists(path):
+            return None
+        _loaded_index = SpecIndex.load(path)
+        print(f"✓ Loaded spec index with {len(_loaded_index)} entries")
+    return _loaded_index
+
+
+def answer_from_spec_index(query):
+    """
+    Answer a direct spec lookup from the index
+
+    Returns:
+        results.Answer: Answer with citations, or None when the query is not
+                        a spec lookup the index can answer
+    """
+    index = get_spec_index()
+    if index is None:
+        return None
+    entries = index.lookup(query)
+    return format_answer(entries) if entries else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the spec-line index")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="Index the spec lines of a document folder")
+    build.add_argument('folder')
+    build.add_argument('--uri-prefix', default='', help="Prefix for source URIs, e.g. s3://bucket/")
+    build.add_argument('--output', default=DEFAULT_INDEX_PATH)
+    query = commands.add_parser('query', help="Look up a question in the index")
+    query.add_argument('question')
+    query.add_argument('--index', default=DEFAULT_INDEX_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        index = SpecIndex.build(args.folder, args.uri_prefix)
+        index.save(args.output)
+        print(f"✓ Indexed {len(index)} spec lines into {args.output}")
+        return 0
+
+    entries = SpecIndex.load(args.index).lookup(args.question)
+    if not entries:
+        print("No direct spec match (would go through RAG)")
+        return 1
+    answer = format_answer(entries)
+    print(answer.text)
+    for source in answer.sources:
+        print(f"  source: {source}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
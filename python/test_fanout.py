@@ -0,0 +1,108 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import bedrock_utils
+import fake_bedrock
+import fanout
+from fanout import RetrievalTarget, fan_out_retrieve, merge_results
+from model_router import DEFAULT_REGION
+
+QUERY = "excavator bucket capacity"
+
+
+def _result(uri, text, score):
+    return {'content': {'text': text}, 'location': {'type': 'S3', 's3Location': {'uri': uri}},
+            'score': score, 'metadata': {}}
+
+
+def test_merge_normalizes_scores_per_target():
+    strong = RetrievalTarget('KBSTRONG01', DEFAULT_REGION)
+    weak = RetrievalTarget('KBWEAK0001', DEFAULT_REGION, weight=0.5)
+    merged = merge_results([
+        (strong, [_result('s3://a/1', 'one', 0.9), _result('s3://a/2', 'two', 0.45)]),
+        (weak, [_result('s3://b/1', 'three', 0.2)]),
+    ], number_of_results=10)
+
+    assert [(r['knowledgeBaseId'], r['normalizedScore']) for r in merged] == [
+        ('KBSTRONG01', 1.0), ('KBSTRONG01', 0.5), ('KBWEAK0001', 0.5)]
+
+
+def test_merge_keeps_distinct_chunks_and_collapses_duplicates():
+    primary = RetrievalTarget('KBPRIMARY1', DEFAULT_REGION)
+    replica = RetrievalTarget('KBREPLICA1', DEFAULT_REGION, weight=0.8)
+    merged = merge_results([
+        (primary, [_result('s3://a/doc', 'chunk one', 0.9), _result('s3://a/doc', 'chunk two', 0.6)]),
+        (replica, [_result('s3://a/doc', 'chunk two', 0.5)]),
+    ], number_of_results=10)
+
+    assert len(merged) == 2
+    by_text = {r['content']['text']: r for r in merged}
+    # Replica copy of chunk two normalizes to 0.8, beating the primary's 0.667
+    assert by_text['chunk two']['knowledgeBaseId'] == 'KBREPLICA1'
+    assert by_text['chunk two']['normalizedScore'] == 0.8
+
+
+def test_merge_falls_back_to_rank_without_scores():
+    target = RetrievalTarget('KBNOSCORE1', DEFAULT_REGION)
+    merged = merge_results([(target, [_result('s3://a/1', 'one', None), _result('s3://a/2', 'two', None)])], 10)
+    assert [r['normalizedScore'] for r in merged] == [1.0, 0.5]
+
+
+class _BrokenAgentRuntime(fake_bedrock.FakeAgentRuntime):
+    def retrieve(self, **kwargs):
+        raise ClientError({'Error': {'Code': 'ServiceUnavailableException', 'Message': 'down'}}, 'Retrieve')
+
+
+@pytest.fixture
+def regional_clients(monkeypatch):
+    """us-west-2 always fails and eu-west-1 is slow; every other region is healthy"""
+    healthy = fake_bedrock.FakeAgentRuntime(latency=fake_bedrock.LatencyModel('fixed', 1.0), seed=1)
+    clients = {
+        'us-west-2': _BrokenAgentRuntime(latency=fake_bedrock.LatencyModel('fixed', 1.0), seed=1),
+        'eu-west-1': fake_bedrock.FakeAgentRuntime(latency=fake_bedrock.LatencyModel('fixed', 500.0), seed=1),
+    }
+    monkeypatch.setattr(bedrock_utils, '_new_agent_runtime', lambda region: clients.get(region, healthy))
+    bedrock_utils._regional_kb_clients.clear()
+    yield
+    bedrock_utils._regional_kb_clients.clear()
+
+
+def _statuses(response):
+    return {(entry['kb_id'], entry['region']): entry['status'] for entry in response['targets']}
+
+
+def test_failing_target_is_reported_as_error(fake_services, regional_clients):
+    targets = [RetrievalTarget('KBHEALTHY1', DEFAULT_REGION), RetrievalTarget('KBBROKEN01', 'us-west-2')]
+    response = fan_out_retrieve(QUERY, targets, use_cache=False, auto_filter=False)
+
+    assert _statuses(response) == {('KBHEALTHY1', DEFAULT_REGION): 'ok', ('KBBROKEN01', 'us-west-2'): 'error'}
+    assert response['partial'] is True
+    assert response['results']
+    assert all(r['knowledgeBaseId'] == 'KBHEALTHY1' for r in response['results'])
+
+
+def test_slow_target_times_out_without_holding_back_the_rest(fake_services, regional_clients):
+    targets = [RetrievalTarget('KBHEALTHY1', DEFAULT_REGION), RetrievalTarget('KBSLOW0001', 'eu-west-1', timeout=0.05)]
+    response = fan_out_retrieve(QUERY, targets, use_cache=False, auto_filter=False)
+
+    assert _statuses(response) == {('KBHEALTHY1', DEFAULT_REGION): 'ok', ('KBSLOW0001', 'eu-west-1'): 'timeout'}
+    assert response['partial'] is True
+    assert response['results']
+    slow = next(entry for entry in response['targets'] if entry['kb_id'] == 'KBSLOW0001')
+    assert slow['elapsed_ms'] < 400
+
+
+def test_all_targets_ok_is_not_partial(fake_services, regional_clients):
+    targets = [RetrievalTarget('KBHEALTHY1', DEFAULT_REGION), RetrievalTarget('KBHEALTHY2', 'ap-south-1')]
+    response = fan_out_retrieve(QUERY, targets, number_of_results=4, use_cache=False, auto_filter=False)
+
+    assert set(_statuses(response).values()) == {'ok'}
+    assert response['partial'] is False
+    assert len(response['results']) <= 4
+
+
+def test_parse_targets():
+    targets = fanout.parse_targets('KBSALES001, KBPARTS001@us-west-2')
+    assert [t.name for t in targets] == [f'KBSALES001@{DEFAULT_REGION}', 'KBPARTS001@us-west-2']
+    with pytest.raises(ValueError):
+        fanout.parse_targets('not a target!')
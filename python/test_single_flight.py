@@ -0,0 +1,139 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from single_flight import SingleFlight, make_key
+
+
+def test_make_key_normalizes_the_query():
+    assert make_key('q', '  What IS   it? ', 'KB1') == make_key('q', 'what is it?', 'KB1')
+    assert make_key('q', 'what is it?', 'KB1') != make_key('q', 'what is it?', 'KB2')
+
+
+def _run_concurrently(flight, fn, callers=5):
+    """Start callers on the same key while fn is blocked; return their outcomes"""
+    def call():
+        try:
+            return ('ok', flight.do('key', fn))
+        except Exception as e:
+            return ('error', e)
+
+    with ThreadPoolExecutor(max_workers=callers) as pool:
+        futures = [pool.submit(call) for _ in range(callers)]
+        return [f.result(timeout=5) for f in futures]
+
+
+def _gated(result=None, error=None):
+    """A function that blocks until every caller has joined, then returns or raises"""
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        if error is not None:
+            raise error
+        return result
+    return fn, release, calls
+
+
+def _release_when_joined(flight, release, waiters):
+    def watch():
+        while flight.stats()['coalesced'] < waiters:
+            threading.Event().wait(0.005)
+        release.set()
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def test_do_runs_once_and_shares_the_result():
+    flight = SingleFlight()
+    result = {'answer': 42}
+    fn, release, calls = _gated(result=result)
+    _release_when_joined(flight, release, 4)
+
+    outcomes = _run_concurrently(flight, fn)
+
+    assert calls == [1]
+    assert all(outcome == ('ok', result) for outcome in outcomes)
+    assert flight.stats() == {'executed': 1, 'coalesced': 4, 'in_flight': 0}
+
+
+def test_do_raises_the_error_in_every_caller_and_forgets_the_key():
+    flight = SingleFlight()
+    error = RuntimeError('backend down')
+    fn, release, calls = _gated(error=error)
+    _release_when_joined(flight, release, 4)
+
+    outcomes = _run_concurrently(flight, fn)
+
+    assert calls == [1]
+    assert all(outcome == ('error', error) for outcome in outcomes)
+    # The failed call is not cached; the next caller runs again
+    assert flight.do('key', lambda: 'retried') == 'retried'
+    assert flight.in_flight() == 0
+
+
+def test_do_async_raises_the_error_in_every_waiter():
+    flight = SingleFlight()
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError('bad answer')
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async('key', fail) for _ in range(3)), return_exceptions=True)
+
+    outcomes = asyncio.run(main())
+    assert calls == [1]
+    assert all(isinstance(outcome, ValueError) for outcome in outcomes)
+    assert flight.in_flight() == 0
+
+
+def test_do_async_cancelling_one_waiter_keeps_the_call_for_the_others():
+    flight = SingleFlight()
+    finished = []
+
+    async def answer():
+        await asyncio.sleep(0.05)
+        finished.append(1)
+        return 'shared'
+
+    async def main():
+        leaving = asyncio.ensure_future(flight.do_async('key', answer))
+        staying = asyncio.ensure_future(flight.do_async('key', answer))
+        await asyncio.sleep(0.01)
+        leaving.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leaving
+        return await staying
+
+    assert asyncio.run(main()) == 'shared'
+    assert finished == [1]
+
+
+def test_do_async_cancelling_every_waiter_cancels_the_call():
+    flight = SingleFlight()
+    cancelled = []
+
+    async def answer():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def main():
+        waiters = [asyncio.ensure_future(flight.do_async('key', answer)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert cancelled == [1]
+    assert flight.in_flight() == 0
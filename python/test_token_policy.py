@@ -0,0 +1,142 @@
+import json
+
+import bedrock_utils
+import token_policy
+from token_policy import DEFAULT_POLICIES, MIN_LEARNED_TOKENS, TURN_STOP_SEQUENCES, TokenPolicy, classify_query, learn
+
+COMPARISON_QUERY = "Compare the operating weight of excavators versus bulldozers"
+GENERAL_QUERY = "Tell me about excavators and bulldozers"
+
+
+def test_classify_query():
+    assert classify_query(COMPARISON_QUERY) == 'comparison'
+    assert classify_query("How do I inspect the hydraulic lines?") == 'procedure'
+    assert classify_query("What is the operating weight of an excavator?") == 'spec_lookup'
+    assert classify_query(GENERAL_QUERY) == 'general'
+
+
+def test_classifier_is_budgeted_by_default():
+    decision = TokenPolicy().choose('classify', GENERAL_QUERY)
+    assert decision['max_tokens'] == 2
+    assert decision['prefill'] == 'Category'
+    assert decision['stop_sequences'] == list(TURN_STOP_SEQUENCES)
+
+
+def test_answer_tasks_keep_their_limit_without_learned_budget():
+    policy = TokenPolicy()
+    for task in ('rag', 'generate', 'summarize'):
+        decision = policy.choose(task, COMPARISON_QUERY)
+        assert decision['max_tokens'] is None
+        assert decision['stop_sequences'] == list(TURN_STOP_SEQUENCES)
+
+
+def test_learned_budget_is_capped_by_the_class_ceiling():
+    ceiling = DEFAULT_POLICIES[('rag', 'comparison')]['max_tokens']
+    policy = TokenPolicy(learned={'rag/comparison': 300, 'rag/general': ceiling * 10})
+    assert policy.choose('rag', COMPARISON_QUERY)['max_tokens'] == 300
+    assert policy.choose('rag', GENERAL_QUERY)['max_tokens'] == DEFAULT_POLICIES[('rag', 'general')]['max_tokens']
+    assert policy.choose('generate', COMPARISON_QUERY)['max_tokens'] is None
+
+
+def test_unknown_task_has_no_policy():
+    assert TokenPolicy().choose('translate', GENERAL_QUERY) is None
+
+
+def test_record_counts_unbudgeted_calls():
+    policy = TokenPolicy()
+    policy.record('rag', 'general', None, 120)
+    policy.record('rag', 'general', 200, 200, truncated=True)
+    assert policy.stats()['rag/general'] == {'calls': 2, 'budget_tokens': 200, 'output_tokens': 320, 'truncated': 1}
+
+
+def _write_log(path, rows):
+    with open(path, 'w') as f:
+        for query, output_tokens, verdict in rows:
+            f.write(json.dumps({'query': query, 'verdict': verdict, 'output_tokens': output_tokens}) + '\n')
+
+
+def test_learn_uses_p95_plus_headroom(tmp_path):
+    log = tmp_path / 'queries.jsonl'
+    rows = [(GENERAL_QUERY, tokens, 'answered') for tokens in range(100, 200)]
+    rows += [(COMPARISON_QUERY, 10, 'answered')] * 60
+    rows += [("How do I grease the boom?", 50, 'answered')] * 5
+    rows += [(GENERAL_QUERY, 5000, 'rejected')] * 50
+    _write_log(log, rows)
+
+    learned, report = learn([str(log)], headroom=1.25, min_samples=50)
+
+    assert report['general']['samples'] == 100
+    assert report['general']['p95_tokens'] == 194
+    assert learned['rag/general'] == 243  # ceil(194 * 1.25)
+    assert learned['rag/comparison'] == MIN_LEARNED_TOKENS
+    assert 'rag/procedure' not in learned
+    assert report['procedure']['learned'] is None
+
+
+def test_learn_never_exceeds_the_ceiling(tmp_path):
+    log = tmp_path / 'queries.jsonl'
+    _write_log(log, [(GENERAL_QUERY, 4000, 'answered')] * 60)
+    learned, _ = learn([str(log)], min_samples=50)
+    assert learned['rag/general'] == DEFAULT_POLICIES[('rag', 'general')]['max_tokens']
+
+
+def test_saved_policy_round_trips(tmp_path):
+    path = tmp_path / 'policy.json'
+    TokenPolicy(learned={'rag/general': 123}).save(str(path))
+    assert TokenPolicy.load(str(path)).choose('rag', GENERAL_QUERY)['max_tokens'] == 123
+
+
+def _capture_rag_requests(agent_runtime):
+    requests = []
+    original = agent_runtime.retrieve_and_generate
+
+    def capture(**kwargs):
+        requests.append(kwargs)
+        return original(**kwargs)
+    agent_runtime.retrieve_and_generate = capture
+    return requests
+
+
+def test_rag_request_has_no_max_tokens_without_learned_budget(fake_services, monkeypatch):
+    _, agent_runtime = fake_services
+    monkeypatch.setattr(token_policy, '_policy', TokenPolicy())
+    monkeypatch.setattr(token_policy, 'TOKEN_POLICY_ENABLED', True)
+    requests = _capture_rag_requests(agent_runtime)
+
+    bedrock_utils.answer_with_citations(GENERAL_QUERY, 'FAKEKB0001', 'arn:aws:bedrock:us-east-1::foundation-model/m',
+                                        auto_filter=False)
+
+    config = requests[0]['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration']
+    text_config = config['generationConfiguration']['inferenceConfig']['textInferenceConfig']
+    assert 'maxTokens' not in text_config
+    assert text_config['stopSequences'] == list(TURN_STOP_SEQUENCES)
+    assert agent_runtime.stats()['truncated'] == 0
+
+
+def test_rag_request_uses_learned_budget(fake_services, monkeypatch):
+    _, agent_runtime = fake_services
+    monkeypatch.setattr(token_policy, '_policy', TokenPolicy(learned={'rag/general': 40}))
+    monkeypatch.setattr(token_policy, 'TOKEN_POLICY_ENABLED', True)
+    requests = _capture_rag_requests(agent_runtime)
+
+    bedrock_utils.answer_with_citations(GENERAL_QUERY, 'FAKEKB0001', 'arn:aws:bedrock:us-east-1::foundation-model/m',
+                                        auto_filter=False)
+
+    config = requests[0]['retrieveAndGenerateConfiguration']['knowledgeBaseConfiguration']
+    assert config['generationConfiguration']['inferenceConfig']['textInferenceConfig']['maxTokens'] == 40
+
+
+def test_category_letter_after_prefill():
+    assert bedrock_utils._category_letter("Category E") == 'E'
+    assert bedrock_utils._category_letter("CategoryE") == 'E'
+    assert bedrock_utils._category_letter(" e") == 'E'
+    assert bedrock_utils._category_letter("Category C") == 'C'
+    assert bedrock_utils._category_letter("Every category") is None
+    assert bedrock_utils._category_letter("") is None
+
+
+def test_classifier_approves_with_prefill(fake_services, monkeypatch):
+    monkeypatch.setattr(token_policy, '_policy', TokenPolicy())
+    monkeypatch.setattr(token_policy, 'TOKEN_POLICY_ENABLED', True)
+    assert bedrock_utils.valid_prompt("What is the bucket capacity of an excavator?")
+    assert not bedrock_utils.valid_prompt("Tell me about machine learning")
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Output budget policy: max_tokens and stop sequences per task and query class
+
+Generation time grows with output length, and Bedrock reserves quota for
+the whole max_tokens budget, so every call asks for no more than its kind
+of answer needs. Queries are put in a class:
+
+    spec_lookup  - a single number for one machine ("operating weight of an excavator")
+    comparison   - compare / difference / versus questions
+    procedure    - how-to, steps, checklists
+    general      - everything else
+
+and each (task, class) pair can get a budget. The classifier needs one
+letter, so it prefills the answer with "Category" and asks for 2 tokens:
+the model writes the letter and stops. That is the only budget on by
+default. Answer tasks (generate, summarize, rag) keep their route default
+max_tokens, or no maxTokens at all for retrieve_and_generate, until a
+budget has been learned for their class: a fixed cap would cut user-facing
+answers mid-sentence. The prompts are written as Human:/Assistant:
+turns, so every call also stops at TURN_STOP_SEQUENCES rather than writing
+a made-up next turn. (Stop sequences cannot be whitespace only, so a stop
+at the end of the line is not available.) Tasks are the model_router
+routes plus 'rag' for retrieve_and_generate.
+
+max_tokens only shortens answers that would have run past it, so a learned
+budget saves output tokens only on the answers it truncates; its main gain
+is admission-control quota, which is reserved for the full budget.
+
+Budgets are learned from query logs (query_log.py records an output_tokens
+estimate per answered query): p95 output length per class plus headroom,
+never above the class ceiling in DEFAULT_POLICIES. Learned budgets are written to TOKEN_POLICY_PATH,
+which is loaded on first use like the spec index. TOKEN_POLICY=0 turns the
+policy off and restores the fixed route defaults.
+
+Usage:
+    python token_policy.py learn /tmp/query-log/queries*.jsonl.gz --output token_policy.json
+    python token_policy.py report --ms-per-token 15 --policy token_policy.json
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import sys
+import threading
+
+from facets import detect_query_facets
+
+TOKEN_POLICY_ENABLED = os.environ.get('TOKEN_POLICY', '1').lower() not in ('0', 'false', 'no', 'off')
+TOKEN_POLICY_PATH = os.environ.get(
+    'TOKEN_POLICY_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'token_policy.json')
+)
+
+QUERY_CLASSES = ('spec_lookup', 'comparison', 'procedure', 'general')
+
+# Start of a new dialogue turn the model would otherwise write itself
+TURN_STOP_SEQUENCES = ('\n\nHuman:',)
+
+# (task, query class) -> budget; '*' matches any class. For learned_only
+# entries max_tokens is only the ceiling of a learned budget: without one
+# the call keeps its usual limit.
+DEFAULT_POLICIES = {
+    ('classify', '*'): {'max_tokens': 2, 'prefill': 'Category', 'stop_sequences': TURN_STOP_SEQUENCES},
+    ('generate', 'spec_lookup'): {'max_tokens': 150, 'learned_only': True, 'stop_sequences': TURN_STOP_SEQUENCES},
+    ('generate', 'comparison'): {'max_tokens': 600, 'learned_only': True, 'stop_sequences': TURN_STOP_SEQUENCES},
+    ('generate', 'procedure'): {'max_tokens': 600, 'learned_only': True, 'stop_sequences': TURN_STOP_SEQUENCES},
+    ('generate', 'general'): {'max_tokens': 500, 'learned_only': True, 'stop_sequences': TURN_STOP_SEQUENCES},
+    ('summarize', '*'): {'max_tokens': 300, 'learned_only': True, 'stop_sequences': TURN_STOP_SEQUENCES},
+    ('rag', 'spec_lookup'): {'max_tokens': 200, 'learned_only': True, 'stop_sequences': TURN_STOP_SEQUENCES},
+    ('rag', 'comparison'): {'max_tokens': 800, 'learned_only': True, 'stop_sequences': TURN_STOP_SEQUENCES},
+    ('rag', 'procedure'): {'max_tokens': 700, 'learned_only': True, 'stop_sequences': TURN_STOP_SEQUENCES},
+    ('rag', 'general'): {'max_tokens': 500, 'learned_only': True, 'stop_sequences': TURN_STOP_SEQUENCES},
+}
+
+# Learned budget = p95 * headroom, only with enough samples and never
+# below MIN_LEARNED_TOKENS or above the class ceiling
+LEARN_HEADROOM = 1.25
+LEARN_MIN_SAMPLES = 50
+MIN_LEARNED_TOKENS = 32
+
+_COMPARISON_WORDS = {'compare', 'comparison', 'difference', 'differences', 'versus', 'vs', 'better', 'between'}
+_PROCEDURE_RE = re.compile(r'\b(how (do|to|should|can)|steps?|procedure|process|checklist|instructions?|guide)\b')
+_SPEC_WORDS = {
+    'capacity', 'weight', 'power', 'horsepower', 'hp', 'depth', 'width', 'height', 'length', 'reach',
+    'pressure', 'speed', 'size', 'range', 'load', 'radius', 'torque', 'dimensions', 'rating',
+}
+_WORD_RE = re.compile(r'[a-z]+')
+
+
+def classify_query(query):
+    """Query class of a question (see QUERY_CLASSES)"""
+    text = (query or '').lower()
+    words = set(_WORD_RE.findall(text))
+    if words & _COMPARISON_WORDS:
+        return 'comparison'
+    if _PROCEDURE_RE.search(text):
+        return 'procedure'
+    if words & _SPEC_WORDS and len(detect_query_facets(query).get('equipment_type', [])) == 1:
+        return 'spec_lookup'
+    return 'general'
+
+
+class TokenPolicy:
+    """Budgets per (task, query class) plus counters of what was asked for and used"""
+
+    def __init__(self, policies=None, learned=None):
+        self.policies = dict(DEFAULT_POLICIES if policies is None else policies)
+        self.learned = dict(learned or {})
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _base(self, task, query_class):
+        return self.policies.get((task, query_class)) or self.policies.get((task, '*'))
+
+    def choose(self, task, query=None):
+        """
+        Budget for one call
+
+        Args:
+            task (str): Route name or 'rag'
+            query (str): The user's question (used for its query class)
+
+        Returns:
+            dict: query_class, max_tokens (None to keep the caller's usual
+                  limit), stop_sequences and prefill, or None when the task
+                  has no policy
+        """
+        query_class = classify_query(query) if query else 'general'
+        base = self._base(task, query_class)
+        if base is None:
+            return None
+        max_tokens = None if base.get('learned_only') else base['max_tokens']
+        learned = self.learned.get(f"{task}/{query_class}")
+        if learned:
+            max_tokens = min(base['max_tokens'], learned)
+        return {
+            'query_class': query_class,
+            'max_tokens': max_tokens,
+            'stop_sequences': list(base.get('stop_sequences', ())),
+            'prefill': base.get('prefill'),
+        }
+
+    def record(self, task, query_class, max_tokens, output_tokens, truncated=False):
+        """Record one call made under the policy (max_tokens None: no budget was set)"""
+        with self._lock:
+            entry = self._stats.setdefault(f"{task}/{query_class}", {
+                'calls': 0, 'budget_tokens': 0, 'output_tokens': 0, 'truncated': 0,
+            })
+            entry['calls'] += 1
+            entry['budget_tokens'] += max_tokens or 0
+            entry['output_tokens'] += output_tokens
+            entry['truncated'] += 1 if truncated else 0
+
+    def stats(self):
+        """
+        Per task/class counters
+
+        A high truncated count means the budget is too tight for that class.
+        """
+        with self._lock:
+            return {key: dict(entry) for key, entry in self._stats.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'learned': self.learned}, f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(learned=json.load(f).get('learned', {}))
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_token_policy():
+    """The process-wide policy (with learned budgets when TOKEN_POLICY_PATH exists), or None when off"""
+    global _policy
+    if not TOKEN_POLICY_ENABLED:
+        return None
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                policy = TokenPolicy()
+                if os.path.exists(TOKEN_POLICY_PATH):
+                    try:
+                        policy = TokenPolicy.load(TOKEN_POLICY_PATH)
+                    except (OSError, ValueError) as e:
+                        print(f"Warning: Ignoring token policy {TOKEN_POLICY_PATH}: {str(e)}")
+                _policy = policy
+    return _policy
+
+
+def set_token_policy(policy):
+    """Replace the process-wide policy (None turns the policy off)"""
+    global _policy, TOKEN_POLICY_ENABLED
+    _policy = policy
+    TOKEN_POLICY_ENABLED = policy is not None
+
+
+def learn(log_paths, task='rag', headroom=LEARN_HEADROOM, min_samples=LEARN_MIN_SAMPLES):
+    """
+    Learn per-class budgets from query logs
+
+    Returns:
+        tuple: (learned, report) - learned maps "task/class" to max_tokens;
+               report has samples, p95 and the chosen budget per class
+    """
+    from model_router import _percentile
+    from query_log import read_log
+
+    samples = {query_class: [] for query_class in QUERY_CLASSES}
+    for record in read_log(log_paths):
+        entries = record.get('queries') or [record]
+        for entry in entries:
+            if entry.get('verdict') == 'answered' and isinstance(entry.get('output_tokens'), int):
+                samples[classify_query(entry.get('query', ''))].append(entry['output_tokens'])
+
+    learned = {}
+    report = {}
+    for query_class, values in samples.items():
+        ceiling = DEFAULT_POLICIES[(task, query_class)]['max_tokens']
+        p95 = _percentile(sorted(values), 95)
+        budget = None
+        if len(values) >= min_samples:
+            budget = max(MIN_LEARNED_TOKENS, min(ceiling, int(math.ceil(p95 * headroom))))
+            learned[f"{task}/{query_class}"] = budget
+        report[query_class] = {'samples': len(values), 'p95_tokens': p95, 'ceiling': ceiling, 'learned': budget}
+    return learned, report
+
+
+def compare_on_benchmark(queries, ms_per_token=15.0, seed=1234, policy=None):
+    """
+    Run queries against the Bedrock stand-in with the policy off, then on
+
+    The stand-in's latency grows by ms_per_token per output token, so the
+    latency change reflects the shorter outputs. Tokens and truncations are
+    counted per task: 'classify' on the bedrock-runtime stand-in and 'rag'
+    on the bedrock-agent-runtime one. Fewer tokens on a task whose answers
+    the policy truncated are cut-off answers, not a saving; each task's
+    'truncated' counts the answers the policy cut beyond the fixed run.
+
+    Args:
+        policy (TokenPolicy): Policy to evaluate (default: the process-wide
+                              policy, with learned budgets if any)
+
+    Returns:
+        dict: Latency summary and per-task output tokens and truncations for
+              each run, plus the token change and truncations per task
+    """
+    import time
+
+    import bedrock_utils
+    import fake_bedrock
+    # The module bedrock_utils reads the policy from (not __main__ when run as a script)
+    import token_policy
+    from benchmark import FAKE_KB_ID, FAKE_MODEL_ID
+    from latency_stats import summarize_latencies
+
+    model_arn = f"arn:aws:bedrock:us-east-1::foundation-model/{FAKE_MODEL_ID}"
+    adaptive_policy = policy or token_policy.get_token_policy() or token_policy.TokenPolicy()
+    runs = {}
+    for label, policy in (('fixed', None), ('policy', adaptive_policy)):
+        token_policy.set_token_policy(policy)
+        latency = fake_bedrock.LatencyModel('fixed', 50.0)
+        runtime, agent_runtime = fake_bedrock.install(
+            fake_bedrock.FakeBedrockRuntime(latency=latency, seed=seed, ms_per_output_token=ms_per_token),
+            fake_bedrock.FakeAgentRuntime(latency=latency, seed=seed, ms_per_output_token=ms_per_token),
+        )
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            if bedrock_utils.valid_prompt(query, FAKE_MODEL_ID):
+                bedrock_utils.answer_with_citations(query, FAKE_KB_ID, model_arn)
+            latencies.append((time.perf_counter() - started) * 1000.0)
+        tasks = {}
+        for task, service in (('classify', runtime), ('rag', agent_runtime)):
+            stats = service.stats()
+            tasks[task] = {'calls': stats['calls'], 'output_tokens': stats['output_tokens'],
+                           'truncated': stats['truncated']}
+        runs[label] = dict(summarize_latencies(latencies), tasks=tasks,
+                           output_tokens=sum(t['output_tokens'] for t in tasks.values()))
+
+    def saving(fixed_tokens, policy_tokens):
+        return {
+            'tokens_saved': fixed_tokens - policy_tokens,
+            'tokens_saved_pct': round(100.0 * (fixed_tokens - policy_tokens) / fixed_tokens, 1)
+            if fixed_tokens else 0.0,
+        }
+
+    fixed, adaptive = runs['fixed'], runs['policy']
+    tasks = {}
+    for task in fixed['tasks']:
+        tasks[task] = saving(fixed['tasks'][task]['output_tokens'], adaptive['tasks'][task]['output_tokens'])
+        tasks[task]['truncated'] = max(0, adaptive['tasks'][task]['truncated'] - fixed['tasks'][task]['truncated'])
+    return dict(
+        saving(fixed['output_tokens'], adaptive['output_tokens']),
+        queries=len(queries),
+        ms_per_token=ms_per_token,
+        runs=runs,
+        tasks=tasks,
+        truncated=sum(row['truncated'] for row in tasks.values()),
+        mean_latency_change_ms=round(adaptive['mean_ms'] - fixed['mean_ms'], 2),
+        p95_latency_change_ms=round(adaptive['p95_ms'] - fixed['p95_ms'], 2),
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Learn and evaluate output token budgets")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    learn_parser = sub.add_parser('learn', help="Learn p95 budgets per query class from query logs")
+    learn_parser.add_argument('logs', nargs='+')
+    learn_parser.add_argument('--headroom', type=float, default=LEARN_HEADROOM)
+    learn_parser.add_argument('--min-samples', type=int, default=LEARN_MIN_SAMPLES)
+    learn_parser.add_argument('--output', default=TOKEN_POLICY_PATH, help="Learned policy JSON")
+
+    report_parser = sub.add_parser('report', help="Tokens saved and latency change on the benchmark set")
+    report_parser.add_argument('--golden', help="Golden query set (defaults to golden_queries.json plus the benchmark queries)")
+    report_parser.add_argument('--ms-per-token', type=float, default=15.0, help="Stand-in generation time per output token")
+    report_parser.add_argument('--policy', help="Learned policy JSON to evaluate (default TOKEN_POLICY_PATH if it exists)")
+    report_parser.add_argument('--output', help="Write the report as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == 'learn':
+        learned, report = learn(args.logs, headroom=args.headroom, min_samples=args.min_samples)
+        print(f"{'class':<12} {'samples':>8} {'p95':>8} {'ceiling':>8} {'learned':>8}")
+        for query_class, row in report.items():
+            print(f"{query_class:<12} {row['samples']:>8} {row['p95_tokens']:>8} {row['ceiling']:>8} "
+                  f"{row['learned'] if row['learned'] is not None else '-':>8}")
+        TokenPolicy(learned=learned).save(args.output)
+        print(f"\n✓ Learned budgets written to {args.output}")
+        return 0
+
+    from benchmark import BENCH_QUERIES
+    from evaluate_retrieval import DEFAULT_GOLDEN_SET, load_golden_set
+
+    queries = [entry['query'] for entry in load_golden_set(args.golden or DEFAULT_GOLDEN_SET)]
+    if not args.golden:
+        queries += BENCH_QUERIES
+
+    # bedrock_utils logs every call with print(); keep the report readable
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        result = compare_on_benchmark(queries, args.ms_per_token,
+                                      policy=TokenPolicy.load(args.policy) if args.policy else None)
+    finally:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+
+    print(f"{'run':<8} {'task':<10} {'calls':>6} {'tokens':>8} {'truncated':>10}")
+    for label, run in result['runs'].items():
+        for task, row in run['tasks'].items():
+            print(f"{label:<8} {task:<10} {row['calls']:>6} {row['output_tokens']:>8} {row['truncated']:>10}")
+    print()
+    for task, row in result['tasks'].items():
+        if row['truncated']:
+            print(f"{task:<10} ✗ {row['truncated']} answers truncated by the budget: "
+                  f"{row['tokens_saved']} fewer tokens are cut-off answers, not a saving")
+        else:
+            print(f"{task:<10} tokens saved: {row['tokens_saved']} ({row['tokens_saved_pct']}%)")
+    for label, run in result['runs'].items():
+        print(f"{label:<8} mean: {run['mean_ms']} ms  p95: {run['p95_ms']} ms")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Report written to {args.output}")
+    if result['truncated']:
+        print(f"\n✗ The policy truncated {result['truncated']} answers; raise the budgets of those classes")
+        return 1
+    print(f"\nTokens saved: {result['tokens_saved']} ({result['tokens_saved_pct']}%)  "
+          f"mean latency {result['mean_latency_change_ms']:+} ms  p95 {result['p95_latency_change_ms']:+} ms "
+          f"over {result['queries']} queries")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Local vector index with quantized codes and exact rescoring
+
+A 1536-dim float32 embedding is 6 KB per chunk, so a few million chunks do
+not fit in a worker's RAM. This index keeps only compact codes resident:
+
+    int8    - per-dimension scalar quantization, 1 byte per dimension
+    binary  - 1 sign bit per dimension, searched by Hamming distance (popcount)
+    float32 - no codes; exact scan of the full vectors (the baseline)
+
+Search is two-phase: a scan over the codes picks candidates (k times a
+per-mode factor), then the candidates are rescored exactly against the full
+float32 vectors, which stay on disk and are memory-mapped, so only the
+candidate rows are paged in.
+
+An index directory holds:
+
+    meta.json    - dimension, row count and int8 scales
+    vectors.f32  - normalized float32 vectors (memory-mapped)
+    codes.i8     - int8 codes
+    codes.bin    - packed sign bits
+    docs.jsonl   - id, chunk text and metadata per row (read for hits only)
+    offsets.i64  - byte offsets into docs.jsonl
+
+Indexes are built from the same JSONL export that scripts/bulk_load_kb.py
+loads: one {"id", "embedding", "chunks", "metadata"} object per line.
+
+Usage:
+    python vector_index.py build export.jsonl.gz --index /data/kb-index
+    python vector_index.py benchmark --index /data/kb-index --queries 200 --k 10
+    python vector_index.py benchmark --synthetic 200000 --output vector_bench.json
+"""
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from latency_stats import summarize_latencies
+
+EMBEDDING_DIMENSIONS = 1536
+EMBEDDING_MODEL_ID = os.environ.get('EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v1')
+MODES = ('float32', 'int8', 'binary')
+
+# Candidates scanned from the codes per requested result before rescoring
+RESCORE_FACTORS = {'int8': 4, 'binary': 40}
+
+# Rows per block when scanning codes or quantizing, bounding temporary memory
+BLOCK_ROWS = 65536
+
+# int8 blocks are widened to float32 before the dot product; small blocks
+# keep the widened copy in cache
+INT8_BLOCK_ROWS = 256
+
+_POPCOUNT = None
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("The local vector index needs numpy: pip install numpy")
+
+
+def _popcount_rows(xored):
+    """Set bits per row of a packed uint8 matrix"""
+    global _POPCOUNT
+    if hasattr(np, 'bitwise_count'):
+        if xored.shape[1] % 8 == 0:
+            # Counting 64 bits at a time is several times faster than bytes
+            xored = np.ascontiguousarray(xored).view(np.uint64)
+        return np.bitwise_count(xored).sum(axis=1, dtype=np.int32)
+    if _POPCOUNT is None:
+        _POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return _POPCOUNT[xored].sum(axis=1, dtype=np.int32)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def _top(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    keyed = -scores
+    picked = np.argpartition(keyed, k - 1)[:k]
+    return picked[np.argsort(keyed[picked], kind='stable')]
+
+
+def read_export(paths):
+    """Yield (id, embedding, chunks, metadata) tuples from bulk-loader JSONL exports"""
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    yield (record.get('id'), record['embedding'],
+                           record.get('chunks') or record.get('text') or '', record.get('metadata') or {})
+
+
+def build(path, rows, dim=EMBEDDING_DIMENSIONS, batch_rows=4096):
+    """
+    Build an index directory from (id, embedding, chunks, metadata) rows
+
+    Vectors are normalized and streamed to disk; the int8 scales need the
+    per-dimension maximum, so codes are computed in a second pass over the
+    memory-mapped vectors.
+
+    Returns:
+        int: Rows indexed
+    """
+    _require_numpy()
+    os.makedirs(path, exist_ok=True)
+    max_abs = np.zeros(dim, dtype=np.float32)
+    offsets = [0]
+    count = 0
+
+    def flush(batch, vectors_file):
+        vectors = _normalize(np.asarray(batch, dtype=np.float32))
+        np.maximum(max_abs, np.abs(vectors).max(axis=0), out=max_abs)
+        vectors_file.write(vectors.tobytes())
+
+    with open(os.path.join(path, 'vectors.f32'), 'wb') as vectors_file, \
+            open(os.path.join(path, 'docs.jsonl'), 'wb') as docs_file:
+        batch = []
+        for row_id, embedding, chunks, metadata in rows:
+            if len(embedding) != dim:
+                raise ValueError(f"Row {count}: embedding has {len(embedding)} dimensions, expected {dim}")
+            batch.append(embedding)
+            line = json.dumps({'id': str(row_id) if row_id else str(count), 'chunks': chunks,
+                               'metadata': metadata}, separators=(',', ':')).encode('utf-8') + b'\n'
+            docs_file.write(line)
+            offsets.append(offsets[-1] + len(line))
+            count += 1
+            if len(batch) >= batch_rows:
+                flush(batch, vectors_file)
+                batch = []
+        if batch:
+            flush(batch, vectors_file)
+
+    scale = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+    if count:
+        vectors = np.memmap(os.path.join(path, 'vectors.f32'), dtype=np.float32, mode='r', shape=(count, dim))
+        with open(os.path.join(path, 'codes.i8'), 'wb') as int8_file, \
+                open(os.path.join(path, 'codes.bin'), 'wb') as bits_file:
+            for start in range(0, count, BLOCK_ROWS):
+                block = np.asarray(vectors[start:start + BLOCK_ROWS])
+                int8_file.write(np.clip(np.rint(block / scale), -127, 127).astype(np.int8).tobytes())
+                bits_file.write(np.packbits(block > 0, axis=1).tobytes())
+        del vectors
+    else:
+        open(os.path.join(path, 'codes.i8'), 'wb').close()
+        open(os.path.join(path, 'codes.bin'), 'wb').close()
+
+    np.asarray(offsets, dtype=np.int64).tofile(os.path.join(path, 'offsets.i64'))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'dim': dim, 'count': count, 'int8_scale': scale.tolist()}, f)
+    return count
+
+
+class VectorIndex:
+    """
+    A built index opened for search in one mode
+
+    Only the codes for the chosen mode and the docs offsets are loaded into
+    RAM; full vectors and chunk text are read from disk on demand.
+    """
+
+    def __init__(self, path, mode='int8'):
+        _require_numpy()
+        if mode not in MODES:
+            raise ValueError(f"Unknown index mode: {mode}")
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.path = path
+        self.mode = mode
+        self.dim = meta['dim']
+        self.count = meta['count']
+        self.scale = np.asarray(meta['int8_scale'], dtype=np.float32)
+        self.offsets = np.fromfile(os.path.join(path, 'offsets.i64'), dtype=np.int64)
+        self.vectors = (np.memmap(os.path.join(path, 'vectors.f32'), dtype=np.float32, mode='r',
+                                  shape=(self.count, self.dim)) if self.count else
+                        np.empty((0, self.dim), dtype=np.float32))
+        self.codes = None
+        if mode == 'int8':
+            self.codes = np.fromfile(os.path.join(path, 'codes.i8'), dtype=np.int8).reshape(self.count, self.dim)
+        elif mode == 'binary':
+            self.codes = np.fromfile(os.path.join(path, 'codes.bin'), dtype=np.uint8).reshape(self.count, -1)
+
+    def resident_bytes_per_chunk(self):
+        """RAM held per chunk: codes plus the docs offset (the full vector for float32)"""
+        per_chunk = self.offsets.itemsize
+        if self.codes is not None:
+            return per_chunk + self.codes.shape[1] * self.codes.itemsize
+        return per_chunk + self.dim * 4
+
+    def _approximate_scores(self, query):
+        scores = np.empty(self.count, dtype=np.float32)
+        if self.mode == 'int8':
+            scaled = query * self.scale
+            widened = np.empty((INT8_BLOCK_ROWS, self.dim), dtype=np.float32)
+            for start in range(0, self.count, INT8_BLOCK_ROWS):
+                block = self.codes[start:start + INT8_BLOCK_ROWS]
+                size = len(block)
+                np.copyto(widened[:size], block, casting='unsafe')
+                np.matmul(widened[:size], scaled, out=scores[start:start + size])
+        elif self.mode == 'binary':
+            query_bits = np.packbits(query > 0)
+            for start in range(0, self.count, BLOCK_ROWS):
+                block = self.codes[start:start + BLOCK_ROWS]
+                # Map Hamming distance to a cosine-like score in [-1, 1]
+                scores[start:start + len(block)] = 1.0 - 2.0 * _popcount_rows(block ^ query_bits) / self.dim
+        else:
+            for start in range(0, self.count, BLOCK_ROWS):
+                block = self.vectors[start:start + BLOCK_ROWS]
+                scores[start:start + len(block)] = block @ query
+        return scores
+
+    def search_vector(self, vector, k=5, rescore=True, candidates=None):
+        """
+        Nearest rows to a vector by cosine similarity
+
+        Args:
+            vector: Query embedding (normalized here)
+            k (int): Results to return
+            rescore (bool): Rescore candidates against the full vectors
+            candidates (int): Candidates taken from the codes before
+                              rescoring (default k * RESCORE_FACTORS[mode])
+
+        Returns:
+            list: (row, score) pairs, best first
+        """
+        if not self.count:
+            return []
+        query = _normalize(np.asarray(vector, dtype=np.float32))
+        scores = self._approximate_scores(query)
+        if self.mode == 'float32' or not rescore:
+            rows = _top(scores, k)
+            return [(int(row), float(scores[row])) for row in rows]
+
+        picked = np.sort(_top(scores, candidates or k * RESCORE_FACTORS[self.mode]))
+        # Sorted rows keep the memory-mapped reads in file order
+        exact = np.asarray(self.vectors[picked]) @ query
+        best = _top(exact, k)
+        return [(int(picked[i]), float(exact[i])) for i in best]
+
+    def document(self, row):
+        """id, chunks and metadata for a row"""
+        with open(os.path.join(self.path, 'docs.jsonl'), 'rb') as f:
+            f.seek(int(self.offsets[row]))
+            return json.loads(f.read(int(self.offsets[row + 1] - self.offsets[row])))
+
+    def search(self, vector, k=5, rescore=True, candidates=None):
+        """
+        search_vector hits as Bedrock retrieve() results
+
+        Returns:
+            list: Dicts with content, location, score and metadata, so the
+                  hits can go wherever retrievalResults are expected
+        """
+        results = []
+        for row, score in self.search_vector(vector, k, rescore, candidates):
+            doc = self.document(row)
+            metadata = doc.get('metadata') or {}
+            results.append({
+                'content': {'text': doc.get('chunks', '')},
+                'location': {'type': 'S3', 's3Location': {'uri': metadata.get('x-amz-bedrock-kb-source-uri', '')}},
+                'score': score,
+                'metadata': metadata,
+            })
+        return results
+
+    def search_text(self, query, k=5, rescore=True):
+        """Embed a question with the knowledge base's embedding model and search"""
+        return self.search(embed_text(query), k, rescore)
+
+
+def embed_text(text):
+    """Embedding of a text from the Bedrock embedding model"""
+    from bedrock_utils import bedrock
+
+    response = bedrock.invoke_model(
+        modelId=EMBEDDING_MODEL_ID,
+        contentType='application/json',
+        body=json.dumps({'inputText': text})
+    )
+    return json.loads(response['body'].read())['embedding']
+
+
+def synthetic_rows(count, dim=EMBEDDING_DIMENSIONS, clusters=256, seed=1234):
+    """Clustered random rows, so nearest neighbours are meaningful"""
+    _require_numpy()
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    for start in range(0, count, 4096):
+        size = min(4096, count - start)
+        vectors = centers[rng.integers(0, clusters, size)] + 0.6 * rng.standard_normal((size, dim)).astype(np.float32)
+        for offset, vector in enumerate(vectors):
+            row = start + offset
+            yield row, vector, f"synthetic chunk {row}", {
+                'x-amz-bedrock-kb-source-uri': f"s3://synthetic/doc-{row // 20}.pdf"
+            }
+
+
+def run_benchmark(path, queries=200, k=10, seed=1234, noise=0.3):
+    """
+    Memory per chunk, QPS and recall@k per mode against the float32 baseline
+
+    Queries are corpus vectors plus noise. Ground truth is the exact float32
+    top k.
+
+    Returns:
+        list: One result dict per configuration
+    """
+    baseline = VectorIndex(path, 'float32')
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, baseline.count, queries)
+    query_vectors = np.asarray(baseline.vectors[np.sort(rows)]) + \
+        noise * rng.standard_normal((queries, baseline.dim)).astype(np.float32) / np.sqrt(baseline.dim)
+    truth = [{row for row, _ in baseline.search_vector(q, k)} for q in query_vectors]
+
+    configs = [('float32', False), ('int8', False), ('int8', True), ('binary', False), ('binary', True)]
+    results = []
+    for mode, rescore in configs:
+        index = baseline if mode == 'float32' else VectorIndex(path, mode)
+        latencies = []
+        hits = 0
+        started = time.perf_counter()
+        for query, expected in zip(query_vectors, truth):
+            call_started = time.perf_counter()
+            found = index.search_vector(query, k, rescore=rescore)
+            latencies.append((time.perf_counter() - call_started) * 1000.0)
+            hits += len(expected & {row for row, _ in found})
+        elapsed = time.perf_counter() - started
+        results.append({
+            'mode': mode + ('+rescore' if rescore else ''),
+            'bytes_per_chunk': index.resident_bytes_per_chunk(),
+            'qps': round(queries / elapsed, 1) if elapsed else 0.0,
+            f'recall@{k}': round(hits / (queries * k), 4),
+            'latency_ms': summarize_latencies(latencies),
+        })
+    return results
+
+
+def print_benchmark(results, count):
+    k_key = next(key for key in results[0] if key.startswith('recall@'))
+    print(f"\n{count} chunks")
+    print(f"{'mode':<16} {'bytes/chunk':>12} {'qps':>10} {k_key:>10} {'p50 ms':>9} {'p95 ms':>9}")
+    for r in results:
+        print(f"{r['mode']:<16} {r['bytes_per_chunk']:>12} {r['qps']:>10} {r[k_key]:>10} "
+              f"{r['latency_ms']['p50_ms']:>9} {r['latency_ms']['p95_ms']:>9}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build and benchmark the local quantized vector index")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = sub.add_parser('build', help="Build an index from bulk-loader JSONL exports")
+    build_parser.add_argument('inputs', nargs='+')
+    build_parser.add_argument('--index', required=True, help="Index directory")
+    build_parser.add_argument('--dim', type=int, default=EMBEDDING_DIMENSIONS)
+
+    bench_parser = sub.add_parser('benchmark', help="Compare modes against the float32 baseline")
+    bench_parser.add_argument('--index', help="Existing index directory")
+    bench_parser.add_argument('--synthetic', type=int, default=0, help="Build a synthetic index of this many chunks")
+    bench_parser.add_argument('--dim', type=int, default=EMBEDDING_DIMENSIONS)
+    bench_parser.add_argument('--queries', type=int, default=200)
+    bench_parser.add_argument('--k', type=int, default=10)
+    bench_parser.add_argument('--seed', type=int, default=1234)
+    bench_parser.add_argument('--output', help="Write results as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        _require_numpy()
+    except RuntimeError as e:
+        print(f"Error: {str(e)}")
+        return 1
+
+    if args.command == 'build':
+        started = time.monotonic()
+        count = build(args.index, read_export(args.inputs), args.dim)
+        print(f"✓ Indexed {count} chunks in {time.monotonic() - started:.1f}s at {args.index}")
+        return 0
+
+    if not args.index and not args.synthetic:
+        print("Error: --index or --synthetic is required")
+        return 1
+
+    scratch = None
+    path = args.index
+    if args.synthetic:
+        scratch = tempfile.mkdtemp(prefix='vector-index-')
+        path = scratch
+        print(f"Building a synthetic index of {args.synthetic} chunks...")
+        build(path, synthetic_rows(args.synthetic, args.dim, seed=args.seed), args.dim)
+    try:
+        results = run_benchmark(path, args.queries, args.k, args.seed)
+        print_benchmark(results, VectorIndex(path, 'binary').count)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'chunks': VectorIndex(path, 'binary').count, 'dim': args.dim, 'results': results}, f, indent=2)
+            print(f"\nResults written to {args.output}")
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
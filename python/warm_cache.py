@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Answer cache warming job
+
+Ranks queries from a JSONL query log by frequency, precomputes answers for
+the top N through query_with_sources in parallel under a request-rate limit,
+and writes them as an answer cache snapshot (S3 or local file) that Lambda
+containers load on their first request (ANSWER_CACHE_LOCATION).
+
+Run it on a schedule with --if-stale (or deploy warm_handler as a scheduled
+Lambda): it compares the KB's latest completed ingestion job against the
+version the snapshot was built from and only re-warms after a new ingestion.
+
+Usage:
+    python warm_cache.py query_log.jsonl --kb-id ABCDEFGHIJ --top 200 --rate 5 \\
+        --output s3://my-bucket/cache/answers.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import priority
+from query_log import read_log
+from single_flight import normalize_query
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _queries_in_record(record):
+    """Yield the queries in one log record (single or batch request), skipping rejected ones"""
+    if isinstance(record.get('query'), str) and record.get('verdict') != 'rejected':
+        yield record['query']
+    for entry in record.get('queries') or []:
+        if isinstance(entry, dict) and isinstance(entry.get('query'), str):
+            if entry.get('verdict') != 'rejected':
+                yield entry['query']
+        elif isinstance(entry, str):
+            yield entry
+
+
+def rank_queries(log_paths, top=200):
+    """
+    Rank logged queries by frequency
+
+    Args:
+        log_paths (list): JSONL files with one request record per line
+                          (plain or gzipped query_log.py output)
+        top (int): Number of queries to keep
+
+    Returns:
+        list: (query, count) pairs, most frequent first; the query text is
+              the most common original spelling of each normalized query
+    """
+    counts = Counter()
+    spellings = {}
+    for record in read_log(log_paths):
+        for query in _queries_in_record(record):
+            key = normalize_query(query)
+            if not key:
+                continue
+            counts[key] += 1
+            spellings.setdefault(key, Counter())[query.strip()] += 1
+
+    return [(spellings[key].most_common(1)[0][0], count) for key, count in counts.most_common(top)]
+
+
+def snapshot_is_current(location, kb_version):
+    """True when an existing snapshot was built from kb_version"""
+    from answer_cache import AnswerCache
+
+    existing = AnswerCache()
+    if not existing.load(location):
+        return False
+    return existing.versions() == {kb_version}
+
+
+def warm(queries, kb_id, model_arn, workers=4, rate=5.0, classifier_model_id=None):
+    """
+    Precompute answers into bedrock_utils.answer_cache
+
+    Queries that fail validation are skipped so a cache hit never bypasses
+    the classifier for a query it would have rejected.
+
+    Returns:
+        dict: Counts of warmed, rejected and failed queries
+    """
+    import bedrock_utils
+
+    kb_version = bedrock_utils.retrieval_cache.kb_version(kb_id)
+    limiter = RateLimiter(rate)
+    stats = Counter()
+    stats_lock = threading.Lock()
+
+    def precompute(query):
+        try:
+            limiter.wait()
+            # Queue behind interactive traffic when admission control is on
+            with priority('background'):
+                if not bedrock_utils.valid_prompt(query, classifier_model_id):
+                    outcome = 'rejected'
+                else:
+                    limiter.wait()
+                    answer = bedrock_utils.query_with_sources(query, kb_id, model_arn)
+                    answer.pop('sessionId', None)
+                    bedrock_utils.answer_cache.put(query, kb_id, model_arn, answer, kb_version)
+                    outcome = 'warmed'
+        except Exception as e:
+            print(f"✗ Failed to warm '{query[:50]}': {type(e).__name__} - {str(e)}")
+            outcome = 'failed'
+        with stats_lock:
+            stats[outcome] += 1
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(precompute, queries))
+
+    return {'kb_version': kb_version, 'warmed': stats['warmed'],
+            'rejected': stats['rejected'], 'failed': stats['failed']}
+
+
+def run(log_paths, kb_id, model_arn, output, top=200, workers=4, rate=5.0, if_stale=False,
+        classifier_model_id=None):
+    """Rank, warm and save; returns a summary dict"""
+    import bedrock_utils
+
+    if if_stale:
+        kb_version = bedrock_utils.retrieval_cache.kb_version(kb_id)
+        if kb_version and snapshot_is_current(output, kb_version):
+            print(f"✓ Snapshot at {output} is current for KB version {kb_version}; nothing to do")
+            return {'kb_version': kb_version, 'skipped': True}
+
+    ranked = rank_queries(log_paths, top)
+    print(f"Warming {len(ranked)} queries ({sum(c for _, c in ranked)} logged requests)...")
+
+    started = time.monotonic()
+    summary = warm([q for q, _ in ranked], kb_id, model_arn, workers, rate, classifier_model_id)
+    bedrock_utils.answer_cache.save(output)
+    summary['elapsed_s'] = round(time.monotonic() - started, 1)
+    summary['output'] = output
+    print(f"✓ {summary}")
+    return summary
+
+
+def warm_handler(event, context):
+    """
+    Lambda entry point for a scheduled warming run
+
+    Configured with QUERY_LOG_PATHS (comma-separated local or s3:// JSONL
+    paths; an s3:// prefix ending in '/' reads every batch under it, such as
+    the QUERY_LOG_S3_URI of the query Lambda), KNOWLEDGE_BASE_ID, MODEL_ARN and ANSWER_CACHE_LOCATION. Only
+    re-warms when the KB has a newer completed ingestion job.
+    """
+    from lambda_function import _kb_config
+
+    kb_id, model_arn = _kb_config()
+    log_paths = [p for p in os.environ.get('QUERY_LOG_PATHS', '').split(',') if p]
+    summary = run(
+        log_paths, kb_id, model_arn, os.environ['ANSWER_CACHE_LOCATION'],
+        top=int(os.environ.get('WARM_TOP_QUERIES', '200')),
+        workers=int(os.environ.get('WARM_WORKERS', '4')),
+        rate=float(os.environ.get('WARM_RATE', '5')),
+        if_stale=True,
+        classifier_model_id=os.environ.get('CLASSIFIER_MODEL_ID')
+    )
+    return {'statusCode': 200, 'body': json.dumps(summary)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute answers for the most frequent queries")
+    parser.add_argument('logs', nargs='+', help="JSONL query logs: files or s3:// URIs (a trailing / reads a prefix)")
+    parser.add_argument('--kb-id', default=os.environ.get('KNOWLEDGE_BASE_ID'))
+    parser.add_argument('--model-arn', default=os.environ.get('MODEL_ARN'))
+    parser.add_argument('--output', default=os.environ.get('ANSWER_CACHE_LOCATION'),
+                        help="Snapshot location (s3://bucket/key or local path)")
+    parser.add_argument('--top', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=5.0, help="Max Bedrock requests per second")
+    parser.add_argument('--if-stale', action='store_true', help="Skip when the snapshot matches the KB version")
+    parser.add_argument('--offline', action='store_true', help="Use the local Bedrock stand-in")
+    args = parser.parse_args(argv)
+
+    if args.offline:
+        import fake_bedrock
+        fake_bedrock.install()
+        args.kb_id = args.kb_id or 'FAKEKB0001'
+
+    if not args.kb_id or not args.output:
+        print("Error: --kb-id and --output (or KNOWLEDGE_BASE_ID / ANSWER_CACHE_LOCATION) are required")
+        return 1
+
+    if not args.model_arn:
+        from model_router import get_profile, model_arn
+        args.model_arn = model_arn(get_profile('generate')['model_id'])
+
+    run(args.logs, args.kb_id, args.model_arn, args.output, args.top, args.workers, args.rate, args.if_stale)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
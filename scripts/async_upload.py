@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Asyncio S3 uploader for upload_to_s3.py
+
+Keeps many uploads in flight with bounded memory: each file is streamed in
+fixed-size chunks (at most three chunks in memory per in-flight upload: the
+part being sent, the next part and the one being read ahead), each chunk is
+checksummed once as it is read and the value is sent with it, and every
+upload can be capped to a per-connection bandwidth. Throughput is reported
+continuously while the uploads run.
+
+The reported checksum is the one S3 stores: the plain checksum for a single
+PutObject, and for multipart uploads the composite checksum (the checksum of
+the concatenated part checksums, suffixed with -<parts>), as returned by
+HeadObject with ChecksumMode=ENABLED. For MD5 the composite is the multipart
+ETag digest in base64.
+
+Uses aiobotocore when it is installed; otherwise boto3 calls run on a
+dedicated thread pool sized to the concurrency. Either way the client's
+connection pool is sized to the concurrency.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session as get_aio_session
+except ImportError:
+    get_aio_session = None
+
+try:
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 minimum for all parts except the last
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+REPORT_INTERVAL_SECONDS = 2.0
+# Region of the target bucket unless the caller passes one
+DEFAULT_REGION = os.environ.get('AWS_REGION', 'us-east-1')
+
+
+def parse_size(value):
+    """Parse sizes such as '8M', '512K' or '1048576' into bytes"""
+    value = str(value).strip().upper().rstrip('B')
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+
+class PartChecksums:
+    """
+    Per-part checksums of one upload (S3 ChecksumAlgorithm CRC32, CRC32C or MD5 only)
+
+    Each chunk is hashed exactly once; its value goes into that request's
+    headers and into the object checksum reported at the end.
+    """
+
+    def __init__(self, algorithm):
+        algorithm = algorithm.upper()
+        if algorithm == 'CRC32C' and _crc32c is None:
+            print("Warning: crc32c package not installed, using CRC32")
+            algorithm = 'CRC32'
+        self.algorithm = algorithm
+        self._digests = []
+
+    @property
+    def s3_algorithm(self):
+        """ChecksumAlgorithm value for S3, or None for plain MD5"""
+        return self.algorithm if self.algorithm in ('CRC32', 'CRC32C') else None
+
+    def _digest(self, data):
+        if self.algorithm == 'CRC32C':
+            return _crc32c.crc32c(data).to_bytes(4, 'big')
+        if self.algorithm == 'CRC32':
+            return zlib.crc32(data).to_bytes(4, 'big')
+        return hashlib.md5(data).digest()
+
+    def add(self, data):
+        """
+        Checksum one chunk
+
+        Returns:
+            dict: Request arguments carrying the checksum (Checksum<ALG> for
+                  CRCs, ContentMD5 for MD5), so botocore does not hash the
+                  body again
+        """
+        value = base64.b64encode(self._digest(data)).decode('ascii')
+        self._digests.append(value)
+        if self.s3_algorithm:
+            return {f"Checksum{self.s3_algorithm}": value}
+        return {'ContentMD5': value}
+
+    def b64(self):
+        """Object checksum as S3 reports it (composite with a -<parts> suffix for multipart)"""
+        if len(self._digests) == 1:
+            return self._digests[0]
+        joined = b''.join(base64.b64decode(value) for value in self._digests)
+        return f"{base64.b64encode(self._digest(joined)).decode('ascii')}-{len(self._digests)}"
+
+
+class BandwidthLimiter:
+    """Token bucket limiting one connection to `rate` bytes per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._allowance = rate
+        self._last = time.monotonic()
+
+    async def consume(self, nbytes):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+        self._last = now
+        self._allowance -= nbytes
+        if self._allowance < 0:
+            await asyncio.sleep(-self._allowance / self.rate)
+
+
+class Progress:
+    """Shared counters for the throughput reporter"""
+
+    def __init__(self, total_files, total_bytes):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files_done = 0
+        self.files_failed = 0
+        self.bytes_sent = 0
+        self.started = time.monotonic()
+
+    def line(self, last_bytes, interval):
+        elapsed = time.monotonic() - self.started
+        current = (self.bytes_sent - last_bytes) / interval if interval else 0.0
+        average = self.bytes_sent / elapsed if elapsed else 0.0
+        return (f"  {self.files_done}/{self.total_files} files, "
+                f"{self.bytes_sent / 1e6:.1f}/{self.total_bytes / 1e6:.1f} MB, "
+                f"{current / 1e6:.2f} MB/s now, {average / 1e6:.2f} MB/s avg")
+
+
+class _ThreadedS3:
+    """Async facade over a boto3 client using a dedicated thread pool"""
+
+    def __init__(self, concurrency, region_name):
+        self._client = boto3.client('s3', region_name=region_name,
+                                    config=Config(max_pool_connections=concurrency))
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        async def call(**kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, partial(method, **kwargs))
+        return call
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+
+
+async def _read_chunk(executor, f, size):
+    return await asyncio.get_running_loop().run_in_executor(executor, f.read, size)
+
+
+async def upload_one(s3, io_executor, bucket, local_path, key, chunk_size, checksum_algorithm,
+                     bandwidth, progress, sidecar=None):
+    """
+    Stream one file to S3
+
+    Files up to one chunk go in a single PutObject; larger files use a
+    multipart upload with one part per chunk. Returns the object checksum
+    (base64, composite for multipart) on success.
+    """
+    content_type = mimetypes.guess_type(local_path)[0] or 'binary/octet-stream'
+    checksums = PartChecksums(checksum_algorithm)
+    limiter = BandwidthLimiter(bandwidth)
+    upload_id = None
+
+    with open(local_path, 'rb') as f:
+        chunk = await _read_chunk(io_executor, f, chunk_size)
+        next_chunk = await _read_chunk(io_executor, f, chunk_size) if len(chunk) == chunk_size else b''
+
+        try:
+            if not next_chunk:
+                checksum_args = checksums.add(chunk)
+                await limiter.consume(len(chunk))
+                await s3.put_object(
+                    Bucket=bucket, Key=key, Body=chunk, ContentType=content_type, **checksum_args
+                )
+                progress.bytes_sent += len(chunk)
+            else:
+                extra = {'ChecksumAlgorithm': checksums.s3_algorithm} if checksums.s3_algorithm else {}
+                created = await s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type, **extra)
+                upload_id = created['UploadId']
+                parts = []
+                part_number = 1
+                while chunk:
+                    checksum_args = checksums.add(chunk)
+                    await limiter.consume(len(chunk))
+                    # Read the next chunk while this part is in flight
+                    uploaded, following = await asyncio.gather(
+                        s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                       Body=chunk, **checksum_args),
+                        _read_chunk(io_executor, f, chunk_size) if next_chunk else _noop(),
+                    )
+                    part = {'PartNumber': part_number, 'ETag': uploaded['ETag']}
+                    if checksums.s3_algorithm:
+                        part.update(checksum_args)
+                    parts.append(part)
+                    progress.bytes_sent += len(chunk)
+                    chunk, next_chunk = next_chunk, following
+                    part_number += 1
+                await s3.complete_multipart_upload(
+                    Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts}
+                )
+                upload_id = None
+        finally:
+            if upload_id:
+                await s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+    if sidecar:
+        await s3.put_object(
+            Bucket=bucket, Key=sidecar[0], Body=json.dumps(sidecar[1]).encode('utf-8'),
+            ContentType='application/json'
+        )
+    return checksums.b64()
+
+
+async def _noop():
+    return b''
+
+
+async def _reporter(progress, interval):
+    last_bytes = 0
+    while True:
+        await asyncio.sleep(interval)
+        print(progress.line(last_bytes, interval))
+        last_bytes = progress.bytes_sent
+
+
+async def upload_files(bucket, files, concurrency=100, chunk_size=DEFAULT_CHUNK_SIZE,
+                       checksum_algorithm='CRC32C', bandwidth_per_connection=0,
+                       sidecars=None, region_name=DEFAULT_REGION, report_interval=REPORT_INTERVAL_SECONDS):
+    """
+    Upload (local_path, key) pairs with up to `concurrency` uploads in flight
+
+    Args:
+        bucket (str): Target bucket
+        files (list): (local_path, s3_key) pairs
+        concurrency (int): Maximum simultaneous uploads
+        chunk_size (int): Read/part size in bytes (at least 5 MiB)
+        checksum_algorithm (str): CRC32C, CRC32 or MD5
+        bandwidth_per_connection (int): Bytes/s cap per upload, 0 for none
+        sidecars (dict): Optional local_path -> (sidecar_key, sidecar_doc)
+        region_name (str): Region of the bucket (default AWS_REGION)
+
+    Returns:
+        int: Number of files uploaded successfully
+    """
+    chunk_size = max(MIN_PART_SIZE, chunk_size)
+    sidecars = sidecars or {}
+    progress = Progress(len(files), sum(os.path.getsize(path) for path, _ in files))
+    semaphore = asyncio.Semaphore(concurrency)
+    io_executor = ThreadPoolExecutor(max_workers=min(32, concurrency))
+
+    async def run_one(s3, local_path, key):
+        async with semaphore:
+            try:
+                digest = await upload_one(
+                    s3, io_executor, bucket, local_path, key, chunk_size, checksum_algorithm,
+                    bandwidth_per_connection, progress, sidecars.get(local_path)
+                )
+                progress.files_done += 1
+                print(f"✓ {key} ({digest})")
+            except ClientError as e:
+                progress.files_failed += 1
+                print(f"✗ Failed to upload {local_path}: {e.response['Error']['Code']} - {e.response['Error']['Message']}")
+            except Exception as e:
+                progress.files_failed += 1
+                print(f"✗ Unexpected error uploading {local_path}: {str(e)}")
+
+    async def run_all(s3):
+        reporter = asyncio.ensure_future(_reporter(progress, report_interval))
+        try:
+            await asyncio.gather(*(run_one(s3, path, key) for path, key in files))
+        finally:
+            reporter.cancel()
+
+    try:
+        if get_aio_session is not None:
+            config = AioConfig(max_pool_connections=concurrency)
+            async with get_aio_session().create_client('s3', region_name=region_name, config=config) as s3:
+                await run_all(s3)
+        else:
+            s3 = _ThreadedS3(concurrency, region_name)
+            try:
+                await run_all(s3)
+            finally:
+                await s3.close()
+    finally:
+        io_executor.shutdown(wait=False)
+
+    elapsed = time.monotonic() - progress.started
+    print(f"\nAsync upload: {progress.files_done}/{len(files)} files, "
+          f"{progress.bytes_sent / 1e6:.1f} MB in {elapsed:.1f}s "
+          f"({progress.bytes_sent / elapsed / 1e6 if elapsed else 0:.2f} MB/s)")
+    return progress.files_done
@@ -34,6 +34,15 @@ CREATE INDEX IF NOT EXISTS idx_bedrock_kb_text
 ON bedrock_integration.bedrock_knowledge_base 
 USING gin (to_tsvector('english', chunks));
 
+-- scripts/bulk_load_kb.py builds these same indexes after a bulk load;
+-- keep the definitions in sync with its INDEXES table
+
+-- Metadata filters (equipment_type, manufacturer, model, doc_date facets
+-- written by scripts/upload_to_s3.py) are evaluated against this column
+CREATE INDEX IF NOT EXISTS idx_bedrock_kb_metadata 
+ON bedrock_integration.bedrock_knowledge_base 
+USING gin (metadata jsonb_path_ops);
+
 -- 8. Verify setup
 SELECT * FROM pg_extension WHERE extname = 'vector';
 SELECT table_schema || '.' || table_name as show_tables 
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Stale-chunk garbage collection for the knowledge base
+
+upload_to_s3.py only ever adds objects, so a spec sheet removed from
+spec-sheets/ stays in S3 and its chunks stay in
+bedrock_integration.bedrock_knowledge_base, where they grow the HNSW index
+and keep ranking. This job reconciles the three copies:
+
+    local files  - spec-sheets/ (the source of truth, or S3 with --source s3)
+    S3 objects   - documents and their .metadata.json sidecars
+    table rows   - grouped by the x-amz-bedrock-kb-source-uri metadata key
+
+Objects and rows whose source is gone are deleted in batches. Only objects
+upload_to_s3.py could have written are candidates (document formats the KB
+ingests, their sidecars, or anything with a sidecar), so other objects in
+the bucket such as answer-cache snapshots or query logs are left alone.
+Only URIs under this bucket and prefix are considered; rows with other or
+missing URIs are reported, never deleted. When dead tuples pass --bloat-threshold the
+table is vacuumed and its indexes are rebuilt concurrently. The report lists
+orphans found, rows deleted and bytes reclaimed.
+
+Nothing is deleted without --apply.
+
+Usage:
+    python reconcile_kb.py --secret-id [bedrock-user-secret] --host [cluster-endpoint]           # dry run
+    python reconcile_kb.py --secret-id [bedrock-user-secret] --host [cluster-endpoint] --apply
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+import upload_to_s3
+from bulk_load_kb import INDEXES, SCHEMA, TABLE, connect
+from upload_to_s3 import DOCUMENT_EXTENSIONS, SIDECAR_SUFFIX, bucket_name, collect_files, prefix
+
+SOURCE_URI_KEY = 'x-amz-bedrock-kb-source-uri'
+S3_DELETE_BATCH = 1000  # DeleteObjects limit
+ROW_DELETE_BATCH = 5000
+BLOAT_THRESHOLD = 0.2
+
+_TABLE = f"{SCHEMA}.{TABLE}"
+
+
+def uri_for(key):
+    return f"s3://{bucket_name}/{key}"
+
+
+def list_s3_keys(s3_client):
+    """All object keys under the upload prefix with their sizes"""
+    keys = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            keys[obj['Key']] = obj['Size']
+    return keys
+
+
+def source_uri_counts(conn):
+    """Rows and bytes per source URI in the table"""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT metadata->>%s, count(*), coalesce(sum(pg_column_size(t.*)), 0) "
+            f"FROM {_TABLE} t GROUP BY 1",
+            (SOURCE_URI_KEY,)
+        )
+        return {uri: (rows, size) for uri, rows, size in cursor.fetchall()}
+
+
+def is_uploaded_object(key, s3_keys):
+    """True for keys upload_to_s3.py writes: KB documents, sidecars, or objects that have a sidecar"""
+    if key.endswith(SIDECAR_SUFFIX):
+        return True
+    return key.lower().endswith(DOCUMENT_EXTENSIONS) or key + SIDECAR_SUFFIX in s3_keys
+
+
+def plan(local_keys, s3_keys, table_uris, source='local'):
+    """
+    Work out what is orphaned
+
+    Args:
+        local_keys (set): S3 keys the local files map to
+        s3_keys (dict): S3 key -> size
+        table_uris (dict): Source URI -> (rows, bytes)
+        source (str): 'local' to treat spec-sheets/ as the truth, 's3' to
+                      keep every document still in S3
+
+    Returns:
+        dict: S3 objects and table URIs to delete, rows that cannot be
+              attributed to this bucket, and objects skipped as not uploaded
+              documents
+    """
+    documents = {key for key in s3_keys if not key.endswith(SIDECAR_SUFFIX)}
+    expected = local_keys if source == 'local' else documents
+
+    orphan_objects = []
+    skipped_objects = 0
+    if source == 'local':
+        for key in sorted(s3_keys):
+            if not is_uploaded_object(key, s3_keys):
+                skipped_objects += 1
+                continue
+            document = key[:-len(SIDECAR_SUFFIX)] if key.endswith(SIDECAR_SUFFIX) else key
+            if document not in expected:
+                orphan_objects.append(key)
+
+    uri_prefix = uri_for(prefix)
+    expected_uris = {uri_for(key) for key in expected}
+    orphan_uris = []
+    unattributed = 0
+    for uri, (rows, _) in table_uris.items():
+        if not uri or not uri.startswith(uri_prefix):
+            unattributed += rows
+        elif uri not in expected_uris:
+            orphan_uris.append(uri)
+
+    return {
+        'orphan_objects': orphan_objects,
+        'orphan_object_bytes': sum(s3_keys[key] for key in orphan_objects),
+        'orphan_uris': sorted(orphan_uris),
+        'orphan_rows': sum(table_uris[uri][0] for uri in orphan_uris),
+        'orphan_row_bytes': sum(table_uris[uri][1] for uri in orphan_uris),
+        'unattributed_rows': unattributed,
+        'skipped_objects': skipped_objects,
+    }
+
+
+def delete_objects(s3_client, keys):
+    """Delete S3 objects in DeleteObjects-sized batches; returns the number deleted"""
+    deleted = 0
+    for start in range(0, len(keys), S3_DELETE_BATCH):
+        batch = keys[start:start + S3_DELETE_BATCH]
+        try:
+            response = s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+            )
+        except ClientError as e:
+            print(f"✗ Failed to delete S3 objects: {e.response['Error']['Code']} - {e.response['Error']['Message']}")
+            continue
+        for error in response.get('Errors', []):
+            print(f"✗ Failed to delete {error['Key']}: {error['Code']}")
+        deleted += len(batch) - len(response.get('Errors', []))
+    return deleted
+
+
+def delete_rows(conn, uris, batch_rows=ROW_DELETE_BATCH):
+    """
+    Delete rows for the given source URIs, batch_rows per transaction
+
+    The ids are selected once (one scan of metadata->>key, which no index
+    covers) and then deleted by primary key. Short transactions keep row
+    locks and WAL bursts small while the table is serving queries.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id FROM {_TABLE} WHERE metadata->>%s = ANY(%s)",
+            (SOURCE_URI_KEY, list(uris))
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+
+    deleted = 0
+    with conn.cursor() as cursor:
+        for start in range(0, len(ids), batch_rows):
+            cursor.execute(f"DELETE FROM {_TABLE} WHERE id = ANY(%s)", (ids[start:start + batch_rows],))
+            conn.commit()
+            deleted += cursor.rowcount
+            print(f"  deleted {deleted}/{len(ids)} rows")
+    return deleted
+
+
+def table_health(conn):
+    """Live/dead tuples and on-disk size (table plus indexes)"""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT n_live_tup, n_dead_tup, pg_total_relation_size(relid) "
+            "FROM pg_stat_user_tables WHERE schemaname = %s AND relname = %s",
+            (SCHEMA, TABLE)
+        )
+        row = cursor.fetchone()
+    live, dead, size = row if row else (0, 0, 0)
+    return {'live_rows': live, 'dead_rows': dead, 'bytes': size,
+            'dead_ratio': round(dead / (live + dead), 4) if live + dead else 0.0}
+
+
+def compact(conn, health, threshold=BLOAT_THRESHOLD):
+    """
+    VACUUM and REINDEX CONCURRENTLY once dead tuples pass the threshold
+
+    Plain VACUUM makes dead space reusable without blocking queries;
+    rebuilding the indexes is what actually shrinks them, HNSW in
+    particular. Both need autocommit.
+
+    Returns:
+        bool: True if compaction ran
+    """
+    if health['dead_ratio'] < threshold:
+        print(f"Dead tuple ratio {health['dead_ratio']:.1%} is under {threshold:.0%}; skipping VACUUM/REINDEX")
+        return False
+
+    conn.commit()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            for label, sql in [('vacuum', f"VACUUM (ANALYZE) {_TABLE}")] + [
+                    (name, f"REINDEX INDEX CONCURRENTLY {SCHEMA}.{name}") for name in INDEXES]:
+                started = time.monotonic()
+                cursor.execute(sql)
+                print(f"  {label}: {time.monotonic() - started:.1f}s")
+    finally:
+        conn.autocommit = False
+    return True
+
+
+def reconcile(conn, s3_client, source='local', apply=False, threshold=BLOAT_THRESHOLD,
+              batch_rows=ROW_DELETE_BATCH):
+    """
+    Diff local files, S3 and the table, and (with apply) delete orphans
+
+    Returns:
+        dict: The plan, what was deleted, and table health before/after
+    """
+    local_keys = {s3_key for _, s3_key in collect_files()} if source == 'local' else set()
+    s3_keys = list_s3_keys(s3_client)
+    table_uris = source_uri_counts(conn)
+    conn.commit()
+    before = table_health(conn)
+
+    found = plan(local_keys, s3_keys, table_uris, source)
+    print(f"Local documents: {len(local_keys)}, S3 objects: {len(s3_keys)}, "
+          f"table sources: {len(table_uris)} ({sum(rows for rows, _ in table_uris.values())} rows)")
+    print(f"Orphaned S3 objects: {len(found['orphan_objects'])} ({found['orphan_object_bytes']} bytes)")
+    print(f"Orphaned table sources: {len(found['orphan_uris'])} "
+          f"({found['orphan_rows']} rows, ~{found['orphan_row_bytes']} bytes)")
+    for uri in found['orphan_uris'][:20]:
+        print(f"  - {uri} ({table_uris[uri][0]} rows)")
+    if found['skipped_objects']:
+        print(f"Skipped {found['skipped_objects']} S3 objects that are not uploaded documents")
+    if found['unattributed_rows']:
+        print(f"⚠ {found['unattributed_rows']} rows have no source URI under s3://{bucket_name}/{prefix}; left alone")
+
+    report = {'plan': found, 'applied': apply, 'before': before}
+    if not apply:
+        print("\nDry run: re-run with --apply to delete")
+        return report
+
+    if source == 'local' and not local_keys:
+        # An empty spec-sheets/ would otherwise wipe the bucket and the table
+        print("⚠ No local documents found; not deleting anything")
+        return report
+
+    report['objects_deleted'] = delete_objects(s3_client, found['orphan_objects'])
+    print(f"✓ Deleted {report['objects_deleted']} S3 objects")
+    report['rows_deleted'] = delete_rows(conn, found['orphan_uris'], batch_rows) if found['orphan_uris'] else 0
+    print(f"✓ Deleted {report['rows_deleted']} rows")
+
+    # Statistics lag the deletes; ANALYZE refreshes the dead tuple count
+    with conn.cursor() as cursor:
+        cursor.execute(f"ANALYZE {_TABLE}")
+    conn.commit()
+    report['compacted'] = compact(conn, table_health(conn), threshold)
+    report['after'] = table_health(conn)
+    report['bytes_reclaimed'] = max(0, before['bytes'] - report['after']['bytes'])
+    print(f"✓ Reclaimed {report['rows_deleted']} rows and {report['bytes_reclaimed']} bytes "
+          f"({before['bytes']} -> {report['after']['bytes']})")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Delete knowledge base chunks and S3 objects whose source is gone")
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--secret-id', help="Secrets Manager secret with username/password")
+    parser.add_argument('--host', help="Cluster endpoint (with --secret-id)")
+    parser.add_argument('--database', default='postgres')
+    parser.add_argument('--source', choices=['local', 's3'], default='local',
+                        help="What counts as current: spec-sheets/ (default) or the documents in S3")
+    parser.add_argument('--apply', action='store_true', help="Delete orphans (default is a dry run)")
+    parser.add_argument('--bloat-threshold', type=float, default=BLOAT_THRESHOLD,
+                        help="Dead tuple ratio that triggers VACUUM/REINDEX")
+    parser.add_argument('--batch-rows', type=int, default=ROW_DELETE_BATCH)
+    parser.add_argument('--output', help="Write the report as JSON")
+    args = parser.parse_args(argv)
+
+    if not args.dsn and not args.secret_id:
+        print("Error: --dsn (or DATABASE_URL) or --secret-id is required")
+        return 1
+    if args.source == 'local' and not os.path.exists(upload_to_s3.local_folder):
+        print(f"Error: Local folder '{upload_to_s3.local_folder}' does not exist")
+        return 1
+
+    s3_client = boto3.client('s3', region_name=upload_to_s3.region_name)
+    with connect(args.dsn, args.secret_id, args.host, args.database) as conn:
+        report = reconcile(conn, s3_client, args.source, args.apply, args.bloat_threshold, args.batch_rows)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    if report.get('rows_deleted'):
+        print("\nSync the knowledge base data source so Bedrock's ingestion state matches")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
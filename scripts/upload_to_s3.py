@@ -1,40 +1,90 @@
 #!/usr/bin/env python3
 """
 S3 Upload Script for Heavy Machinery Spec Sheets
-Uploads all files from spec-sheets folder to S3 bucket
+Uploads all files from spec-sheets folder to S3 bucket, each with a
+Bedrock KB metadata sidecar (<file>.metadata.json) holding its facets
+
+Usage:
+    python upload_to_s3.py                     # serial upload
+    python upload_to_s3.py --async --concurrency 100 --bandwidth-per-connection 2M
 """
 
+import argparse
+import asyncio
 import os
+import sys
+import json
 import boto3
 from botocore.exceptions import ClientError
 import mimetypes
 
+# Facet extraction is shared with the query side in ../python
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+from facets import extract_facets, metadata_sidecar
+from spec_index import SpecIndex, DEFAULT_INDEX_PATH
+
 # Configuration - UPDATE THESE VALUES
 bucket_name = "doc-query-system-dev-documents-471848907879"  # Update with your bucket name
 prefix = ""  # Optional: specify a folder path in S3
 local_folder = "../spec-sheets"  # Path to local spec-sheets folder
+region_name = os.environ.get('AWS_REGION', 'us-east-1')  # Region of the bucket
 
-def upload_files_to_s3():
-    """Upload all files from spec-sheets folder to S3"""
+SIDECAR_SUFFIX = '.metadata.json'
+# File types whose text is read for facet extraction (others use the file name)
+TEXT_EXTENSIONS = ('.txt', '.md', '.csv', '.html', '.htm')
+# Document formats a Bedrock knowledge base ingests
+DOCUMENT_EXTENSIONS = TEXT_EXTENSIONS + ('.pdf', '.doc', '.docx', '.xls', '.xlsx')
+
+def build_sidecar(local_path):
+    """
+    Build the metadata sidecar for a document
     
-    # Initialize S3 client
-    s3_client = boto3.client('s3', region_name='us-east-1')
+    A hand-written <file>.metadata.json next to the document takes
+    precedence; otherwise facets are extracted from the text (or, for
+    binary formats such as PDF, from the file name).
     
-    # Check if local folder exists
-    if not os.path.exists(local_folder):
-        print(f"Error: Local folder '{local_folder}' does not exist")
-        return False
+    Returns:
+        dict: Sidecar document, or None when no facets were found
+    """
+    if os.path.exists(local_path + SIDECAR_SUFFIX):
+        with open(local_path + SIDECAR_SUFFIX) as f:
+            return json.load(f)
+    
+    if local_path.lower().endswith(TEXT_EXTENSIONS):
+        with open(local_path, encoding='utf-8', errors='replace') as f:
+            text = f.read()
+    else:
+        text = os.path.splitext(os.path.basename(local_path))[0].replace('_', ' ').replace('-', ' ')
     
-    # Get list of files to upload
+    facets = extract_facets(text, local_path)
+    return metadata_sidecar(facets) if facets else None
+
+def collect_files():
+    """List (local_path, s3_key) pairs for every document under local_folder"""
     files_to_upload = []
     for root, dirs, files in os.walk(local_folder):
         for file in files:
+            if file.endswith(SIDECAR_SUFFIX):
+                continue  # uploaded together with its document
             local_path = os.path.join(root, file)
             # Create S3 key maintaining folder structure
             relative_path = os.path.relpath(local_path, local_folder)
             s3_key = os.path.join(prefix, relative_path).replace('\\', '/') if prefix else relative_path.replace('\\', '/')
             files_to_upload.append((local_path, s3_key))
+    return files_to_upload
+
+def upload_files_to_s3():
+    """Upload all files from spec-sheets folder to S3"""
+    
+    # Initialize S3 client
+    s3_client = boto3.client('s3', region_name=region_name)
     
+    # Check if local folder exists
+    if not os.path.exists(local_folder):
+        print(f"Error: Local folder '{local_folder}' does not exist")
+        return False
+    
+    files_to_upload = collect_files()
     if not files_to_upload:
         print(f"No files found in '{local_folder}'")
         return False
@@ -56,6 +106,17 @@ def upload_files_to_s3():
             extra_args = {'ContentType': content_type}
             s3_client.upload_file(local_path, bucket_name, s3_key, ExtraArgs=extra_args)
             
+            # Upload the facet sidecar used for metadata-filtered retrieval
+            sidecar = build_sidecar(local_path)
+            if sidecar:
+                s3_client.put_object(
+                    Bucket=bucket_name,
+                    Key=s3_key + SIDECAR_SUFFIX,
+                    Body=json.dumps(sidecar).encode('utf-8'),
+                    ContentType='application/json'
+                )
+                print(f"  Facets: {sidecar.get('metadataAttributes', {})}")
+            
             success_count += 1
             print(f"✓ Successfully uploaded: {s3_key}")
             
@@ -66,19 +127,63 @@ def upload_files_to_s3():
             print(f"✗ Unexpected error uploading {local_path}: {str(e)}")
     
     print(f"\nUpload complete: {success_count}/{len(files_to_upload)} files uploaded successfully")
+    finish_upload(success_count)
+    return success_count == len(files_to_upload)
+
+def async_upload_files_to_s3(concurrency, chunk_size, checksum_algorithm, bandwidth_per_connection):
+    """
+    Upload all files with the asyncio uploader (see async_upload.py)
+    
+    Streams each file in chunk_size pieces with checksums computed as the
+    bytes are read, keeping up to `concurrency` uploads in flight.
+    """
+    from async_upload import upload_files
+    
+    if not os.path.exists(local_folder):
+        print(f"Error: Local folder '{local_folder}' does not exist")
+        return False
+    
+    files_to_upload = collect_files()
+    if not files_to_upload:
+        print(f"No files found in '{local_folder}'")
+        return False
+    
+    print(f"Found {len(files_to_upload)} files to upload to bucket '{bucket_name}' "
+          f"(async, {concurrency} concurrent, {checksum_algorithm})")
+    
+    sidecars = {}
+    for local_path, s3_key in files_to_upload:
+        sidecar = build_sidecar(local_path)
+        if sidecar:
+            sidecars[local_path] = (s3_key + SIDECAR_SUFFIX, sidecar)
+    
+    success_count = asyncio.run(upload_files(
+        bucket_name, files_to_upload, concurrency=concurrency, chunk_size=chunk_size,
+        checksum_algorithm=checksum_algorithm, bandwidth_per_connection=bandwidth_per_connection,
+        sidecars=sidecars, region_name=region_name
+    ))
+    finish_upload(success_count)
+    return success_count == len(files_to_upload)
+
+def finish_upload(success_count):
+    """Rebuild the spec index and print next steps after an upload"""
+    # Rebuild the spec-line index used by the Lambda fast path
+    if success_count > 0:
+        uri_prefix = f"s3://{bucket_name}/" + (prefix.rstrip('/') + '/' if prefix else '')
+        spec_index = SpecIndex.build(local_folder, uri_prefix)
+        spec_index.save(DEFAULT_INDEX_PATH)
+        print(f"✓ Indexed {len(spec_index)} spec lines into {DEFAULT_INDEX_PATH} (package it with the Lambda)")
     
     if success_count > 0:
         print(f"\nNext steps:")
         print(f"1. Go to AWS Console -> Bedrock -> Knowledge Bases")
         print(f"2. Find your knowledge base and go to Data sources")
         print(f"3. Click 'Sync' to process the uploaded documents")
-    
-    return success_count == len(files_to_upload)
 
 def list_bucket_contents():
     """List current contents of the S3 bucket"""
     try:
-        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client = boto3.client('s3', region_name=region_name)
         
         print(f"\nCurrent contents of bucket '{bucket_name}':")
         response = s3_client.list_objects_v2(Bucket=bucket_name)
@@ -93,6 +198,19 @@ def list_bucket_contents():
         print(f"Error listing bucket contents: {e.response['Error']['Message']}")
 
 if __name__ == "__main__":
+    from async_upload import DEFAULT_CHUNK_SIZE, parse_size
+    
+    parser = argparse.ArgumentParser(description="Upload spec sheets to S3")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Use the asyncio uploader (streaming reads, many uploads in flight)")
+    parser.add_argument('--concurrency', type=int, default=100, help="Uploads in flight (async mode)")
+    parser.add_argument('--chunk-size', type=parse_size, default=DEFAULT_CHUNK_SIZE,
+                        help="Read/part size, e.g. 8M (minimum 5M)")
+    parser.add_argument('--checksum', default='CRC32C', choices=['CRC32C', 'CRC32', 'MD5'], type=str.upper)
+    parser.add_argument('--bandwidth-per-connection', type=parse_size, default=0,
+                        help="Bytes/s cap per upload, e.g. 2M (0 = unlimited)")
+    args = parser.parse_args()
+    
     print("S3 Upload Script for Heavy Machinery Spec Sheets")
     print("=" * 50)
     
@@ -102,7 +220,12 @@ if __name__ == "__main__":
         exit(1)
     
     # Upload files
-    success = upload_files_to_s3()
+    if args.use_async:
+        success = async_upload_files_to_s3(
+            args.concurrency, args.chunk_size, args.checksum, args.bandwidth_per_connection
+        )
+    else:
+        success = upload_files_to_s3()
     
     # List bucket contents
     list_bucket_contents()